@@ -43,13 +43,27 @@ class Ui_MainWindow(object):
         self.sim_mode_layout = QtWidgets.QVBoxLayout(self.sim_mode_group)
         self.top_h_layout.addWidget(self.sim_mode_group, stretch=2)
 
-        self.RHV = QtWidgets.QRadioButton("Right Circular Hybrid mode")
-        self.LHV = QtWidgets.QRadioButton("Left Circular Hybrid mode")
-        self.PI4 = QtWidgets.QRadioButton("Pi/4 Mode")
+        # Several modes can be selected; they are synthesized from the same read of the inputs
+        self.RHV = QtWidgets.QCheckBox("Right Circular Hybrid mode")
+        self.LHV = QtWidgets.QCheckBox("Left Circular Hybrid mode")
+        self.PI4 = QtWidgets.QCheckBox("Pi/4 Mode")
+        self.Ellipse = QtWidgets.QCheckBox("Custom ellipse (orientation, ellipticity):")
+
+        self.ellipse_orientation = QtWidgets.QDoubleSpinBox()
+        self.ellipse_orientation.setRange(-90.0, 90.0)
+        self.ellipse_orientation.setSuffix("°")
+        self.ellipse_ellipticity = QtWidgets.QDoubleSpinBox()
+        self.ellipse_ellipticity.setRange(-45.0, 45.0)
+        self.ellipse_ellipticity.setSuffix("°")
+        self.ellipse_layout = QtWidgets.QHBoxLayout()
+        self.ellipse_layout.addWidget(self.ellipse_orientation)
+        self.ellipse_layout.addWidget(self.ellipse_ellipticity)
 
         self.sim_mode_layout.addWidget(self.RHV)
         self.sim_mode_layout.addWidget(self.LHV)
         self.sim_mode_layout.addWidget(self.PI4)
+        self.sim_mode_layout.addWidget(self.Ellipse)
+        self.sim_mode_layout.addLayout(self.ellipse_layout)
         self.sim_mode_layout.addStretch()
 
         # --- Start Button ---
@@ -60,6 +74,56 @@ class Ui_MainWindow(object):
         self.Convert_to_CP.setObjectName("Convert_to_CP")
         self.Convert_to_CP.setMinimumHeight(60)
         self.start_layout.addWidget(self.Convert_to_CP)
+
+        self.Cancel = QtWidgets.QPushButton("Cancel")
+        self.Cancel.setObjectName("Cancel")
+        self.Cancel.setEnabled(False)
+        self.start_layout.addWidget(self.Cancel)
+
+        self.Preview = QtWidgets.QPushButton("Preview")
+        self.Preview.setObjectName("Preview")
+        self.Preview.setToolTip("Quick look of the first selected mode on a decimated copy of the scene, with input checks")
+        self.start_layout.addWidget(self.Preview)
+
+        self.use_cache = QtWidgets.QCheckBox("Cache calibrated data")
+        self.use_cache.setToolTip("Keep the calibrated scattering matrix on disk so that later runs on the same scene skip calibration")
+        self.start_layout.addWidget(self.use_cache)
+
+        self.show_stats = QtWidgets.QCheckBox("Show stage timings")
+        self.show_stats.setToolTip("Show the time and throughput of every processing stage while the simulation runs")
+        self.start_layout.addWidget(self.show_stats)
+
+        self.region_label = QtWidgets.QLabel("Region of interest:")
+        self.start_layout.addWidget(self.region_label)
+        self.region = QtWidgets.QLineEdit()
+        self.region.setObjectName("region")
+        self.region.setPlaceholderText("Whole scene, or column row width height")
+        self.region.setToolTip("Pixel window or GeoJSON AOI file; only this part of the scene is processed")
+        self.start_layout.addWidget(self.region)
+        self.region_file = QtWidgets.QPushButton("AOI polygon...")
+        self.region_file.setObjectName("region_file")
+        self.start_layout.addWidget(self.region_file)
+
+        # Memory use grows with the tile size and the number of workers
+        self.tiling_layout = QtWidgets.QHBoxLayout()
+        self.tile_size = QtWidgets.QSpinBox()
+        self.tile_size.setObjectName("tile_size")
+        self.tile_size.setRange(64, 8192)
+        self.tile_size.setSingleStep(256)
+        self.tile_size.setValue(1024)
+        self.tile_size.setPrefix("Tiles of ")
+        self.tile_size.setSuffix(" px")
+        self.tile_size.setToolTip("Edge length of the tiles processed at once")
+        self.workers = QtWidgets.QSpinBox()
+        self.workers.setObjectName("workers")
+        self.workers.setRange(0, 256)
+        self.workers.setSuffix(" workers")
+        self.workers.setSpecialValueText("Auto workers")
+        self.workers.setToolTip("Tiles processed in parallel. Auto uses the processor cores, "
+                                "as many as fit in half of the available memory")
+        self.tiling_layout.addWidget(self.tile_size)
+        self.tiling_layout.addWidget(self.workers)
+        self.start_layout.addLayout(self.tiling_layout)
         self.start_layout.addStretch()
 
 
@@ -74,15 +138,39 @@ class Ui_MainWindow(object):
 
         self.Scattering = QtWidgets.QCheckBox("Scattering vector")
         self.Covariance = QtWidgets.QCheckBox("Covariance matrix")
+        self.Stokes = QtWidgets.QCheckBox("Stokes vector")
+        self.DoP = QtWidgets.QCheckBox("Degree of polarization")
+        self.MChi = QtWidgets.QCheckBox("m-chi decomposition")
+        self.MDelta = QtWidgets.QCheckBox("m-delta decomposition")
+        self.Ratio = QtWidgets.QCheckBox("Intensity ratio (RH/RV)")
 
         self.features_layout.addWidget(self.Scattering)
         self.features_layout.addWidget(self.Covariance)
+        self.features_layout.addWidget(self.Stokes)
+        self.features_layout.addWidget(self.DoP)
+        self.features_layout.addWidget(self.MChi)
+        self.features_layout.addWidget(self.MDelta)
+        self.features_layout.addWidget(self.Ratio)
         self.features_layout.addStretch()
 
         # --- Log Text Browser ---
         self.log_text = QtWidgets.QTextBrowser(self.centralwidget)
         self.log_text.setObjectName("log_text")
         self.bottom_h_layout.addWidget(self.log_text, stretch=2)
+
+        # --- Progress Bar ---
+        self.progress_bar = QtWidgets.QProgressBar(self.centralwidget)
+        self.progress_bar.setObjectName("progress_bar")
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("%v / %m tiles")
+        self.main_layout.addWidget(self.progress_bar)
+
+        # --- Stage timings (live view) ---
+        self.stage_stats = QtWidgets.QLabel(self.centralwidget)
+        self.stage_stats.setObjectName("stage_stats")
+        self.stage_stats.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.SystemFont.FixedFont))
+        self.stage_stats.setVisible(False)
+        self.main_layout.addWidget(self.stage_stats)
         
         # --- Footer (Email) ---
         self.email_label = QtWidgets.QLabel(self.centralwidget)
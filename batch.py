@@ -0,0 +1,291 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+# Like cli.py, heavy imports (numpy, rasterio) are deferred to the functions that need them.
+
+# Manifest keys passed to run_tiled as they are, per scene or for all scenes in "options"
+RUN_OPTIONS = ["tile_size", "workers", "use_processes", "precision", "output_dtype", "int16_scale",
+               "layout", "compress", "tiled", "overviews", "cog", "looks", "speckle_filter",
+               "filter_size", "memmap", "region", "prefetch", "output_format"]
+
+DEFAULT_MEMORY_BUDGET = 4 * 2**30
+
+STATE_FILE = "batch_state.json"
+JOURNAL_FILE = "tiles.journal"
+
+# Seconds between saves of the state for tile progress alone
+STATE_SAVE_INTERVAL = 5
+
+
+def load_manifest(path):
+    # {"output_root", "modes", "products", "options", "cache_dir", "cache_size_gb",
+    #  "scenes": [{"name", "sensor", "images", "lut", and per-scene "modes", "products", "options"}]}
+    # A RADARSAT-2 scene can instead give its "product" folder and a "lut_type" (sigma, beta or gamma).
+    # Relative paths are relative to the manifest
+    with open(path) as file:
+        manifest = json.load(file)
+    base = os.path.dirname(os.path.abspath(path))
+
+    def resolve(value):
+        return os.path.normpath(os.path.join(base, os.path.expanduser(value)))
+
+    scenes = []
+    for index, entry in enumerate(manifest.get("scenes", [])):
+        sensor = entry.get("sensor")
+        images = [resolve(image) for image in entry.get("images", [])]
+        lut = resolve(entry["lut"]) if entry.get("lut") else None
+        name = entry.get("name") or f"scene_{index + 1:04d}"
+        if entry.get("product"):
+            from radarsat2 import LUT_TYPES, read_product
+
+            sensor = sensor or "RADARSAT2"
+            lut_type = entry.get("lut_type", "sigma")
+            product = read_product(resolve(entry["product"]))
+            if lut_type not in LUT_TYPES or lut_type not in product["luts"]:
+                raise ValueError(f"Scene {name}: the product has no {lut_type!r} LUT.")
+            images = [product["paths"][pol] for pol in ["HH", "HV", "VH", "VV"]]
+            lut = product["luts"][lut_type]
+        if sensor not in ("RADARSAT2", "ALOS"):
+            raise ValueError(f"Scene {name}: unknown sensor {sensor!r}.")
+        if sensor == "RADARSAT2" and (len(images) != 4 or not lut):
+            raise ValueError(f"Scene {name}: RADARSAT-2 needs 4 images (HH, HV, VH, VV) and a lut.")
+        if sensor == "ALOS" and len(images) != 1:
+            raise ValueError(f"Scene {name}: ALOS-PALSAR needs exactly 1 VOL file.")
+
+        options = dict(manifest.get("options", {}), **entry.get("options", {}))
+        unknown = set(options) - set(RUN_OPTIONS)
+        if unknown:
+            raise ValueError(f"Scene {name}: unknown options {sorted(unknown)}.")
+        for option in ("tile_size", "workers"):
+            if option in options and (not isinstance(options[option], int) or options[option] < 1):
+                raise ValueError(f"Scene {name}: {option} must be a positive integer.")
+        if "looks" in options:
+            options["looks"] = tuple(options["looks"])
+        if isinstance((options.get("region") or {}).get("polygon"), str):
+            options["region"] = dict(options["region"], polygon=resolve(options["region"]["polygon"]))
+
+        scenes.append({
+            "name": name,
+            "sensor": sensor,
+            "paths": dict(zip(["HH", "HV", "VH", "VV"], images)),
+            "lut": lut,
+            "modes": entry.get("modes", manifest.get("modes")),
+            "products": entry.get("products", manifest.get("products")),
+            "options": options,
+        })
+        if not scenes[-1]["modes"] or not scenes[-1]["products"]:
+            raise ValueError(f"Scene {name}: no modes or products given.")
+
+    names = [scene["name"] for scene in scenes]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Scene names must be unique: {duplicates}")
+
+    return {
+        "output_root": resolve(manifest.get("output_root", ".")),
+        "cache_dir": resolve(manifest["cache_dir"]) if manifest.get("cache_dir") else None,
+        "cache_size": int(manifest.get("cache_size_gb", 20) * 2**30),
+        "scenes": scenes,
+    }
+
+
+class BatchState:
+    # Per-scene status of a campaign in <output_root>/batch_state.json, shared by the scene threads
+
+    def __init__(self, output_root):
+        self.path = os.path.join(output_root, STATE_FILE)
+        self.lock = threading.Lock()
+        self.last_save = 0
+        try:
+            with open(self.path) as file:
+                self.scenes = json.load(file)
+        except (OSError, ValueError):
+            self.scenes = {}
+
+    def status(self, name):
+        return self.scenes.get(name, {}).get("status")
+
+    def update(self, name, save=True, **fields):
+        with self.lock:
+            self.scenes.setdefault(name, {}).update(fields, updated=time.strftime("%Y-%m-%dT%H:%M:%S"))
+            if not save and time.monotonic() - self.last_save < STATE_SAVE_INTERVAL:
+                return
+            self.last_save = time.monotonic()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            staging_path = self.path + ".tmp"
+            with open(staging_path, "w") as file:
+                json.dump(self.scenes, file, indent=2)
+            os.replace(staging_path, self.path)
+
+
+def scene_signature(scene):
+    # Parameters the tile journal of a scene is valid for
+    return json.dumps({key: scene[key] for key in ("sensor", "paths", "lut", "modes", "products", "options")},
+                      sort_keys=True)
+
+
+def scene_memory(scene):
+    from pipeline import DEFAULT_PREFETCH, DEFAULT_TILE_SIZE, estimate_memory, make_job
+
+    options = scene["options"]
+    job = make_job(scene["sensor"], None, scene["modes"], scene["products"],
+                   options.get("precision", "reference"), options.get("output_dtype", "float32"),
+                   looks=options.get("looks", (1, 1)), speckle_filter=options.get("speckle_filter"),
+                   filter_size=options.get("filter_size", 7))
+    return estimate_memory(job, options.get("tile_size", DEFAULT_TILE_SIZE), options.get("workers", 1),
+                           options.get("prefetch", DEFAULT_PREFETCH))
+
+
+def run_scene(scene, output_root, state, cache=None, cancel=None, log=print):
+    from pipeline import ProcessingCancelled, TileJournal, load_calibration, run_tiled
+
+    name = scene["name"]
+    scene_root = os.path.join(output_root, name)
+
+    def scene_log(message):
+        log(f"[{name}] {message}")
+
+    def progress(done, total):
+        state.update(name, save=done == total, tiles_done=done, tiles_total=total)
+
+    state.update(name, status="running", output_root=scene_root)
+    try:
+        calibration = load_calibration(scene["sensor"], scene["lut"] or scene["paths"]["HH"])
+        if calibration is None:
+            raise ValueError(f"Failed to load LUT {scene['lut']}.")
+        journal = TileJournal(os.path.join(scene_root, JOURNAL_FILE), scene_signature(scene))
+        files = run_tiled(scene["paths"], scene["sensor"], calibration, scene["modes"], scene["products"],
+                          output_root=scene_root, log=scene_log, progress=progress, cancel=cancel,
+                          cache=cache, journal=journal, **scene["options"])
+    except ProcessingCancelled:
+        state.update(name, status="interrupted")
+        return False
+    except Exception as error:
+        state.update(name, status="failed", error=str(error))
+        scene_log("".join(traceback.format_exception_only(type(error), error)).strip())
+        return False
+
+    state.update(name, status="done", files=files, signature=scene_signature(scene))
+    os.remove(os.path.join(scene_root, JOURNAL_FILE))
+    scene_log("Done.")
+    return True
+
+
+def run_batch(manifest, memory_budget=DEFAULT_MEMORY_BUDGET, max_scenes=None, restart=False, cancel=None,
+              log=print):
+    # Runs the scenes that aren't done yet, as many at a time as fit in memory_budget
+    # (one scene always runs, whatever its estimate). Returns the names of failed scenes.
+    output_root = manifest["output_root"]
+    state = BatchState(output_root)
+    cache = None
+    if manifest["cache_dir"]:
+        from cache import ScatteringCache
+        cache = ScatteringCache(manifest["cache_dir"], manifest["cache_size"])
+
+    # A scene is done as long as its parameters in the manifest didn't change
+    scenes = [scene for scene in manifest["scenes"]
+              if restart or state.status(scene["name"]) != "done"
+              or state.scenes[scene["name"]].get("signature") != scene_signature(scene)]
+    skipped = len(manifest["scenes"]) - len(scenes)
+    if skipped:
+        log(f"{skipped} scene(s) already done, {len(scenes)} to process.")
+    if restart:
+        for scene in scenes:
+            journal = os.path.join(output_root, scene["name"], JOURNAL_FILE)
+            if os.path.exists(journal):
+                os.remove(journal)
+
+    condition = threading.Condition()
+    running = {}
+    failed = []
+    stop = threading.Event()
+
+    def stopped():
+        return stop.is_set() or (cancel is not None and cancel())
+
+    def worker(scene):
+        try:
+            if not run_scene(scene, output_root, state, cache, stopped, log):
+                failed.append(scene["name"])
+        finally:
+            with condition:
+                del running[scene["name"]]
+                condition.notify_all()
+
+    threads = []
+    try:
+        for scene in scenes:
+            try:
+                memory = scene_memory(scene)
+            except ValueError as error:
+                state.update(scene["name"], status="failed", error=str(error))
+                log(f"[{scene['name']}] {error}")
+                failed.append(scene["name"])
+                continue
+            with condition:
+                condition.wait_for(lambda: not running or (
+                    sum(running.values()) + memory <= memory_budget
+                    and (max_scenes is None or len(running) < max_scenes)))
+                if stopped():
+                    break
+                running[scene["name"]] = memory
+            log(f"Starting {scene['name']} (about {memory / 2**20:.0f} MB).")
+            thread = threading.Thread(target=worker, args=(scene,))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        # Running scenes stop at the next tile boundary and journal what they completed
+        stop.set()
+        for thread in threads:
+            thread.join()
+        raise
+    return failed
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m batch",
+        description="Process a campaign of scenes listed in a JSON manifest. Completed scenes and tiles "
+                    "are recorded, so an interrupted campaign resumes where it stopped."
+    )
+    parser.add_argument("manifest", help="JSON manifest of the scenes to process.")
+    parser.add_argument("--memory-budget", type=float, default=DEFAULT_MEMORY_BUDGET / 2**30,
+                        help="Approximate memory in GB that concurrently processed scenes may use (default: 4).")
+    parser.add_argument("--max-scenes", type=int,
+                        help="Maximum number of scenes processed at the same time.")
+    parser.add_argument("--restart", action="store_true",
+                        help="Process every scene again, ignoring the recorded progress.")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        manifest = load_manifest(args.manifest)
+    except (OSError, ValueError) as error:
+        print(f"Invalid manifest: {error}", file=sys.stderr)
+        return 2
+
+    try:
+        failed = run_batch(manifest, int(args.memory_budget * 2**30), args.max_scenes, args.restart)
+    except KeyboardInterrupt:
+        print("Interrupted; run the same command again to resume.", file=sys.stderr)
+        return 130
+
+    if failed:
+        print(f"{len(failed)} scene(s) failed: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    print("Batch completed successfully.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from metrics import format_megabytes, peak_rss, reset_peak_rss
+
+# Benchmarks the stages of the FP to CP chain on synthetic SLC rasters:
+#   python -m benchmark --size 4096 4096 --output bench.json
+#   python -m benchmark --size 4096 4096 --compare bench.json
+# Like cli.py, heavy imports (numpy, rasterio) are deferred to the functions that need them.
+
+MODES = ["RHV", "LHV", "pi4"]
+
+# Largest relative difference tolerated between the float32 kernels and the reference chain
+FLOAT32_TOLERANCE = 1e-5
+
+
+def make_scene(folder, sensor, rows, columns, seed=0):
+    # Synthetic SLC inputs and calibration: RADARSAT-2 int16 I/Q GeoTIFFs and a sigma LUT,
+    # or an ALOS-PALSAR like raster with a complex64 band per polarization
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    profile = {"driver": "GTiff", "width": columns, "height": rows, "crs": "EPSG:32610",
+               "transform": from_origin(500000, 4000000, 5, 5)}
+    if sensor == "RADARSAT2":
+        paths = {}
+        for pol in ["HH", "HV", "VH", "VV"]:
+            paths[pol] = os.path.join(folder, f"imagery_{pol}.tif")
+            with rasterio.open(paths[pol], "w", count=2, dtype="int16", **profile) as dataset:
+                dataset.write(rng.integers(-3000, 3000, size=(2, rows, columns), dtype=np.int16))
+        lut = os.path.join(folder, "lutSigma.xml")
+        gains = rng.uniform(500, 900, size=columns).astype(np.float32)
+        with open(lut, "w") as file:
+            file.write(f"<lut><offset>0.000000e+00</offset>"
+                       f"<gains>{' '.join('%.6e' % gain for gain in gains)}</gains></lut>")
+        return paths, lut
+
+    path = os.path.join(folder, "alos.tif")
+    with rasterio.open(path, "w", count=4, dtype="complex64", **profile) as dataset:
+        for band in range(1, 5):
+            data = rng.normal(size=(rows, columns)) + 1j * rng.normal(size=(rows, columns))
+            dataset.write((data * 1000).astype(np.complex64), band)
+    return {"HH": path}, None
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def measure(name, function, pixels, repeat=1, written=None):
+    # Runs function repeat times. Time is the best run; memory is the peak RSS and the
+    # peak of the allocations traced during the first run
+    times = []
+    result = None
+    for index in range(repeat):
+        result = None
+        if index == 0:
+            reset_peak_rss()
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+        if index == 0:
+            _, traced_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            rss = peak_rss()
+
+    stage = {
+        "stage": name,
+        "seconds": min(times),
+        "mean_seconds": sum(times) / len(times),
+        "megapixels_per_s": pixels / 1e6 / min(times),
+        "peak_rss_bytes": rss,
+        "peak_allocated_bytes": traced_peak,
+        "bytes_written": written() if written is not None else 0,
+    }
+    return stage, result
+
+
+def compare_arrays(name, expected, actual, exact):
+    # exact: bit-identical (in the dtype of actual, e.g. a written float32 band),
+    # otherwise within FLOAT32_TOLERANCE relative to the largest magnitude
+    import numpy as np
+
+    expected = np.asarray(expected)
+    actual = np.asarray(actual)
+    if exact:
+        expected = expected.astype(actual.dtype)
+        ok = np.array_equal(expected, actual)
+        error = 0.0 if ok else float(np.max(np.abs(expected - actual)))
+    else:
+        scale = max(float(np.max(np.abs(expected))), np.finfo(np.float32).tiny)
+        error = float(np.max(np.abs(expected - actual))) / scale
+        ok = error <= FLOAT32_TOLERANCE
+    return {"check": name, "ok": bool(ok), "exact": exact, "max_error": error}
+
+
+def run_benchmark(sensor="RADARSAT2", rows=2048, columns=2048, modes=MODES, tile_size=1024, workers=1,
+                  use_processes=False, precision="reference", repeat=1, data_dir=None, log=print, prefetch=2):
+    import rasterio
+    from rasterio.windows import Window
+    from functions import (FP_scattering_matrix, covariance_matrix_function, cp_synthesis_kernel,
+                           fp_scattering_kernel, radarsat2_reader, reference_meta, save_single_band_tif)
+    from metrics import RunMetrics
+    from pipeline import PRECISIONS, SIMULATORS, calibrate_tile, load_calibration, run_tiled, working_dtype
+
+    root = data_dir or tempfile.mkdtemp(prefix="compactsar_bench_")
+    pixels = rows * columns
+    stages = []
+    checks = []
+
+    def record(name, function, **kwargs):
+        stage, result = measure(name, function, pixels, repeat, **kwargs)
+        stages.append(stage)
+        log(f"{name:<24} {stage['seconds']:8.3f} s {stage['megapixels_per_s']:9.2f} MP/s "
+            f"{format_megabytes(stage['peak_rss_bytes'], 1):>12} peak RSS")
+        return result
+
+    try:
+        log(f"Creating a synthetic {sensor} scene of {rows} x {columns} pixels in {root}...")
+        paths, lut = make_scene(os.path.join(root, "input"), sensor, rows, columns)
+        calibration = load_calibration(sensor, lut if sensor == "RADARSAT2" else paths["HH"])
+        dtype = working_dtype(paths, sensor, calibration, precision)
+        window = Window(0, 0, columns, rows)
+
+        # Stages of the original chain, on whole scenes
+        if sensor == "RADARSAT2":
+            tile = record("read", lambda: radarsat2_reader(paths))
+        else:
+            def read_alos():
+                with rasterio.open(paths["HH"]) as dataset:
+                    return {pol: dataset.read(band) for band, pol in enumerate(["HH", "HV", "VH", "VV"], 1)}
+            tile = record("read", read_alos)
+
+        calibrated = record("calibration", lambda: calibrate_tile(tile, sensor, calibration, window))
+        # The lambdas bind what they use as default arguments, since the arrays are deleted once measured
+        S11, S12, S22 = record("fp_scattering_matrix", lambda calibrated=calibrated: FP_scattering_matrix(
+            *calibrated["HH"], *calibrated["HV"], *calibrated["VH"], *calibrated["VV"]))
+        del calibrated
+        simulated = {}
+        for mode in modes:
+            simulated[mode] = record(f"{mode}_simulator",
+                                     lambda mode=mode, fp_matrix=(S11, S12, S22): SIMULATORS[mode](*fp_matrix))
+        covariance = {}
+        for mode in modes:
+            covariance[mode] = record(f"{mode}_covariance",
+                                      lambda channels=simulated[mode]: covariance_matrix_function(*channels))
+
+        output = os.path.join(root, "save_single_band_tif")
+        os.makedirs(output, exist_ok=True)
+        meta = reference_meta(paths["HH"])
+        C11, C12, C22 = covariance[modes[0]]
+        bands = {"C11": C11, "C12_real": C12.real, "C12_imag": C12.imag, "C22": C22}
+        record("save_single_band_tif", lambda: [save_single_band_tif(os.path.join(output, f"{name}.tif"), data,
+                                                                     paths["HH"], meta=meta)
+                                                for name, data in bands.items()],
+               written=lambda: folder_size(output))
+
+        # Fused kernels of the tiled engine, on the same whole scenes
+        exact = precision == "reference"
+        if sensor == "RADARSAT2":
+            arguments = {"gains": calibration["gains"], "offset": calibration["offset"]}
+        else:
+            arguments = {"const": calibration["const"]}
+        buffers = {}
+        fused = record("fp_scattering_kernel", lambda buffers=buffers: fp_scattering_kernel(
+            tile["HH"], tile["HV"], tile["VH"], tile["VV"], buffers=buffers, dtype=PRECISIONS[precision], **arguments))
+        for name, expected, actual in zip(["S11", "S12", "S22"], [S11, S12, S22], fused):
+            checks.append(compare_arrays(f"fp_scattering_kernel {name}", expected, actual, exact))
+        for mode in modes:
+            results = record(f"{mode}_cp_synthesis_kernel", lambda mode=mode, fused=fused, buffers=buffers:
+                             cp_synthesis_kernel(*fused, mode, ["scattering", "covariance"], buffers, preserve=True))
+            S1, S2 = simulated[mode]
+            C11, C12, C22 = covariance[mode]
+            expected = {"S11_real": S1.real, "S11_imag": S1.imag, "S21_real": S2.real, "S21_imag": S2.imag,
+                        "C11": C11, "C12_real": C12.real, "C12_imag": C12.imag, "C22": C22}
+            for name, data in expected.items():
+                checks.append(compare_arrays(f"{mode} {name}", data, results[name], exact))
+        del fused, buffers, simulated, S11, S12, S22
+
+        # The whole tiled engine, from the input files to the written outputs
+        output = os.path.join(root, "run_tiled")
+        run_metrics = RunMetrics()
+        record("run_tiled", lambda: run_tiled(paths, sensor, calibration, modes, ["scattering", "covariance"],
+                                              output_root=output, tile_size=tile_size, workers=workers,
+                                              use_processes=use_processes, precision=precision,
+                                              prefetch=prefetch, log=lambda message: None,
+                                              metrics=run_metrics, report=None),
+               written=lambda: folder_size(output))
+        for mode in modes:
+            C11 = covariance[mode][0]
+            with rasterio.open(os.path.join(output, f"C2_{mode}", "C11.tif")) as dataset:
+                checks.append(compare_arrays(f"run_tiled {mode} C11", C11, dataset.read(1), exact))
+    finally:
+        if data_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        "environment": environment(),
+        "parameters": {"sensor": sensor, "rows": rows, "columns": columns, "modes": list(modes),
+                       "tile_size": tile_size, "workers": workers, "use_processes": use_processes,
+                       "prefetch": prefetch,
+                       "precision": precision, "repeat": repeat, "working_dtype": str(dtype)},
+        "stages": stages,
+        # Stages of the last run_tiled run, as in its run report
+        "run_tiled_stages": run_metrics.snapshot()["stages"],
+        "checks": checks,
+    }
+
+
+def environment():
+    import numpy as np
+    import rasterio
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare_results(baseline, results, log=print):
+    # Speed of every stage relative to a previous run; > 1 is faster
+    previous = {stage["stage"]: stage for stage in baseline["stages"]}
+    log(f"Compared to {baseline['environment'].get('commit') or 'the baseline'}:")
+    for stage in results["stages"]:
+        old = previous.get(stage["stage"])
+        if old is None:
+            continue
+        line = f"{stage['stage']:<24} {old['seconds'] / stage['seconds']:6.2f}x speed"
+        if stage["peak_rss_bytes"] is not None and old["peak_rss_bytes"] is not None:
+            line += f" {stage['peak_rss_bytes'] / max(old['peak_rss_bytes'], 1):6.2f}x peak RSS"
+        log(line)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmark",
+        description="Time the stages of the FP to CP chain on a synthetic SLC scene and check the "
+                    "fused kernels and the tiled engine against the original functions."
+    )
+    parser.add_argument("--sensor", default="RADARSAT2", choices=["RADARSAT2", "ALOS"],
+                        help="Kind of synthetic input (default: RADARSAT2).")
+    parser.add_argument("--size", type=int, nargs=2, default=[2048, 2048], metavar=("ROWS", "COLUMNS"),
+                        help="Size of the synthetic scene (default: 2048 2048).")
+    parser.add_argument("--mode", nargs="+", default=MODES, choices=MODES,
+                        help="Simulators to benchmark (default: all).")
+    parser.add_argument("--tile-size", type=int, default=1024,
+                        help="Tile size of the run_tiled stage (default: 1024).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Workers of the run_tiled stage (default: 1).")
+    parser.add_argument("--processes", action="store_true",
+                        help="Use a process pool in the run_tiled stage.")
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="Tiles queued between the stages of the run_tiled pipeline, 0 for none (default: 2).")
+    parser.add_argument("--precision", default="reference", choices=["reference", "float32"],
+                        help="Precision of the fused kernels and run_tiled (default: reference).")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Runs per stage; the fastest is reported (default: 1).")
+    parser.add_argument("--data-dir",
+                        help="Keep the synthetic scene and the outputs in this folder instead of a temporary one.")
+    parser.add_argument("--output", metavar="JSON",
+                        help="Write the results to this file.")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="Results of an earlier run (e.g. another commit) to compare with.")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    results = run_benchmark(args.sensor, *args.size, modes=args.mode, tile_size=args.tile_size,
+                            workers=args.workers, use_processes=args.processes, precision=args.precision,
+                            repeat=max(args.repeat, 1), data_dir=args.data_dir, prefetch=args.prefetch)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare_results(json.load(file), results)
+
+    failed = [check for check in results["checks"] if not check["ok"]]
+    for check in failed:
+        print(f"Check failed: {check['check']} (max error {check['max_error']:.3g})", file=sys.stderr)
+    if failed:
+        return 1
+    print(f"All {len(results['checks'])} correctness checks passed.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+
+CACHE_BANDS = ["S11", "S12", "S22"]
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "CompactSAR")
+DEFAULT_CACHE_SIZE = 20 * 2**30
+
+# Digests are only recomputed when the size or modification time of an input changes
+DIGESTS_FILE = "digests.json"
+HASH_CHUNK_SIZE = 4 * 2**20
+
+# Staging folders left this long without a write are from runs that crashed or were killed
+STALE_STAGING_AGE = 24 * 3600
+
+# Serializes the updates of the digests index between the threads of a process (e.g. batch scenes)
+_digests_lock = threading.Lock()
+
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def last_write(path):
+    # Latest modification time of a folder and of the files in it
+    return max([os.stat(path).st_mtime] + [entry.stat().st_mtime for entry in os.scandir(path) if entry.is_file()])
+
+
+class CachedBand:
+    # Same read(window) interface as readers.RasterReader, on a cached band
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.memory_mapped = True
+
+    def read(self, window):
+        rows, columns = window.toslices()
+        return self.array[rows, columns]
+
+    def close(self):
+        self.array = None
+
+
+class ScatteringCache:
+    # On-disk cache of the calibrated FP scattering matrix (S11, S12, S22) of whole scenes.
+    # Every entry is a folder of memory-mappable .npy files named by a hash of the input
+    # contents and the calibration; the least recently used entries are evicted once the
+    # cache grows beyond max_bytes
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def read_digests(self):
+        try:
+            with open(os.path.join(self.root, DIGESTS_FILE)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def input_digest(self, path):
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        known = self.read_digests().get(path)
+        if known is not None and known["stamp"] == stamp:
+            return known["digest"]
+
+        digest = file_digest(path)
+        with _digests_lock:
+            # Read again, so that the entries other threads added meanwhile are kept
+            index = self.read_digests()
+            index[path] = {"stamp": stamp, "digest": digest}
+            index_path = os.path.join(self.root, DIGESTS_FILE)
+            staging_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}"
+            with open(staging_path, "w") as file:
+                json.dump(index, file)
+            os.replace(staging_path, index_path)
+        return digest
+
+    def key(self, input_paths, sensor, calibration, dtype):
+        # Content of the inputs, calibration constants (LUT gains/offset or ALOS factor) and working dtype
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{sensor}:{np.dtype(dtype).str}".encode())
+        for path in input_paths:
+            digest.update(self.input_digest(path).encode())
+        for name in sorted(calibration):
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(calibration[name], dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def lookup(self, key, shape):
+        # Memory-mapped bands of a complete entry, or None
+        path = self.entry_path(key)
+        try:
+            bands = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in CACHE_BANDS}
+        except (OSError, ValueError):
+            return None
+        if any(array.shape != tuple(shape) for array in bands.values()):
+            return None
+        # The folder time stamp records the last use for eviction
+        os.utime(path)
+        return {name: CachedBand(array) for name, array in bands.items()}
+
+    def entries(self):
+        # (path, size, last used) of every complete entry, least recently used first
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and not entry.name.endswith(".partial"):
+                entries.append((entry.path, directory_size(entry.path), entry.stat().st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def staging_folders(self):
+        # (path, size, last written) of the staging folders of entries being written
+        folders = []
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and entry.name.endswith(".partial"):
+                try:
+                    folders.append((entry.path, directory_size(entry.path), last_write(entry.path)))
+                except OSError:
+                    # Finalized or discarded meanwhile
+                    continue
+        return folders
+
+    def evict(self, reserve=0):
+        # Removes least recently used entries until reserve more bytes fit in max_bytes.
+        # Stale staging folders are removed; the others count against max_bytes
+        total = 0
+        for path, size, written in self.staging_folders():
+            if time.time() - written > STALE_STAGING_AGE:
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                total += size
+        entries = self.entries()
+        total += sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total + reserve <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def create(self, key, shape, dtype):
+        # Writer for a new entry, or None when a single scene doesn't fit in the cache
+        size = len(CACHE_BANDS) * int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if size > self.max_bytes:
+            return None
+        self.evict(reserve=size)
+        return CacheEntry(self.entry_path(key), shape, dtype)
+
+
+class CacheEntry:
+    # Written tile by tile like the output writers; only becomes visible to lookup
+    # once the run finished
+    parallel = False
+
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.staging_path = None
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.arrays = {}
+
+    def open(self):
+        # A staging folder of its own, since several runs (e.g. the scene threads of a batch)
+        # can compute the same entry at once
+        root, key = os.path.split(self.path)
+        self.staging_path = tempfile.mkdtemp(dir=root, prefix=f"{key}.", suffix=".partial")
+        for name in CACHE_BANDS:
+            self.arrays[name] = np.lib.format.open_memmap(os.path.join(self.staging_path, name + ".npy"),
+                                                          mode="w+", dtype=self.dtype, shape=self.shape)
+        return self
+
+    def write(self, results, window):
+        rows, columns = window.toslices()
+        for name, data in results.items():
+            self.arrays[name][rows, columns] = data
+
+    def checkpoint(self):
+        for array in self.arrays.values():
+            array.flush()
+
+    def close(self):
+        self.checkpoint()
+        self.arrays = {}
+
+    def finalize(self):
+        if self.staging_path is None or not os.path.isdir(self.staging_path) or os.path.isdir(self.path):
+            # Another run stored the same entry first
+            self.discard()
+            return
+        with open(os.path.join(self.staging_path, "entry.json"), "w") as file:
+            json.dump({"shape": self.shape, "dtype": self.dtype.str, "created": time.time()}, file)
+        try:
+            os.rename(self.staging_path, self.path)
+        except OSError:
+            # Another run stored the same entry first
+            self.discard()
+
+    def discard(self):
+        self.close()
+        if self.staging_path is not None:
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is None:
+            self.finalize()
+        else:
+            self.discard()
@@ -0,0 +1,231 @@
+import os
+import threading
+import numpy as np
+from affine import Affine
+from functions import db_to_linear_scale
+
+# ALOS-1 and ALOS-2 PALSAR Level 1.1 (Single Look Complex) products in CEOS format:
+# VOL-<scene>, LED-<scene> (leader) and one IMG-<pol>-<scene> per polarization,
+# e.g. IMG-HH-ALPSRP123456780-P1.1__A or IMG-HH-ALOS2012345678-140101-HBQR1.1__A
+
+POLARIZATIONS = ["HH", "HV", "VH", "VV"]
+FILE_PREFIXES = ["VOL-", "LED-", "TRL-"] + [f"IMG-{pol}-" for pol in POLARIZATIONS]
+
+# Every record starts with a 12 byte header: sequence number, 4 type codes and the record length
+RECORD_HEADER = np.dtype([("sequence", ">u4"), ("codes", "u1", 4), ("length", ">u4")])
+RADIOMETRIC_RECORD = 50
+
+# sigma0 = 10 * log10(I^2 + Q^2) + CF - 32 dB for Level 1.1
+DEFAULT_CALIBRATION_FACTOR = -83.0
+CALIBRATION_OFFSET = 32.0
+
+# CEOS complex*8: big-endian float32 I/Q pairs
+SAMPLE_DTYPE = np.dtype(">c8")
+
+
+def scene_id(path):
+    name = os.path.basename(path)
+    for prefix in FILE_PREFIXES:
+        if name.upper().startswith(prefix):
+            return name[len(prefix):]
+    return None
+
+
+def product_files(path):
+    # {"leader", "paths": {pol: IMG file}} of the product any of its files belongs to,
+    # or None when path isn't part of a complete quad-pol CEOS product
+    scene = scene_id(path)
+    if scene is None:
+        return None
+    folder = os.path.dirname(os.path.abspath(path))
+    paths = {pol: os.path.join(folder, f"IMG-{pol}-{scene}") for pol in POLARIZATIONS}
+    if not all(os.path.isfile(image) for image in paths.values()):
+        return None
+    leader = os.path.join(folder, f"LED-{scene}")
+    return {"leader": leader if os.path.isfile(leader) else None, "paths": paths}
+
+
+def ascii_field(record, start, length):
+    # Fields are given by their 1-based byte positions, as in the format description
+    return record[start - 1:start - 1 + length].decode("ascii", "replace").strip()
+
+
+def int_field(record, start, length):
+    value = ascii_field(record, start, length)
+    return int(value) if value else 0
+
+
+def read_records(path):
+    # (type code, record bytes) of every record of a leader file
+    with open(path, "rb") as file:
+        data = file.read()
+    offset = 0
+    while offset + RECORD_HEADER.itemsize <= len(data):
+        header = np.frombuffer(data, RECORD_HEADER, count=1, offset=offset)[0]
+        length = int(header["length"])
+        if length < RECORD_HEADER.itemsize:
+            break
+        yield int(header["codes"][1]), data[offset:offset + length]
+        offset += length
+
+
+def read_calibration_factor(leader_path):
+    # Calibration factor CF in dB from the radiometric data record of the leader file, or None
+    for code, record in read_records(leader_path):
+        if code == RADIOMETRIC_RECORD:
+            try:
+                value = float(ascii_field(record, 21, 16))
+            except ValueError:
+                return None
+            return value if np.isfinite(value) else None
+    return None
+
+
+def calibration_constant(calibration_factor):
+    # Linear factor applied to the I/Q samples (ALOS_calibration). Some products state
+    # the factor with the 32 dB Level 1.1 offset already included (about -115 dB)
+    if calibration_factor <= -100:
+        return db_to_linear_scale(calibration_factor)
+    return db_to_linear_scale(calibration_factor - CALIBRATION_OFFSET)
+
+
+def image_layout(path):
+    # Record layout of an image file from its file descriptor record
+    with open(path, "rb") as file:
+        header = file.read(RECORD_HEADER.itemsize)
+        if len(header) < RECORD_HEADER.itemsize:
+            raise ValueError(f"{path} is not a CEOS image file.")
+        descriptor_length = int(np.frombuffer(header, RECORD_HEADER)[0]["length"])
+        descriptor = header + file.read(descriptor_length - RECORD_HEADER.itemsize)
+
+    sample_format = ascii_field(descriptor, 429, 4)
+    if sample_format != "C*8":
+        raise ValueError(f"{path} holds {sample_format or 'unknown'} samples; "
+                         "Level 1.1 (complex C*8) data is required.")
+    rows = int_field(descriptor, 237, 8) or int_field(descriptor, 181, 6)
+    columns = int_field(descriptor, 249, 8)
+    record_length = int_field(descriptor, 187, 6)
+    suffix = int_field(descriptor, 289, 4)
+    prefix = record_length - suffix - columns * SAMPLE_DTYPE.itemsize
+    if rows <= 0 or columns <= 0 or prefix < RECORD_HEADER.itemsize:
+        raise ValueError(f"Unexpected record layout in {path}.")
+    if os.path.getsize(path) < descriptor_length + rows * record_length:
+        raise ValueError(f"{path} is truncated.")
+    return {
+        "shape": (rows, columns),
+        "offset": descriptor_length,
+        "record_length": record_length,
+        "prefix": prefix,
+    }
+
+
+class CeosImageReader:
+    # Same read(window) interface as readers.RasterReader, on the IMG file of one polarization.
+    # Only the records (rows) of a window are read; the big-endian samples are decoded
+    # into a native complex64 tile, the values GDAL's CEOS driver returns
+
+    def __init__(self, path, memmap=True):
+        self.path = path
+        layout = image_layout(path)
+        self.shape = layout["shape"]
+        self.dtype = np.dtype(np.complex64)
+        self.offset = layout["offset"]
+        self.record_length = layout["record_length"]
+        self.prefix = layout["prefix"]
+        self.array = None
+        self.file = None
+        if memmap:
+            # Strided view of the samples, skipping the prefix data of every record
+            records = np.memmap(path, dtype=np.uint8, mode="r", offset=self.offset,
+                                shape=(self.shape[0], self.record_length))
+            self.array = np.ndarray(self.shape, SAMPLE_DTYPE, buffer=records, offset=self.prefix,
+                                    strides=(self.record_length, SAMPLE_DTYPE.itemsize))
+        else:
+            self.file = open(path, "rb")
+            self.lock = threading.Lock()
+
+    @property
+    def memory_mapped(self):
+        return self.array is not None
+
+    def read(self, window):
+        rows, columns = window.toslices()
+        if self.array is not None:
+            return self.array[rows, columns].astype(self.dtype)
+
+        # One read of the consecutive records of the window
+        first, last = rows.start, min(rows.stop, self.shape[0])
+        data = self.read_bytes(self.offset + first * self.record_length, (last - first) * self.record_length)
+        records = np.frombuffer(data, np.uint8).reshape(last - first, self.record_length)
+        start = self.prefix + columns.start * SAMPLE_DTYPE.itemsize
+        stop = self.prefix + min(columns.stop, self.shape[1]) * SAMPLE_DTYPE.itemsize
+        return records[:, start:stop].view(SAMPLE_DTYPE).astype(self.dtype)
+
+    def read_bytes(self, offset, size):
+        # Seek and read as one step, since the threads of a run may share the reader
+        # (os.pread isn't available on Windows)
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    def read_decimated(self, step):
+        # Every step-th row and column, reading only the records of those rows
+        if self.array is not None:
+            return self.array[::step, ::step].astype(self.dtype)
+        rows = range(0, self.shape[0], step)
+        decimated = np.empty((len(rows), -(-self.shape[1] // step)), self.dtype)
+        for index, row in enumerate(rows):
+            data = self.read_bytes(self.offset + row * self.record_length + self.prefix,
+                                   self.shape[1] * SAMPLE_DTYPE.itemsize)
+            decimated[index] = np.frombuffer(data, SAMPLE_DTYPE)[::step]
+        return decimated
+
+    def close(self):
+        self.array = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_product(path):
+    # Image files, shape and calibration factor of the product path (VOL, LED or IMG file) belongs to
+    files = product_files(path)
+    if files is None:
+        raise ValueError(f"No IMG-HH/HV/VH/VV files found next to {path}; a quad-pol CEOS product is required.")
+    shapes = {pol: image_layout(image)["shape"] for pol, image in files["paths"].items()}
+    if len(set(shapes.values())) != 1:
+        raise ValueError(f"The image files have different sizes: {shapes}")
+
+    calibration_factor = None
+    if files["leader"] is not None:
+        calibration_factor = read_calibration_factor(files["leader"])
+    scene = scene_id(path)
+    return {
+        "paths": files["paths"],
+        "leader": files["leader"],
+        "shape": shapes["HH"],
+        "satellite": "ALOS-2" if scene.upper().startswith("ALOS2") else "ALOS",
+        "calibration_factor": calibration_factor,
+    }
+
+
+def ceos_meta(path):
+    # Output profile for an image file, like functions.reference_meta gives for a raster
+    # GDAL opens. Level 1.1 is in slant range geometry, without a geotransform
+    rows, columns = image_layout(path)["shape"]
+    return {
+        "driver": "GTiff",
+        "dtype": "complex64",
+        "nodata": None,
+        "width": columns,
+        "height": rows,
+        "count": 1,
+        "crs": None,
+        "transform": Affine.identity(),
+    }
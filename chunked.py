@@ -0,0 +1,371 @@
+import os
+import threading
+import time
+from contextlib import ExitStack
+import numpy as np
+from rasterio.windows import Window
+from functions import (cp_synthesis_kernel, derived_cp_products, fp_scattering_kernel, multilook_covariance,
+                       refined_lee_filter)
+from metrics import REPORT_FILE, RunMetrics, StageTimer
+from pipeline import (CHIRALITY, DEFAULT_INT16_SCALE, DEFAULT_TILE_SIZE, DERIVED_PRODUCTS, POLARIZATIONS,
+                      PRECISIONS, ProcessingCancelled, encode_output, filter_halo, input_bands, kernel_mode, make_job,
+                      open_reader, output_meta, working_dtype)
+from writers import (COVARIANCE_BANDS, FULL_RESOLUTION_BANDS, OUTPUT_FORMATS, PRODUCTS, SCATTERING_BANDS,
+                     GeoTiffWriter, ZarrWriter)
+
+# Chunked backend: the chain is built as a dask task graph over lazily read chunks of the
+# inputs (calibration and FP matrix -> simulator -> C2 -> multilook and filter -> derived
+# products -> encoding), so that it runs on dask's threaded or multi-process scheduler or on
+# a dask.distributed cluster. dask, and distributed for clusters, are optional dependencies
+# only imported here. The results are bit for bit those of pipeline.run_tiled
+
+# Local dask schedulers; "local" starts a distributed LocalCluster, anything else is the
+# address of a distributed scheduler
+LOCAL_SCHEDULERS = ["threads", "processes", "synchronous"]
+
+
+def import_dask():
+    try:
+        import dask
+        import dask.array
+    except ImportError:
+        raise ImportError("The chunked backend needs dask: pip install 'dask[array]' "
+                          "(and 'distributed' for clusters).") from None
+    return dask
+
+
+class LazyBand:
+    # Array-like input polarization for dask.array.from_array. Only the path is pickled, so
+    # every worker process (or node) opens the file itself, and every thread gets its own
+    # reader since a GDAL handle can't be shared between threads
+
+    def __init__(self, path, band, sensor, memmap=True):
+        self.path = path
+        self.band = band
+        self.sensor = sensor
+        self.memmap = memmap
+        self.local = threading.local()
+        with open_reader(path, band, sensor, memmap=False) as reader:
+            self.dtype = reader.dtype
+            # RADARSAT-2 GeoTIFFs are read as (I/Q, rows, columns)
+            self.count = reader.dataset.count if sensor == "RADARSAT2" else None
+            self.shape = reader.shape if self.count is None else (self.count,) + reader.shape
+        self.ndim = len(self.shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def __getitem__(self, key):
+        reader = getattr(self.local, "reader", None)
+        if reader is None:
+            reader = self.local.reader = open_reader(self.path, self.band, self.sensor, memmap=self.memmap)
+        rows, columns = (slice(*axis.indices(size)[:2]) for axis, size in zip(key[-2:], self.shape[-2:]))
+        data = reader.read(Window.from_slices(rows, columns))
+        return data if self.count is None else data[key[0]]
+
+
+def lazy_inputs(paths, sensor, chunks=(DEFAULT_TILE_SIZE, DEFAULT_TILE_SIZE), memmap=True):
+    # One dask array per polarization in chunks of (rows, columns); nothing is read yet
+    dask = import_dask()
+    inputs = {}
+    for pol, (path, band) in input_bands(paths, sensor).items():
+        source = LazyBand(path, band, sensor, memmap)
+        inputs[pol] = dask.array.from_array(source, chunks=source.shape[:-2] + tuple(chunks),
+                                            name=f"read-{pol}-{dask.base.tokenize(path, band, memmap)}",
+                                            meta=np.empty((0,) * source.ndim, source.dtype))
+    return inputs
+
+
+def _fp_block(IQ_HH, IQ_HV, IQ_VH, IQ_VV, calibration=None, kernel_dtype=None, block_info=None):
+    # Calibrated FP matrix of a chunk, stacked as (S11, S12, S22)
+    if "gains" in calibration:
+        first, last = block_info[0]["array-location"][-1]
+        S11, S12, S22 = fp_scattering_kernel(IQ_HH, IQ_HV, IQ_VH, IQ_VV, gains=calibration["gains"][first:last],
+                                             offset=calibration["offset"], dtype=kernel_dtype)
+    else:
+        S11, S12, S22 = fp_scattering_kernel(IQ_HH, IQ_HV, IQ_VH, IQ_VV, const=calibration["const"],
+                                             dtype=kernel_dtype)
+    return np.stack([S11, S12, S22])
+
+
+def _scattering_block(fp, mode=None):
+    # Scattering vector of a chunk, stacked as SCATTERING_BANDS
+    results = cp_synthesis_kernel(fp[0], fp[1], fp[2], kernel_mode(mode), ["scattering"], preserve=True)
+    return np.stack([results[name] for name in SCATTERING_BANDS])
+
+
+def _covariance_block(fp, mode=None, looks=(1, 1)):
+    # Multilooked C2 of a chunk, stacked as COVARIANCE_BANDS
+    results = cp_synthesis_kernel(fp[0], fp[1], fp[2], kernel_mode(mode), ["covariance"], preserve=True)
+    C11, C22 = results["C11"], results["C22"]
+    C12_real, C12_imag = results["C12_real"], results["C12_imag"]
+    if looks != (1, 1):
+        C11, C12, C22 = multilook_covariance(C11, C12_real + 1j * C12_imag, C22, looks)
+        C12_real, C12_imag = C12.real, C12.imag
+    return np.stack([C11, C12_real, C12_imag, C22])
+
+
+def _filter_block(C2, offset=(0, 0), shape=None, speckle_filter=None, filter_size=7, looks=(1, 1)):
+    # Speckle filter of a C2 chunk read with the halo around it, cropped to the chunk
+    C11, C12, C22 = C2[0], C2[1] + 1j * C2[2], C2[3]
+    if speckle_filter == "boxcar":
+        C11, C12, C22 = multilook_covariance(C11, C12, C22, (1, 1), "boxcar", filter_size)
+    else:
+        C11, C12, C22 = refined_lee_filter(C11, C12, C22, filter_size, looks[0] * looks[1])
+    (row, col), (rows, columns) = offset, shape
+    return np.stack([C11, C12.real, C12.imag, C22])[:, row:row + rows, col:col + columns]
+
+
+def filtered(C2, halo, speckle_filter, filter_size, looks):
+    # Speckle filter of every chunk with `halo` pixels of its neighbours, clipped at the scene
+    # edges like the tile reads of run_tiled, on the same chunks. (map_overlap would merge
+    # chunks smaller than the halo, and the filters' running sums depend on the extent)
+    da = import_dask().array
+    _, total_rows, total_cols = C2.shape
+    rows = []
+    for row_off, height in zip(np.cumsum((0,) + C2.chunks[1]), C2.chunks[1]):
+        row = []
+        for col_off, width in zip(np.cumsum((0,) + C2.chunks[2]), C2.chunks[2]):
+            first_row, first_col = max(0, row_off - halo), max(0, col_off - halo)
+            window = C2[:, first_row:min(total_rows, row_off + height + halo),
+                        first_col:min(total_cols, col_off + width + halo)].rechunk(-1)
+            row.append(window.map_blocks(_filter_block, offset=(row_off - first_row, col_off - first_col),
+                                         shape=(height, width), speckle_filter=speckle_filter,
+                                         filter_size=filter_size, looks=looks, dtype=C2.dtype,
+                                         chunks=((4,), (height,), (width,))))
+        rows.append(row)
+    return da.block(rows)
+
+
+def _derived_block(C2, products=(), chirality=1):
+    bands = derived_cp_products(C2[0], C2[1] + 1j * C2[2], C2[3], list(products), chirality)
+    return np.stack(list(bands.values()))
+
+
+def chunk_shape(chunk_size=DEFAULT_TILE_SIZE, looks=(1, 1)):
+    # Chunks are whole numbers of looks, like the tiles of run_tiled
+    looks_rows, looks_cols = looks
+    return max(1, chunk_size // looks_rows) * looks_rows, max(1, chunk_size // looks_cols) * looks_cols
+
+
+def derived_bands(products):
+    # Band names of the derived products, in the order derived_cp_products returns them
+    return [name for product in DERIVED_PRODUCTS if product in products for name in PRODUCTS[product][1]]
+
+
+def cp_graph(paths, sensor, calibration, mode, products, chunk_size=DEFAULT_TILE_SIZE, precision="reference",
+             output_dtype=None, int16_scale=DEFAULT_INT16_SCALE, looks=(1, 1), speckle_filter=None,
+             filter_size=7, memmap=True):
+    # {mode: {band name: 2D dask array}} of the products, the scattering vector at full
+    # resolution and C2 and the derived products on the multilooked grid. Chunk (i, j) of
+    # every band covers the same part of the scene. With output_dtype the bands are encoded
+    # as run_tiled writes them, otherwise they stay in the working precision
+    da = import_dask().array
+    job = make_job(sensor, calibration, mode, products, precision, output_dtype or "float32", int16_scale,
+                   looks, speckle_filter, filter_size)
+    looks_rows, looks_cols = job["looks"]
+    complex_dtype = working_dtype(paths, sensor, calibration, precision)
+    real_dtype = np.empty(0, complex_dtype).real.dtype
+
+    inputs = lazy_inputs(paths, sensor, chunk_shape(chunk_size, job["looks"]), memmap)
+    raw = [inputs[pol] for pol in POLARIZATIONS]
+    rows, columns = raw[0].chunks[-2:]
+    looked = (tuple(-(-size // looks_rows) for size in rows), tuple(-(-size // looks_cols) for size in columns))
+    fp = da.map_blocks(_fp_block, *raw, calibration=calibration, kernel_dtype=PRECISIONS[precision],
+                       dtype=complex_dtype, chunks=((3,), rows, columns),
+                       **({"new_axis": 0} if raw[0].ndim == 2 else {}))
+
+    derived = [product for product in job["products"] if product in DERIVED_PRODUCTS]
+    graph = {}
+    for name in job["modes"]:
+        stacks = []
+        if "scattering" in job["products"]:
+            scattering = fp.map_blocks(_scattering_block, mode=name, dtype=real_dtype, chunks=((4,), rows, columns))
+            stacks.append((SCATTERING_BANDS, scattering))
+        if "covariance" in job["products"] or derived:
+            C2 = fp.map_blocks(_covariance_block, mode=name, looks=job["looks"], dtype=real_dtype,
+                               chunks=((4,),) + looked)
+            halo = filter_halo(job)
+            if halo:
+                C2 = filtered(C2, halo, speckle_filter, filter_size, job["looks"])
+            if "covariance" in job["products"]:
+                stacks.append((COVARIANCE_BANDS, C2))
+            if derived:
+                names = derived_bands(derived)
+                stacks.append((names, C2.map_blocks(_derived_block, products=derived,
+                                                    chirality=CHIRALITY.get(name, 1), dtype=real_dtype,
+                                                    chunks=((len(names),),) + looked)))
+        bands = {}
+        for names, stack in stacks:
+            if output_dtype is not None:
+                stack = stack.map_blocks(encode_output, output_dtype, int16_scale,
+                                         dtype=np.int16 if output_dtype == "int16" else np.float32)
+            bands.update({band: stack[index] for index, band in enumerate(names)})
+        graph[name] = bands
+    return graph
+
+
+def block_windows(chunks):
+    # Window of every chunk of a 2D dask array, by block index
+    row_offsets = np.cumsum((0,) + chunks[0])
+    col_offsets = np.cumsum((0,) + chunks[1])
+    return {(i, j): Window(int(col_offsets[j]), int(row_offsets[i]), height=int(height), width=int(width))
+            for i, height in enumerate(chunks[0]) for j, width in enumerate(chunks[1])}
+
+
+def write_block(writers, outputs, windows, timer, pixels=0):
+    # Writes the {mode: {band: array}} of one chunk, whose windows are given at full
+    # resolution (True) and on the multilooked grid (False)
+    for name, data in outputs.items():
+        start = time.perf_counter()
+        for full, window in windows.items():
+            writers[name].write({band: values for band, values in data.items()
+                                 if (band in FULL_RESOLUTION_BANDS) == full}, window)
+        timer.add("write", time.perf_counter() - start, sum(values.nbytes for values in data.values()), pixels)
+
+
+def _store_block(outputs, writers=None, windows=None, pixels=0):
+    # write_block in the worker that computed the chunk, for writers that take tiles from any
+    # process (ZarrWriter); only the stage times come back
+    timer = StageTimer()
+    write_block(writers, outputs, windows, timer, pixels)
+    return timer.stages
+
+
+def dask_scheduler(scheduler="threads", workers=None):
+    # (scheduler argument of dask.compute, a client to close or None). scheduler is a local
+    # scheduler name, "local" for a LocalCluster of `workers` processes, the address of a
+    # distributed scheduler (e.g. tcp://10.0.0.1:8786) or a distributed.Client
+    if scheduler is None or scheduler in LOCAL_SCHEDULERS:
+        return scheduler or "threads", None
+    if not isinstance(scheduler, str):
+        return scheduler, None
+    try:
+        from distributed import Client
+    except ImportError:
+        raise ImportError("Dask clusters need distributed: pip install distributed") from None
+    if scheduler == "local":
+        client = Client(n_workers=workers or os.cpu_count(), threads_per_worker=1)
+    else:
+        client = Client(scheduler)
+    return client, client
+
+
+def run_chunked(paths, sensor, calibration, mode, products, output_root=".", chunk_size=DEFAULT_TILE_SIZE,
+                scheduler="threads", workers=None, precision="reference", output_dtype="float32",
+                int16_scale=DEFAULT_INT16_SCALE, layout="single", compress=None, tiled=False, overviews=False,
+                cog=False, looks=(1, 1), speckle_filter=None, filter_size=7, memmap=True, log=print,
+                progress=None, cancel=None, metrics=None, report=REPORT_FILE, output_format="geotiff"):
+    # run_tiled on dask: the graph of cp_graph is computed a few chunks per worker at a
+    # time, and the finished chunks come back to this process, which writes them with the
+    # same writers (GeoTIFF handles can't be shared between workers). A Zarr store is instead
+    # written by the workers themselves, chunk by chunk. progress, cancel, metrics and report
+    # work as in run_tiled; the stages are "compute" (the whole graph of a batch of chunks)
+    # and "write"
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    dask = import_dask()
+    from dask.array.core import normalize_chunks
+
+    if metrics is None:
+        metrics = RunMetrics()
+    graph = cp_graph(paths, sensor, calibration, mode, products, chunk_size, precision, output_dtype,
+                     int16_scale, looks, speckle_filter, filter_size, memmap)
+    meta = output_meta(paths, sensor)
+    # Windows of every chunk in the scene, and in the outputs at full resolution (True) and multilooked (False)
+    scene = block_windows(normalize_chunks(chunk_shape(chunk_size, looks), (meta["height"], meta["width"])))
+    grids = {name in FULL_RESOLUTION_BANDS: block_windows(data.chunks)
+             for name, data in next(iter(graph.values())).items()}
+    blocks = list(scene)
+    if output_format == "zarr":
+        writers = {name: ZarrWriter(output_root, name, products, meta, chunk_size, output_dtype, compress,
+                                    looks=tuple(looks))
+                   for name in graph}
+    else:
+        writers = {
+            name: GeoTiffWriter(output_root, name, products, paths["HH"], output_dtype, int16_scale,
+                                layout=layout, compress=compress, tiled=tiled, overviews=overviews, cog=cog,
+                                looks=tuple(looks), meta=meta)
+            for name in graph
+        }
+    parallel = all(writer.parallel for writer in writers.values())
+
+    get, client = dask_scheduler(scheduler, workers)
+    if client is not None:
+        log(f"Dask dashboard: {client.dashboard_link}")
+        threads = sum(client.nthreads().values())
+    else:
+        threads = workers or os.cpu_count() or 1
+    compute_options = {} if client is not None or get == "synchronous" else {"num_workers": threads}
+    batch = 2 * threads
+
+    status = "failed"
+    try:
+        with ExitStack() as stack:
+            for writer in writers.values():
+                stack.enter_context(writer)
+            log(f"Processing {meta['height']} x {meta['width']} pixels in {len(blocks)} chunks of "
+                f"{chunk_size} x {chunk_size} for {', '.join(graph)} with dask...")
+            metrics.start(len(blocks))
+            done = 0
+            for first in range(0, len(blocks), batch):
+                if cancel is not None and cancel():
+                    raise ProcessingCancelled()
+                indices = blocks[first:first + batch]
+                tasks = [{name: {band: data.blocks[index] for band, data in bands.items()}
+                          for name, bands in graph.items()} for index in indices]
+                windows = [{full: grid[index] for full, grid in grids.items()} for index in indices]
+                pixels = [scene[index].width * scene[index].height for index in indices]
+                if parallel:
+                    tasks = [dask.delayed(_store_block)(task, writers, block, count)
+                             for task, block, count in zip(tasks, windows, pixels)]
+                start = time.perf_counter()
+                results = dask.compute(tasks, scheduler=get, **compute_options)[0]
+                metrics.add("compute", time.perf_counter() - start, pixels=sum(pixels))
+                for result, block, count in zip(results, windows, pixels):
+                    if parallel:
+                        metrics.merge(result)
+                    else:
+                        write_block(writers, result, block, metrics, count)
+                    done += 1
+                    metrics.tile_done()
+                    if progress is not None:
+                        progress(done, len(blocks))
+            start = time.perf_counter()
+    except BaseException as error:
+        if isinstance(error, ProcessingCancelled):
+            status = "cancelled"
+            for writer in writers.values():
+                writer.discard()
+            log("Processing cancelled; partial outputs removed.")
+        raise
+    else:
+        status = "completed"
+        metrics.add("finalize", time.perf_counter() - start)
+    finally:
+        if client is not None:
+            client.close()
+        metrics.finish()
+        files = [path for writer in writers.values() for path in writer.files]
+        if report:
+            options = {"chunk_size": chunk_size, "scheduler": str(scheduler), "workers": workers,
+                       "precision": precision, "output_dtype": output_dtype, "layout": layout,
+                       "compress": compress, "looks": list(looks), "speckle_filter": speckle_filter,
+                       "filter_size": filter_size, "memmap": memmap, "output_format": output_format}
+            try:
+                metrics.write_report(os.path.join(output_root, report), status=status, sensor=sensor,
+                                     inputs=paths, shape=[meta["height"], meta["width"]], modes=list(graph),
+                                     products=list(products), options=options,
+                                     outputs=files if status == "completed" else [])
+            except OSError as e:
+                log(f"Could not write the run report: {e}")
+        if status == "completed":
+            log(metrics.summary())
+
+    return files
@@ -0,0 +1,225 @@
+import argparse
+import os
+import sys
+
+# Heavy imports (numpy, rasterio) are deferred to main() so that argument
+# parsing and --help stay fast; PyQt6 is never imported on this path.
+
+MODES = ["RHV", "LHV", "pi4"]
+PRODUCTS = ["scattering", "covariance", "stokes", "dop", "m_chi", "m_delta", "ratio"]
+POLARIZATIONS = ["HH", "HV", "VH", "VV"]
+
+
+def add_input_arguments(parser):
+    # Input scene options, shared with the preview command line
+    parser.add_argument("--sensor", required=True, choices=["RADARSAT2", "ALOS"],
+                        help="Satellite the input data comes from.")
+    parser.add_argument("--images", nargs="+", metavar="PATH",
+                        help="RADARSAT-2: the HH, HV, VH and VV GeoTIFFs in that order. "
+                             "ALOS-PALSAR: the VOL file (or any file of the CEOS product).")
+    parser.add_argument("--lut", metavar="XML",
+                        help="RADARSAT-2 calibration look-up table (e.g. lutSigma.xml).")
+    parser.add_argument("--product", metavar="PATH",
+                        help="RADARSAT-2 product folder (or its product.xml), instead of --images and --lut. "
+                             "The imagery and the LUT are taken from the product metadata.")
+    parser.add_argument("--lut-type", default="sigma", choices=["sigma", "beta", "gamma"],
+                        help="Calibration LUT of --product: sigma nought, beta nought or gamma (default: sigma).")
+    parser.add_argument("--no-memmap", action="store_true",
+                        help="Read the inputs through GDAL even when they could be memory-mapped.")
+
+
+def load_inputs(parser, args):
+    # (paths, calibration) of the scene given by the input arguments; exits on invalid arguments
+    if args.product:
+        if args.sensor != "RADARSAT2":
+            parser.error("--product is only available for RADARSAT-2.")
+        if args.images or args.lut:
+            parser.error("--product replaces --images and --lut.")
+    elif not args.images:
+        parser.error("Give the input --images (or a RADARSAT-2 --product).")
+    elif args.sensor == "RADARSAT2":
+        if len(args.images) != 4:
+            parser.error("RADARSAT-2 needs exactly 4 images (HH, HV, VH, VV).")
+        if not args.lut:
+            parser.error("RADARSAT-2 needs a calibration file (--lut).")
+        paths = dict(zip(POLARIZATIONS, args.images))
+    else:
+        if len(args.images) != 1:
+            parser.error("ALOS-PALSAR needs exactly 1 VOL file.")
+        paths = {"HH": args.images[0]}
+
+    from pipeline import load_calibration
+
+    if args.product:
+        from radarsat2 import product_calibration, read_product
+
+        try:
+            product = read_product(args.product)
+            calibration = product_calibration(product, args.lut_type)
+        except (OSError, ValueError) as e:
+            parser.exit(1, f"Failed to read the product: {e}\n")
+        paths = product["paths"]
+    else:
+        # ALOS-PALSAR takes the calibration factor from the leader file of the product
+        calibration = load_calibration(args.sensor, args.lut if args.sensor == "RADARSAT2" else paths["HH"])
+    if calibration is None:
+        parser.exit(1, "Failed to load LUT. Calibration aborted.\n")
+    return paths, calibration
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m cli",
+        description="Synthesize Compact Polarimetric SAR products from Fully Polarimetric SLC data without the GUI."
+    )
+    add_input_arguments(parser)
+    parser.add_argument("--mode", nargs="+", default=[], choices=MODES,
+                        help="Compact polarimetric mode(s) to synthesize; several modes share one read of the inputs.")
+    parser.add_argument("--ellipse", nargs=2, type=float, action="append", default=[],
+                        metavar=("ORIENTATION", "ELLIPTICITY"),
+                        help="Also synthesize an arbitrary transmitted polarization ellipse, angles in degrees "
+                             "((0, -45) is RHV, (0, 45) LHV, (45, 0) pi4). Written to <prefix>_ellipse_<o>_<e>. "
+                             "Can be repeated.")
+    parser.add_argument("--products", required=True, nargs="+", choices=PRODUCTS,
+                        help="Products to generate: scattering vector, covariance matrix, Stokes vector, "
+                             "degree of polarization, m-chi / m-delta decompositions (RHV/LHV only) "
+                             "and the C11/C22 intensity ratio (e.g. RH/RV).")
+    parser.add_argument("--output-dir", default=".",
+                        help="Folder in which the S2_<mode> and C2_<mode> folders are created (default: current folder).")
+    parser.add_argument("--tile-size", type=int, default=1024,
+                        help="Edge length in pixels of the tiles processed at once (default: 1024).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of tiles processed in parallel (default: 1).")
+    parser.add_argument("--processes", action="store_true",
+                        help="Use a process pool instead of a thread pool for --workers > 1.")
+    parser.add_argument("--dask", nargs="?", const="threads", metavar="SCHEDULER",
+                        help="Run the chain as a dask task graph in chunks of --tile-size: 'threads' (default), "
+                             "'processes', 'local' (a LocalCluster of --workers processes) or the address of a "
+                             "dask.distributed scheduler, e.g. tcp://10.0.0.1:8786. Needs dask (and distributed).")
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="Tiles queued between the read, compute and write stages, which run "
+                             "concurrently; 0 with a single worker runs them one after another (default: 2).")
+    parser.add_argument("--precision", default="reference", choices=["reference", "float32"],
+                        help="Working precision: 'reference' matches the original float64 chain, "
+                             "'float32' computes in float32/complex64 (default: reference).")
+    parser.add_argument("--output-dtype", default="float32", choices=["float32", "float16", "int16"],
+                        help="Data type of the written bands (default: float32).")
+    parser.add_argument("--int16-scale", type=float, default=1e-4,
+                        help="Value of one int16 step when --output-dtype int16 (default: 1e-4).")
+    parser.add_argument("--layout", default="single", choices=["single", "multiband", "complex"],
+                        help="single: one GeoTIFF per band (default); multiband: one GeoTIFF per product; "
+                             "complex: like multiband with the scattering vector as CFloat32 bands.")
+    parser.add_argument("--format", default="geotiff", choices=["geotiff", "zarr"],
+                        help="geotiff (default), or zarr: one chunked store <output-dir>/CP.zarr with a group per mode "
+                             "and S11, S21 and C12 as complex64 arrays, written by the workers in parallel; new modes "
+                             "and products are added to an existing store. Needs zarr.")
+    parser.add_argument("--compress", choices=["deflate", "zstd", "lerc", "lzw"],
+                        help="Compression of the output GeoTIFFs (implies --tiled), or of the Zarr chunks "
+                             "(zstd, the default, or deflate).")
+    parser.add_argument("--tiled", action="store_true",
+                        help="Write internally tiled GeoTIFFs.")
+    parser.add_argument("--overviews", action="store_true",
+                        help="Build overviews of the outputs.")
+    parser.add_argument("--cog", action="store_true",
+                        help="Write Cloud-Optimized GeoTIFFs.")
+    parser.add_argument("--looks", type=int, nargs=2, default=[1, 1], metavar=("ROWS", "COLUMNS"),
+                        help="Multilook the covariance matrix by averaging ROWS x COLUMNS blocks (default: 1 1).")
+    parser.add_argument("--speckle-filter", choices=["boxcar", "refined_lee"],
+                        help="Speckle filter applied to the (multilooked) covariance matrix.")
+    parser.add_argument("--filter-size", type=int, default=7,
+                        help="Window size of the speckle filter, odd (default: 7).")
+    region = parser.add_mutually_exclusive_group()
+    region.add_argument("--window", type=int, nargs=4, metavar=("COLUMN", "ROW", "WIDTH", "HEIGHT"),
+                        help="Only process this pixel window of the scene.")
+    region.add_argument("--bbox", type=float, nargs=4, metavar=("LEFT", "BOTTOM", "RIGHT", "TOP"),
+                        help="Only process the part of the scene inside this bounding box "
+                             "(longitude/latitude unless --region-crs is given).")
+    region.add_argument("--aoi", metavar="GEOJSON",
+                        help="Only process the tiles that intersect the polygons of this GeoJSON file; "
+                             "the outputs cover the bounding box of the polygons.")
+    parser.add_argument("--region-crs", metavar="CRS",
+                        help="CRS of --bbox or --aoi, e.g. EPSG:32610 (default: EPSG:4326, or the crs of the GeoJSON).")
+    parser.add_argument("--cache-dir", nargs="?", const="~/.cache/CompactSAR",
+                        help="Cache the calibrated S11/S12/S22 of every scene in this folder (default: "
+                             "~/.cache/CompactSAR), so repeated runs on the same inputs skip calibration.")
+    parser.add_argument("--cache-size", type=float, default=20,
+                        help="Size limit of the cache in GB; least recently used scenes are evicted (default: 20).")
+    parser.add_argument("--report", default="run_report.json", metavar="JSON",
+                        help="Run report with the time, throughput and bytes of every stage, relative to "
+                             "--output-dir (default: run_report.json).")
+    parser.add_argument("--no-report", action="store_true",
+                        help="Don't write the run report.")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if not args.mode and not args.ellipse:
+        parser.error("Select at least one --mode or --ellipse.")
+
+    if args.tile_size < 1:
+        parser.error("--tile-size must be at least 1 pixel.")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+
+    if args.dask and (args.cache_dir or args.window or args.bbox or args.aoi):
+        parser.error("--dask can't be combined with --cache-dir or a region of interest.")
+
+    if args.format == "zarr":
+        if args.layout != "single" or args.tiled or args.overviews or args.cog:
+            parser.error("--layout, --tiled, --overviews and --cog only apply to GeoTIFF outputs.")
+        if args.output_dtype != "float32":
+            parser.error("Zarr stores are written as complex64 and float32.")
+        if args.compress not in (None, "zstd", "deflate"):
+            parser.error("Zarr chunks are compressed with zstd or deflate.")
+
+    paths, calibration = load_inputs(parser, args)
+
+    from cache import ScatteringCache
+    from pipeline import ellipse_mode, run_tiled
+
+    modes = list(dict.fromkeys(args.mode)) + [ellipse_mode(*angles) for angles in args.ellipse]
+
+    region = None
+    if args.window:
+        region = {"window": args.window}
+    elif args.bbox:
+        region = {"bbox": args.bbox, "crs": args.region_crs}
+    elif args.aoi:
+        region = {"polygon": os.path.abspath(args.aoi), "crs": args.region_crs}
+
+    if args.dask:
+        from chunked import run_chunked
+
+        run_chunked(paths, args.sensor, calibration, modes, args.products,
+                    output_root=args.output_dir, chunk_size=args.tile_size, scheduler=args.dask,
+                    workers=args.workers if args.workers > 1 else None,
+                    precision=args.precision, output_dtype=args.output_dtype, int16_scale=args.int16_scale,
+                    layout=args.layout, compress=args.compress, tiled=args.tiled, overviews=args.overviews,
+                    cog=args.cog, looks=tuple(args.looks), speckle_filter=args.speckle_filter,
+                    filter_size=args.filter_size, memmap=not args.no_memmap,
+                    report=None if args.no_report else args.report, output_format=args.format)
+        print("Simulation completed successfully. Results have been saved.")
+        return 0
+
+    cache = None
+    if args.cache_dir:
+        cache = ScatteringCache(os.path.expanduser(args.cache_dir), int(args.cache_size * 2**30))
+
+    run_tiled(paths, args.sensor, calibration, modes, args.products,
+              output_root=args.output_dir, tile_size=args.tile_size,
+              workers=args.workers, use_processes=args.processes,
+              precision=args.precision, output_dtype=args.output_dtype, int16_scale=args.int16_scale,
+              layout=args.layout, compress=args.compress, tiled=args.tiled, overviews=args.overviews,
+              cog=args.cog, looks=tuple(args.looks), speckle_filter=args.speckle_filter,
+              filter_size=args.filter_size, memmap=not args.no_memmap, cache=cache,
+              report=None if args.no_report else args.report, region=region, prefetch=args.prefetch,
+              output_format=args.format)
+    print("Simulation completed successfully. Results have been saved.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+import os
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+from pipeline import (DEFAULT_TILE_SIZE, POLARIZATIONS, filter_halo, load_calibration, make_job, multilooked_shape,
+                      open_inputs, process_tile, tile_plans)
+from readers import ArrayReader
+from region import scene_georeference
+from writers import COMPLEX_BANDS, FULL_RESOLUTION_BANDS
+
+# In-memory API: the CP products of a scene as arrays, for use from Python without writing
+# and reading back GeoTIFFs. Runs the tile kernel of the tiled engine, so the values are those
+# run_tiled writes with the float32 output dtype. Like cli.py, it never imports PyQt6.
+#
+#   import compactsar
+#   results = compactsar.synthesize(paths, "RADARSAT2", "lutSigma.xml", ["RHV", "pi4"])
+#   results["RHV"]["S11"], results["RHV"]["C12"]        # complex64
+#   results["RHV"]["C11"], results["RHV"]["C22"]        # float32
+#
+# Inputs are {pol: path} as on the command line, or {pol: array or reader} for HH, HV, VH
+# and VV. The calibration is a dict as pipeline.load_calibration returns, or the file it
+# is loaded from. xarray (and dask for lazy datasets) are optional, only imported when needed
+
+DEFAULT_PRODUCTS = ["scattering", "covariance"]
+
+# Bands returned as complex64, from the real and imaginary bands of the tile kernel
+COMPLEX_RESULTS = dict(COMPLEX_BANDS, C12=("C12_real", "C12_imag"))
+COMPLEX_PARTS = {part for parts in COMPLEX_RESULTS.values() for part in parts}
+
+
+def import_xarray():
+    try:
+        import xarray
+    except ImportError:
+        raise ImportError("Datasets need xarray: pip install xarray") from None
+    return xarray
+
+
+def is_paths(inputs):
+    return all(isinstance(value, (str, os.PathLike)) for value in inputs.values())
+
+
+def open_scene(inputs, sensor, calibration=None, memmap=True):
+    # {"readers": one per polarization, "opened": whether they were opened here (and must be
+    # closed here), "calibration", "shape"}. Arrays are RADARSAT-2 (I/Q, rows, columns)
+    # integers or ALOS-PALSAR complex (rows, columns); readers have the read(window)
+    # interface of readers.RasterReader
+    if is_paths(inputs):
+        paths = dict(inputs)
+        readers = open_inputs(paths, sensor, memmap)
+        opened = True
+    else:
+        paths = None
+        missing = [pol for pol in POLARIZATIONS if pol not in inputs]
+        if missing:
+            raise ValueError(f"Missing polarizations: {', '.join(missing)}")
+        readers = {pol: inputs[pol] if hasattr(inputs[pol], "read") else ArrayReader(inputs[pol])
+                   for pol in POLARIZATIONS}
+        opened = False
+    try:
+        shapes = {pol: tuple(reader.shape) for pol, reader in readers.items()}
+        if len(set(shapes.values())) != 1:
+            raise ValueError(f"The polarizations have different sizes: {shapes}")
+        shape = shapes["HH"]
+
+        if not isinstance(calibration, dict):
+            # The RADARSAT-2 LUT, or any file of the ALOS-PALSAR product (by default the input's)
+            if calibration is None and sensor == "RADARSAT2":
+                raise ValueError("RADARSAT-2 needs a calibration LUT.")
+            if calibration is None and paths is not None:
+                calibration = paths["HH"]
+            calibration = load_calibration(sensor, calibration)
+            if calibration is None:
+                raise ValueError("Failed to load the calibration LUT.")
+        if sensor == "RADARSAT2" and len(calibration["gains"]) != shape[1]:
+            raise ValueError(f"The LUT has {len(calibration['gains'])} gains for {shape[1]} columns.")
+    except Exception:
+        if opened:
+            for reader in readers.values():
+                reader.close()
+        raise
+    return {"readers": readers, "opened": opened, "calibration": calibration, "shape": shape}
+
+
+def complex_band(real, imag):
+    data = np.empty(real.shape, np.complex64)
+    data.real = real
+    data.imag = imag
+    return data
+
+
+def complex_bands(bands, join):
+    # bands in their order, each real and imaginary pair joined by join(real, imag)
+    joined = {}
+    for name, data in bands.items():
+        if name not in COMPLEX_PARTS:
+            joined[name] = data
+        for band, (real, imag) in COMPLEX_RESULTS.items():
+            if name == real:
+                joined[band] = join(data, bands[imag])
+    return joined
+
+
+def tile_results(outputs):
+    # {mode: {band: array}} of the (mode, window, bands) outputs of process_tile, with the
+    # real and imaginary bands joined into complex64 ones
+    results = {}
+    for mode, _, bands in outputs:
+        results.setdefault(mode, {}).update(complex_bands(bands, complex_band))
+    return results
+
+
+def close_scene(scene):
+    if scene["opened"]:
+        for reader in scene["readers"].values():
+            reader.close()
+
+
+def scene_tiles(scene, job, tile_size=DEFAULT_TILE_SIZE):
+    rows, columns = scene["shape"]
+    for plan in tile_plans(rows, columns, tile_size, job["looks"], filter_halo(job)):
+        tile = {pol: reader.read(plan["read"]) for pol, reader in scene["readers"].items()}
+        yield plan["core"], plan["out"], tile_results(process_tile(tile, plan, job))
+
+
+def iter_tiles(inputs, sensor, calibration=None, mode="RHV", products=DEFAULT_PRODUCTS, tile_size=DEFAULT_TILE_SIZE,
+               precision="reference", looks=(1, 1), speckle_filter=None, filter_size=7, memmap=True):
+    # Yields (window, looked window, {mode: {band: array}}) tile by tile: the scattering vector
+    # covers the window at full resolution, C2 and the derived products the looked window of the
+    # multilooked grid (the same window without looks). Only one tile is held at a time
+    scene = open_scene(inputs, sensor, calibration, memmap)
+    try:
+        job = make_job(sensor, scene["calibration"], mode, products, precision, looks=looks,
+                       speckle_filter=speckle_filter, filter_size=filter_size)
+        yield from scene_tiles(scene, job, tile_size)
+    finally:
+        close_scene(scene)
+
+
+def synthesize(inputs, sensor, calibration=None, mode="RHV", products=DEFAULT_PRODUCTS, tile_size=DEFAULT_TILE_SIZE,
+               precision="reference", looks=(1, 1), speckle_filter=None, filter_size=7, memmap=True):
+    # {mode: {band: array}} of the whole scene: S11 and S21 (the CP scattering vector) and C12
+    # complex64, C11, C22 and the derived products float32. mode is a mode name (see
+    # pipeline.ellipse_mode for arbitrary ellipses) or a list of them
+    scene = open_scene(inputs, sensor, calibration, memmap)
+    try:
+        job = make_job(sensor, scene["calibration"], mode, products, precision, looks=looks,
+                       speckle_filter=speckle_filter, filter_size=filter_size)
+        shapes = {True: scene["shape"], False: multilooked_shape(*scene["shape"], job["looks"])}
+        results = {}
+        for window, looked_window, tile in scene_tiles(scene, job, tile_size):
+            for name, bands in tile.items():
+                mode_results = results.setdefault(name, {})
+                for band, data in bands.items():
+                    full = band in FULL_RESOLUTION_BANDS
+                    if band not in mode_results:
+                        mode_results[band] = np.empty(shapes[full], data.dtype)
+                    mode_results[band][(window if full else looked_window).toslices()] = data
+    finally:
+        close_scene(scene)
+    return results
+
+
+def grid_coordinates(transform, shape):
+    # x and y of the pixel centres, when the transform isn't rotated
+    if transform is None or transform.b or transform.d:
+        return {}
+    rows, columns = shape
+    return {
+        "y": transform.f + transform.e * (np.arange(rows) + 0.5),
+        "x": transform.c + transform.a * (np.arange(columns) + 0.5),
+    }
+
+
+def to_dataset(results, transform=None, crs=None, looks=(1, 1)):
+    # Labelled xarray Dataset of results ({mode: {band: array}}, NumPy or dask): one variable per
+    # band with a mode dimension, the scattering vector on the (y, x) grid of the scene and C2 and
+    # the derived products on (y_looked, x_looked) when multilooked. The georeferencing follows
+    # the CF / rioxarray convention: a spatial_ref coordinate holding the CRS and the GDAL
+    # geotransform, and x/y coordinates of the pixel centres unless the transform is rotated
+    xr = import_xarray()
+    looks = tuple(looks)
+    transform = Affine(*transform[:6]) if transform is not None else None
+    looked_transform = transform * Affine.scale(looks[1], looks[0]) if transform is not None else None
+    grids = {True: ("y", "x"), False: ("y", "x") if looks == (1, 1) else ("y_looked", "x_looked")}
+
+    modes = list(results)
+    bands = list(dict.fromkeys(band for mode in modes for band in results[mode]))
+    variables = {}
+    coords = {"mode": modes}
+    for band in bands:
+        full = band in FULL_RESOLUTION_BANDS
+        dims = grids[full]
+        layers = [xr.DataArray(results[mode][band], dims=dims) for mode in modes]
+        variables[band] = xr.concat(layers, "mode")
+        axes = grid_coordinates(transform if full else looked_transform, layers[0].shape)
+        coords.update({dim: axes[axis] for dim, axis in zip(dims, ("y", "x")) if axis in axes})
+
+    attrs = {"looks": list(looks)}
+    if crs is not None or transform is not None:
+        spatial_ref = {}
+        if crs is not None:
+            crs_wkt = CRS.from_user_input(crs).to_wkt()
+            spatial_ref.update({"crs_wkt": crs_wkt, "spatial_ref": crs_wkt})
+        if transform is not None:
+            spatial_ref["GeoTransform"] = " ".join(repr(value) for value in transform.to_gdal())
+        coords["spatial_ref"] = xr.DataArray(0, attrs=spatial_ref)
+        for variable in variables.values():
+            variable.attrs["grid_mapping"] = "spatial_ref"
+        if looks != (1, 1) and transform is not None:
+            attrs["looked_GeoTransform"] = " ".join(repr(value) for value in looked_transform.to_gdal())
+    return xr.Dataset(variables, coords=coords, attrs=attrs)
+
+
+def lazy_results(paths, sensor, calibration, mode, products, chunk_size, precision, looks, speckle_filter,
+                 filter_size, memmap):
+    # The results of synthesize as dask arrays from chunked.cp_graph, computed when accessed
+    from chunked import cp_graph, import_dask
+
+    da = import_dask().array
+    graph = cp_graph(paths, sensor, calibration, mode, products, chunk_size, precision, "float32",
+                     looks=looks, speckle_filter=speckle_filter, filter_size=filter_size, memmap=memmap)
+    return {name: complex_bands(bands, lambda real, imag: da.map_blocks(complex_band, real, imag, dtype=np.complex64))
+            for name, bands in graph.items()}
+
+
+def dataset(inputs, sensor, calibration=None, mode="RHV", products=DEFAULT_PRODUCTS, tile_size=DEFAULT_TILE_SIZE,
+            precision="reference", looks=(1, 1), speckle_filter=None, filter_size=7, transform=None, crs=None,
+            lazy=False, memmap=True):
+    # synthesize as an xarray Dataset (see to_dataset). Input files give the georeferencing
+    # (their geotransform, or an affine fit of their GCPs), which transform and crs override.
+    # lazy (input files only) returns dask-backed variables in chunks of tile_size, through
+    # the chunked backend; nothing is computed until the values are used
+    if is_paths(inputs):
+        georeference = scene_georeference(inputs["HH"])
+        if georeference is not None:
+            transform = transform if transform is not None else georeference[0]
+            crs = crs if crs is not None else georeference[1]
+    if lazy:
+        if not is_paths(inputs):
+            raise ValueError("Lazy datasets are read from the input files.")
+        scene = open_scene(inputs, sensor, calibration, memmap=False)
+        close_scene(scene)
+        results = lazy_results(dict(inputs), sensor, scene["calibration"], mode, products, tile_size, precision,
+                               looks, speckle_filter, filter_size, memmap)
+    else:
+        results = synthesize(inputs, sensor, calibration, mode, products, tile_size, precision, looks,
+                             speckle_filter, filter_size, memmap)
+    return to_dataset(results, transform, crs, looks)
@@ -25,8 +25,8 @@ def gains_offset_reader_xml(file_path):
         tree = ET.parse(file_path)
         root = tree.getroot()
         
-        # Try to find the 'offset' element
-        offset_element = root.find("offset")
+        # Try to find the 'offset' element (product LUTs are namespaced, {*} matches any namespace)
+        offset_element = root.find("{*}offset")
         if offset_element is None:
             raise ValueError("Offset element not found in XML file.")
         
@@ -34,7 +34,7 @@ def gains_offset_reader_xml(file_path):
         offset = float(offset_element.text)
         
         # Try to find the 'gains' element
-        gains_element = root.find("gains")
+        gains_element = root.find("{*}gains")
         if gains_element is None:
             raise ValueError("Gains element not found in XML file.")
         
@@ -65,10 +65,10 @@ def gains_offset_reader_xml(file_path):
     
 def Radarsat2_calibration(IQ_band, gains, offset, row_number):
     try:
-        gains_array = np.tile(gains, (row_number, 1))
-        
-        I_calibrated = (IQ_band[0] - offset) / gains_array  # Real
-        Q_calibrated = (IQ_band[1] - offset) / gains_array  # Imaginary
+        # gains holds one value per column and broadcasts over the rows,
+        # row_number is kept for backwards compatibility
+        I_calibrated = (IQ_band[0] - offset) / gains  # Real
+        Q_calibrated = (IQ_band[1] - offset) / gains  # Imaginary
 
         return I_calibrated, Q_calibrated
     
@@ -135,13 +135,356 @@ def covariance_matrix_function(S11, S21):
     C22 = (S21 * np.conj(S21)).real
     return C11, C12, C22
 
-def save_single_band_tif(output_path, data, reference_image_path):
+def reference_meta(reference_image_path):
     with rasterio.open(reference_image_path) as ref_image:
         meta = ref_image.meta.copy()
-        meta.update({
-            'count': 1,  
-            'dtype': 'float32',
-            'driver': 'GTiff'
-        })
-        with rasterio.open(output_path, 'w', **meta) as dst:
-            dst.write(data, 1) 
\ No newline at end of file
+    meta.update({
+        'count': 1,
+        'driver': 'GTiff'
+    })
+    return meta
+
+def save_single_band_tif(output_path, data, reference_image_path, dtype='float32', meta=None):
+    # Pass meta=reference_meta(reference_image_path) to avoid reopening the reference on every call
+    if meta is None:
+        meta = reference_meta(reference_image_path)
+    meta = dict(meta, dtype=dtype)
+    with rasterio.open(output_path, 'w', **meta) as dst:
+        dst.write(data.astype(dtype, copy=False), 1) 
+
+def get_buffer(buffers, name, shape, dtype):
+    # Reuse a scratch array across tiles of the same shape
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        buffers[name] = buffer
+    return buffer
+
+def fp_working_dtype(IQ_dtype, gains=None, offset=None, const=None, dtype=None):
+    # Real dtype fp_scattering_kernel computes in, the promotion of the original functions by default
+    if dtype is not None:
+        return np.dtype(dtype)
+    if gains is not None:
+        # Same dtype promotion as Radarsat2_calibration
+        return np.result_type(np.result_type(IQ_dtype, offset), gains)
+    # Same dtype promotion as ALOS_calibration
+    return np.result_type(np.empty(0, IQ_dtype).real, np.sqrt(const))
+
+def fp_scattering_kernel(IQ_HH, IQ_HV, IQ_VH, IQ_VV, gains=None, offset=None, const=None, buffers=None, dtype=None):
+    # Single pass equivalent of Radarsat2_calibration/ALOS_calibration -> FP_scattering_matrix.
+    # Every step writes with out= into tile-sized scratch buffers that are reused across calls,
+    # and the per-column gains are broadcast, so no gains matrix and no per-stage temporaries
+    # are allocated. Returns S11, S12, S22 (views of the "S11", "S12", "S22" buffers).
+    # RADARSAT-2 is selected by passing gains/offset (IQ_* of shape (2, rows, cols)),
+    # ALOS-PALSAR by passing const (complex IQ_* of shape (rows, cols)).
+    # dtype forces the real working dtype (e.g. np.float32); by default it follows the
+    # promotion of the original functions.
+    if buffers is None:
+        buffers = {}
+
+    dtype = fp_working_dtype(IQ_HH.dtype, gains, offset, const, dtype)
+    if gains is not None:
+        shape = IQ_HH.shape[1:]
+
+        def calibrate(IQ_band, I_out, Q_out):
+            np.subtract(IQ_band[0], offset, out=I_out, dtype=dtype)
+            np.divide(I_out, gains, out=I_out, dtype=dtype)
+            np.subtract(IQ_band[1], offset, out=Q_out, dtype=dtype)
+            np.divide(Q_out, gains, out=Q_out, dtype=dtype)
+    else:
+        shape = IQ_HH.shape
+        factor = np.sqrt(const)
+
+        def calibrate(IQ_band, I_out, Q_out):
+            np.multiply(IQ_band.real, factor, out=I_out, dtype=dtype)
+            np.multiply(IQ_band.imag, factor, out=Q_out, dtype=dtype)
+
+    # Complex scratch tiles; calibration writes their real/imaginary planes
+    complex_dtype = np.result_type(dtype, 1j)
+    S11 = get_buffer(buffers, "S11", shape, complex_dtype)
+    S12 = get_buffer(buffers, "S12", shape, complex_dtype)
+    S22 = get_buffer(buffers, "S22", shape, complex_dtype)
+    tmp = get_buffer(buffers, "tmp", shape, complex_dtype)
+    I_S12, Q_S12 = S12.real, S12.imag
+    I_tmp, Q_tmp = tmp.real, tmp.imag
+
+    calibrate(IQ_HH, S11.real, S11.imag)
+    calibrate(IQ_HV, I_S12, Q_S12)
+    calibrate(IQ_VH, I_tmp, Q_tmp)
+    calibrate(IQ_VV, S22.real, S22.imag)
+    np.add(I_S12, I_tmp, out=I_S12)
+    np.divide(I_S12, 2, out=I_S12)
+    np.add(Q_S12, Q_tmp, out=Q_S12)
+    np.divide(Q_S12, 2, out=Q_S12)
+    return S11, S12, S22
+
+def transmit_jones_vector(orientation, ellipticity):
+    # H and V components of a transmitted polarization ellipse, angles in degrees.
+    # (0, -45) is the right circular transmission of RHV_simulator, (0, 45) LHV and (45, 0) pi4.
+    psi, chi = np.radians(orientation), np.radians(ellipticity)
+    h = complex(np.cos(psi) * np.cos(chi), -np.sin(psi) * np.sin(chi))
+    v = complex(np.sin(psi) * np.cos(chi), np.cos(psi) * np.sin(chi))
+    return h, v
+
+def ellipse_simulator(FP_S11, FP_S12, FP_S22, orientation, ellipticity): # Arbitrary transmitted ellipse
+    h, v = transmit_jones_vector(orientation, ellipticity)
+    S1 = h * FP_S11 + v * FP_S12
+    S2 = h * FP_S12 + v * FP_S22
+    return S1, S2
+
+# Size from which numpy reuses the temporary operand of an expression (NPY_MIN_ELIDE_BYTES)
+ELIDE_BYTES = 256 * 1024
+
+def cp_synthesis_kernel(S11, S12, S22, mode, products, buffers=None, preserve=False):
+    # RHV/LHV/pi4_simulator (mode name) or ellipse_simulator (mode = (orientation, ellipticity))
+    # followed by covariance_matrix_function, with out= into scratch buffers.
+    # With preserve=False the results overwrite S11/S12/S22, otherwise they go to separate
+    # buffers so that the same FP matrix can be synthesized into several modes.
+    if buffers is None:
+        buffers = {}
+    shape, complex_dtype = S11.shape, S11.dtype
+    dtype = S11.real.dtype
+    tmp = get_buffer(buffers, "tmp", shape, complex_dtype)
+    if preserve:
+        S1 = get_buffer(buffers, "S1", shape, complex_dtype)
+        S2 = get_buffer(buffers, "S2", shape, complex_dtype)
+        C12 = get_buffer(buffers, "C12", shape, complex_dtype)
+    else:
+        S1, S2, C12 = S11, S22, S12
+    I_S11, Q_S11 = S11.real, S11.imag
+    I_S12, Q_S12 = S12.real, S12.imag
+    I_S22, Q_S22 = S22.real, S22.imag
+    I_S1, Q_S1 = S1.real, S1.imag
+    I_S2, Q_S2 = S2.real, S2.imag
+    I_tmp = tmp.real
+
+    # Every channel is written after its last use, so S1/S2 may alias S11/S22
+    coefficent = 1 / np.sqrt(2)
+    if mode == "RHV":
+        # S_RH = (S11 - jS12) / sqrt(2), S_RV = (S12 - jS22) / sqrt(2)
+        np.add(I_S11, Q_S12, out=I_S1)
+        np.subtract(Q_S11, I_S12, out=Q_S1)
+        np.subtract(Q_S12, I_S22, out=I_tmp)
+        np.add(I_S12, Q_S22, out=I_S2)
+        np.copyto(Q_S2, I_tmp)
+    elif mode == "LHV":
+        # S_LH = (S11 + jS12) / sqrt(2), S_LV = (S12 + jS22) / sqrt(2)
+        np.subtract(I_S11, Q_S12, out=I_S1)
+        np.add(Q_S11, I_S12, out=Q_S1)
+        np.add(I_S22, Q_S12, out=I_tmp)
+        np.subtract(I_S12, Q_S22, out=I_S2)
+        np.copyto(Q_S2, I_tmp)
+    elif mode == "pi4":
+        # S1 = (S11 + S12) / sqrt(2), S2 = (S22 + S12) / sqrt(2)
+        np.add(S11, S12, out=S1)
+        np.add(S22, S12, out=S2)
+    elif isinstance(mode, tuple):
+        # S1 = h S11 + v S12, S2 = h S12 + v S22
+        h, v = transmit_jones_vector(*mode)
+        np.multiply(S11, h, out=S1)
+        np.multiply(S12, v, out=tmp)
+        np.add(S1, tmp, out=S1)
+        np.multiply(S22, v, out=S2)
+        np.multiply(S12, h, out=tmp)
+        np.add(S2, tmp, out=S2)
+    else:
+        raise ValueError(f"Unknown simulation mode: {mode}")
+    if not isinstance(mode, tuple):
+        for plane in (I_S1, Q_S1, I_S2, Q_S2):
+            np.multiply(plane, coefficent, out=plane, dtype=dtype)
+
+    results = {}
+    if "scattering" in products:
+        results.update({"S11_real": S1.real, "S11_imag": S1.imag, "S21_real": S2.real, "S21_imag": S2.imag})
+
+    if "covariance" in products:
+        # Same complex products as covariance_matrix_function. From ELIDE_BYTES on, numpy
+        # evaluates S11 * np.conj(S21) there as np.conj(S21) * S11 (reusing the temporary),
+        # and the imaginary part of a complex product depends on the operand order
+        C11 = get_buffer(buffers, "C11", shape, dtype)
+        C22 = get_buffer(buffers, "C22", shape, dtype)
+        np.conjugate(S1, out=tmp)
+        np.multiply(S1, tmp, out=tmp)
+        np.copyto(C11, tmp.real)
+        np.conjugate(S2, out=tmp)
+        if tmp.nbytes >= ELIDE_BYTES:
+            np.multiply(tmp, S1, out=C12)
+        else:
+            np.multiply(S1, tmp, out=C12)
+        np.multiply(S2, tmp, out=tmp)
+        np.copyto(C22, tmp.real)
+
+        results.update({"C11": C11, "C12_real": C12.real, "C12_imag": C12.imag, "C22": C22})
+
+    return results
+
+def fused_cp_kernel(IQ_HH, IQ_HV, IQ_VH, IQ_VV, mode, products, gains=None, offset=None, const=None,
+                    buffers=None, dtype=None):
+    # Single pass equivalent of Radarsat2_calibration/ALOS_calibration -> FP_scattering_matrix ->
+    # RHV/LHV/pi4_simulator -> covariance_matrix_function for one mode
+    if buffers is None:
+        buffers = {}
+    S11, S12, S22 = fp_scattering_kernel(IQ_HH, IQ_HV, IQ_VH, IQ_VV, gains, offset, const, buffers, dtype)
+    return cp_synthesis_kernel(S11, S12, S22, mode, products, buffers)
+
+def box_sum(array, rows, cols):
+    # Sum over a centred rows x cols window (odd sizes) from running sums,
+    # O(1) per pixel whatever the window size; pixels outside the array count as 0
+    half_rows, half_cols = rows // 2, cols // 2
+    padded = np.pad(array, ((half_rows + 1, half_rows), (half_cols + 1, half_cols)))
+    sums = np.cumsum(padded, axis=0)
+    sums = sums[rows:] - sums[:-rows]
+    sums = np.cumsum(sums, axis=1)
+    return sums[:, cols:] - sums[:, :-cols]
+
+def boxcar_filter(array, rows, cols=None):
+    # Moving average; near the borders only the pixels inside the array are averaged
+    if cols is None:
+        cols = rows
+    counts = box_sum(np.ones(array.shape, dtype=array.real.dtype), rows, cols)
+    return box_sum(array, rows, cols) / counts
+
+def multilook(array, looks_rows, looks_cols):
+    # Block average with decimation; a partial block at the end averages the pixels it has
+    rows, cols = array.shape
+    out_rows, out_cols = -(-rows // looks_rows), -(-cols // looks_cols)
+    padded = np.zeros((out_rows * looks_rows, out_cols * looks_cols), dtype=array.dtype)
+    padded[:rows, :cols] = array
+    sums = padded.reshape(out_rows, looks_rows, out_cols, looks_cols).sum(axis=(1, 3))
+    row_counts = np.minimum(looks_rows, rows - np.arange(out_rows) * looks_rows)
+    col_counts = np.minimum(looks_cols, cols - np.arange(out_cols) * looks_cols)
+    return sums / np.outer(row_counts, col_counts).astype(array.real.dtype)
+
+def refined_lee_masks(size):
+    # The 8 edge aligned half windows of the refined Lee filter
+    offsets = np.arange(size) - size // 2
+    di, dj = np.meshgrid(offsets, offsets, indexing="ij")
+    return np.stack([
+        dj <= 0, dj >= 0,            # vertical edge: left, right
+        di >= dj, di <= dj,          # diagonal edge: lower left, upper right
+        di <= 0, di >= 0,            # horizontal edge: top, bottom
+        di + dj <= 0, di + dj >= 0,  # anti-diagonal edge: upper left, lower right
+    ])
+
+def refined_lee_filter(C11, C12, C22, size=7, looks=1):
+    # Refined Lee filter (Lee 1981, polarimetric form of Lee et al. 1999) of the C2 matrix.
+    # The edge direction and the half window are chosen from the span, and the same
+    # weight is applied to every element so the filtered matrix stays positive semi-definite.
+    if size < 5 or size % 2 == 0:
+        raise ValueError("The refined Lee window size must be odd and at least 5.")
+    rows, cols = C11.shape
+    half = size // 2
+    sub = 2 * (size // 4) + 1
+    step = (size - sub) // 2
+    span = C11 + C22
+
+    # 3 x 3 grid of sub-window means around every pixel
+    sub_means = np.pad(boxcar_filter(span, sub), step, mode="edge")
+    m = [[sub_means[step + (i - 1) * step:step + (i - 1) * step + rows,
+                    step + (j - 1) * step:step + (j - 1) * step + cols] for j in range(3)] for i in range(3)]
+
+    sides = [
+        (m[0][0] + m[1][0] + m[2][0], m[0][2] + m[1][2] + m[2][2]),
+        (m[1][0] + m[2][0] + m[2][1], m[0][1] + m[0][2] + m[1][2]),
+        (m[0][0] + m[0][1] + m[0][2], m[2][0] + m[2][1] + m[2][2]),
+        (m[0][0] + m[0][1] + m[1][0], m[1][2] + m[2][1] + m[2][2]),
+    ]
+    gradients = np.stack([np.abs(second - first) for first, second in sides])
+    direction = np.argmax(gradients, axis=0)
+    # Of the two half windows, keep the one on the side closest to the centre
+    centre = 3 * m[1][1]
+    second_side = np.stack([np.abs(second - centre) < np.abs(first - centre) for first, second in sides])
+    mask_index = 2 * direction + np.take_along_axis(second_side, direction[np.newaxis], axis=0)[0]
+
+    masks = refined_lee_masks(size)
+    planes = [span, span * span, np.ones(span.shape, dtype=span.dtype), C11, C12, C22]
+    padded = [np.pad(plane, half) for plane in planes]
+    sums = [np.zeros_like(plane) for plane in planes]
+    for i in range(size):
+        for j in range(size):
+            weight = masks[:, i, j][mask_index]
+            for total, plane in zip(sums, padded):
+                total += weight * plane[i:i + rows, j:j + cols]
+
+    span_sum, span_square_sum, counts, C11_sum, C12_sum, C22_sum = sums
+    mean_y = span_sum / counts
+    var_y = np.maximum(span_square_sum / counts - mean_y * mean_y, 0)
+    noise = 1 / looks
+    var_x = np.maximum((var_y - mean_y * mean_y * noise) / (1 + noise), 0)
+    b = np.divide(var_x, var_y, out=np.zeros_like(var_y), where=var_y > 0)
+
+    filtered = []
+    for element, total in zip((C11, C12, C22), (C11_sum, C12_sum, C22_sum)):
+        mean = total / counts
+        filtered.append(mean + b * (element - mean))
+    return tuple(filtered)
+
+def multilook_covariance(C11, C12, C22, looks=(1, 1), speckle_filter=None, filter_size=7):
+    # Spatial averaging of the C2 matrix: block multilook with decimation, then an optional
+    # boxcar or refined Lee filter at the multilooked resolution
+    looks_rows, looks_cols = looks
+    if looks_rows > 1 or looks_cols > 1:
+        C11, C12, C22 = (multilook(element, looks_rows, looks_cols) for element in (C11, C12, C22))
+
+    if speckle_filter == "boxcar":
+        C11, C12, C22 = (boxcar_filter(element, filter_size) for element in (C11, C12, C22))
+    elif speckle_filter == "refined_lee":
+        C11, C12, C22 = refined_lee_filter(C11, C12, C22, filter_size, looks_rows * looks_cols)
+    elif speckle_filter is not None:
+        raise ValueError(f"Unknown speckle filter: {speckle_filter}")
+    return C11, C12, C22
+
+def stokes_vector(C11, C12, C22):
+    # Stokes parameters of the received field, from C2 in the (H, V) receive basis
+    g0 = C11 + C22
+    g1 = C11 - C22
+    g2 = 2 * C12.real
+    g3 = -2 * C12.imag
+    return g0, g1, g2, g3
+
+def degree_of_polarization(g0, g1, g2, g3):
+    polarized = np.sqrt(g1 * g1 + g2 * g2 + g3 * g3)
+    return np.divide(polarized, g0, out=np.zeros_like(polarized), where=g0 > 0)
+
+def m_chi_decomposition(g0, g3, m, chirality=1):
+    # Raney's m-chi decomposition: double bounce, volume and odd bounce amplitudes.
+    # chirality is +1 for right circular (RHV) and -1 for left circular (LHV) transmission.
+    polarized = m * g0
+    sin_2chi = np.divide(-chirality * g3, polarized, out=np.zeros_like(polarized), where=polarized > 0)
+    even = np.sqrt(np.maximum(polarized * (1 - sin_2chi) / 2, 0))
+    volume = np.sqrt(np.maximum(g0 * (1 - m), 0))
+    odd = np.sqrt(np.maximum(polarized * (1 + sin_2chi) / 2, 0))
+    return even, volume, odd
+
+def m_delta_decomposition(g0, C12, m, chirality=1):
+    # Charbonneau's m-delta decomposition, delta being the relative phase of the two received channels
+    polarized = m * g0
+    sin_delta = np.sin(chirality * np.angle(C12))
+    even = np.sqrt(np.maximum(polarized * (1 - sin_delta) / 2, 0))
+    volume = np.sqrt(np.maximum(g0 * (1 - m), 0))
+    odd = np.sqrt(np.maximum(polarized * (1 + sin_delta) / 2, 0))
+    return even, volume, odd
+
+def intensity_ratio(C11, C22):
+    # |S1|^2 / |S2|^2, e.g. RH/RV for the RHV mode
+    return np.divide(C11, C22, out=np.zeros_like(C11), where=C22 > 0)
+
+def derived_cp_products(C11, C12, C22, products, chirality=1):
+    # Products computed from the (multilooked) C2 matrix, keyed by band name
+    bands = {}
+    g0, g1, g2, g3 = stokes_vector(C11, C12, C22)
+    if "stokes" in products:
+        bands.update({"g0": g0, "g1": g1, "g2": g2, "g3": g3})
+
+    m = degree_of_polarization(g0, g1, g2, g3)
+    if "dop" in products:
+        bands["m"] = m
+    if "m_chi" in products:
+        even, volume, odd = m_chi_decomposition(g0, g3, m, chirality)
+        bands.update({"m_chi_even": even, "m_chi_volume": volume, "m_chi_odd": odd})
+    if "m_delta" in products:
+        even, volume, odd = m_delta_decomposition(g0, C12, m, chirality)
+        bands.update({"m_delta_even": even, "m_delta_volume": volume, "m_delta_odd": odd})
+    if "ratio" in products:
+        bands["ratio"] = intensity_ratio(C11, C22)
+    return bands
@@ -1,12 +1,67 @@
 import os
 import sys
+import threading
 from PyQt6 import QtWidgets, QtCore
 from FP_to_CP_GUI import Ui_MainWindow
-from PyQt6.QtGui import QIcon, QPixmap
+from PyQt6.QtGui import QIcon, QImage, QPixmap
 from PyQt6.QtCore import Qt
-from PyQt6.QtWidgets import QFileDialog, QMessageBox, QSplashScreen, QApplication
+from PyQt6.QtWidgets import QDialog, QFileDialog, QInputDialog, QLabel, QMessageBox, QSplashScreen, QApplication, QVBoxLayout
 from functions import *
-from osgeo import gdal
+from cache import ScatteringCache
+from metrics import RunMetrics, available_memory
+from pipeline import ProcessingCancelled, alos_calibration, ellipse_mode, fitting_workers, load_calibration, make_job, run_tiled
+from preview import preview
+from radarsat2 import LUT_TYPES, product_calibration, read_product
+from ceos import DEFAULT_CALIBRATION_FACTOR
+from ceos import read_product as read_ceos_product
+from writers import PRODUCTS
+
+class ProcessingThread(QtCore.QThread):
+    # Runs run_tiled off the event loop; the GUI only sees Qt signals
+    message = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int, int)
+    failed = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
+    completed = QtCore.pyqtSignal()
+
+    def __init__(self, *args, **kwargs):
+        super(ProcessingThread, self).__init__()
+        self.args = args
+        self.kwargs = kwargs
+        self.stop_event = threading.Event()
+        # Read by the GUI thread for the live stage timings
+        self.metrics = RunMetrics()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def run(self):
+        try:
+            run_tiled(*self.args, log=self.message.emit, progress=self.progress.emit,
+                      cancel=self.stop_event.is_set, metrics=self.metrics, **self.kwargs)
+        except ProcessingCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.completed.emit()
+
+class PreviewThread(QtCore.QThread):
+    # Computes the quick look off the event loop
+    completed = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, *args):
+        super(PreviewThread, self).__init__()
+        self.args = args
+
+    def run(self):
+        try:
+            result = preview(*self.args)
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.completed.emit(result)
 
 class FP_to_CP(QtWidgets.QMainWindow):
     def __init__(self):
@@ -16,10 +71,21 @@ class FP_to_CP(QtWidgets.QMainWindow):
         self.ui.FP_image_reader.clicked.connect(self.image_reader)
         self.ui.lut_file.clicked.connect(self.calibration)
         self.ui.Convert_to_CP.clicked.connect(self.simualtion_to_cp)
+        self.ui.Cancel.clicked.connect(self.cancel_processing)
+        self.ui.Preview.clicked.connect(self.show_preview)
+        self.ui.region_file.clicked.connect(self.select_aoi)
+        self.ui.show_stats.toggled.connect(self.toggle_stage_stats)
+        self.stats_timer = QtCore.QTimer(self)
+        self.stats_timer.setInterval(1000)
+        self.stats_timer.timeout.connect(self.update_stage_stats)
         self.ui.log_text.append("Welcome! Ready to start processing.")
         
         self.images_loaded = False
         self.calibration_done = False
+        self.product = None
+        self.calibration_factor = None
+        self.worker = None
+        self.preview_worker = None
     
     def image_reader(self):
         RADARSAT2 = self.ui.radarsat2.isChecked()
@@ -27,16 +93,37 @@ class FP_to_CP(QtWidgets.QMainWindow):
         
         self.images_loaded = False
         self.calibration_done = False
+        self.product = None
+        self.calibration_factor = None
         
         if RADARSAT2:
             files, _ = QFileDialog.getOpenFileNames(
                 self,
-                "Select 4 Images",
+                "Select 4 Images or product.xml",
                 "",
-                "TIF Files (*.tif *.tiff)"
+                "RADARSAT-2 Files (*.tif *.tiff product.xml)"
             )
             
-            if len(files) != 4:
+            if len(files) == 1 and files[0].lower().endswith(".xml"):
+                # The imagery of every polarization and the LUTs come from the product metadata
+                try:
+                    self.product = read_product(files[0])
+                except (OSError, ValueError) as e:
+                    self.ui.log_text.append(f"Error: {e}")
+                    return
+                self.paths = self.product["paths"]
+                self.image_paths = self.paths
+                self.ui.log_text.append(f"Selected product: {files[0]}")
+                if self.product["satellite"]:
+                    self.ui.log_text.append(f"{self.product['satellite']}, acquired {self.product['acquisition']}")
+                for key, full_path in self.paths.items():
+                    self.ui.log_text.append(f"{key}: {full_path}")
+                self.sensor = "RADARSAT2"
+                self.images_loaded = True
+                if self.product["shape"] is not None:
+                    row, column = self.product["shape"]
+                    self.ui.log_text.append(f"Image rows = {row} and image columns = {column}")
+            elif len(files) != 4:
                 msg_box = QMessageBox()
                 msg_box.setIcon(QMessageBox.Icon.Warning)
                 msg_box.setWindowTitle("Warning")
@@ -56,12 +143,19 @@ class FP_to_CP(QtWidgets.QMainWindow):
                 for key, full_path in self.paths.items():
                     self.ui.log_text.append(f"{key}: {full_path}")
                 
-                self.image_array = radarsat2_reader(self.paths)
-                
-                if all(self.image_array[key] is not None for key in self.image_array):
-                    self.ui.log_text.append("Images read successfully")
+                shapes = {}
+                for key, path in self.paths.items():
+                    try:
+                        with rasterio.open(path) as dataset:
+                            shapes[key] = (dataset.height, dataset.width)
+                    except RasterioIOError:
+                        shapes[key] = None
+
+                if all(shape is not None for shape in shapes.values()):
+                    self.ui.log_text.append("Images opened successfully")
+                    self.sensor = "RADARSAT2"
                     self.images_loaded = True
-                    row, column = self.image_array["HH"].shape[1:3]
+                    row, column = shapes["HH"]
                     self.ui.log_text.append(f"Image rows = {row} and image columns = {column}")
                 else:
                     self.ui.log_text.append("Error: One or more images could not be read!")
@@ -71,46 +165,34 @@ class FP_to_CP(QtWidgets.QMainWindow):
                 self,
                 "Select ALOS-PALSAR Image",
                 "",
-                "ALOS-PALSAR Files (VOL-ALPSRP*.1__A)"
+                "ALOS-PALSAR Files (VOL-ALPSRP*.1__A VOL-ALOS2*.1__A)"
             )
             
             if filepath:
                 self.ui.log_text.append(f"Selected ALOS-PALSAR file: {filepath}")
                 
-                palsar = gdal.Open(filepath)
-                if palsar is not None:
+                # CEOS products are read natively from the IMG file of every polarization
+                try:
+                    product = read_ceos_product(filepath)
+                except (OSError, ValueError) as e:
+                    self.ui.log_text.append(f"Error: {e}")
+                    product = None
+
+                if product is not None:
                     self.paths = {'HH': filepath}
-                    self.ui.log_text.append("ALOS-PALSAR image loaded successfully")
-                    
-                    number_of_cols = palsar.RasterXSize
-                    number_of_rows = palsar.RasterYSize
-                    number_of_bands = palsar.RasterCount
+                    # Read from the leader file once, with the product
+                    self.calibration_factor = product["calibration_factor"]
+                    self.ui.log_text.append(f"{product['satellite']} PALSAR image loaded successfully")
+                    for key, full_path in product["paths"].items():
+                        self.ui.log_text.append(f"{key}: {full_path}")
                     
+                    number_of_rows, number_of_cols = product["shape"]
                     self.ui.log_text.append(f"Image dimensions: {number_of_rows} rows, {number_of_cols} columns")
-                    self.ui.log_text.append(f"Number of bands: {number_of_bands}")
-                    
-                    if number_of_bands >= 4:
-                        HH = palsar.GetRasterBand(1)
-                        HV = palsar.GetRasterBand(2)
-                        VH = palsar.GetRasterBand(3)
-                        VV = palsar.GetRasterBand(4)
-                        
-                        self.image_array = {
-                            "HH": HH.ReadAsArray(),
-                            "HV": HV.ReadAsArray(),
-                            "VH": VH.ReadAsArray(),
-                            "VV": VV.ReadAsArray()
-                        }
-                        
-                        self.ui.log_text.append("ALOS-PALSAR images read successfully")
-                        self.images_loaded = True
-                        
-                        row, column = self.image_array["HH"].shape
-                        self.ui.log_text.append(f"Band dimensions: {row} rows, {column} columns")
-                    else:
-                        self.ui.log_text.append("Error: The selected file does not contain the required 4 bands (HH, HV, VH, VV).")
+                    self.ui.log_text.append("ALOS-PALSAR images opened successfully")
+                    self.sensor = "ALOS"
+                    self.images_loaded = True
                 else:
-                    self.ui.log_text.append("Error: Unable to open the selected ALOS-PALSAR file.")
+                    self.ui.log_text.append("Error: Unable to open the selected ALOS-PALSAR product.")
         
     def calibration(self):
         if not self.images_loaded:
@@ -120,7 +202,26 @@ class FP_to_CP(QtWidgets.QMainWindow):
         RADARSAT2 = self.ui.radarsat2.isChecked()
         alos_palsar = self.ui.alosPalsar.isChecked()
         
-        if RADARSAT2:
+        if RADARSAT2 and self.product is not None:
+            if not self.product["luts"]:
+                QMessageBox.warning(self, "Warning", "The product lists no calibration LUT!")
+                return
+            lut_type, ok = QInputDialog.getItem(
+                self, "Calibration", "Calibrate to:", list(self.product["luts"]), 0, False
+            )
+            if not ok:
+                return
+            try:
+                self.calibration_spec = product_calibration(self.product, lut_type)
+            except (OSError, ValueError) as e:
+                self.ui.log_text.append(f"Failed to load LUT: {e}")
+                return
+
+            self.ui.log_text.append(f"{LUT_TYPES[lut_type][0]} LUT of the product loaded successfully.")
+            self.ui.log_text.append("RADARSAT-2 Calibration will be applied on bands tile by tile")
+            self.calibration_done = True
+
+        elif RADARSAT2:
             xml_file, _ = QFileDialog.getOpenFileName(
                 self, "Select Calibration XML File", "", "XML Files (*.xml)"
             )
@@ -130,36 +231,30 @@ class FP_to_CP(QtWidgets.QMainWindow):
                 return
             
             self.ui.log_text.append(f"Selected Calibration XML: {xml_file}")
-            offset, gains = gains_offset_reader_xml(xml_file)
-            if offset is None or gains is None:
+            # Gains are applied per tile during simulation, no full-scene copies are kept
+            self.calibration_spec = load_calibration("RADARSAT2", xml_file)
+            if self.calibration_spec is None:
                 self.ui.log_text.append("Failed to load LUT. Calibration aborted.")
                 return
 
             self.ui.log_text.append("Look-Up Table (LUT) for RADARSAT-2 calibration loaded successfully.")
             
-            HH_array, HV_array, VH_array, VV_array = self.image_array.values()
-            rows, _ = HH_array.shape[1:3]
-            
-            self.I_HH_cal, self.Q_HH_cal = Radarsat2_calibration(HH_array, gains, offset, rows)
-            self.I_HV_cal, self.Q_HV_cal = Radarsat2_calibration(HV_array, gains, offset, rows)
-            self.I_VH_cal, self.Q_VH_cal = Radarsat2_calibration(VH_array, gains, offset, rows)
-            self.I_VV_cal, self.Q_VV_cal = Radarsat2_calibration(VV_array, gains, offset, rows)
-            
-            self.ui.log_text.append("RADARSAT-2 Calibration successfully applied on bands")
+            self.ui.log_text.append("RADARSAT-2 Calibration will be applied on bands tile by tile")
             self.calibration_done = True
 
         elif alos_palsar:
-            CF, CF_offset = -83, 32
-            const = db_to_linear_scale(CF - CF_offset)
-            
-            HH_array, HV_array, VH_array, VV_array = self.image_array.values()
-            
-            self.I_HH_cal, self.Q_HH_cal, _, _ = ALOS_calibration(HH_array, const)
-            self.I_HV_cal, self.Q_HV_cal, _, _ = ALOS_calibration(HV_array, const)
-            self.I_VH_cal, self.Q_VH_cal, _, _ = ALOS_calibration(VH_array, const)
-            self.I_VV_cal, self.Q_VV_cal, _, _ = ALOS_calibration(VV_array, const)
+            if self.sensor != "ALOS":
+                QMessageBox.warning(self, "Warning", "Please import an ALOS-PALSAR product before calibration!")
+                return
+            # The leader file is optional, the default CF is used without it
+            CF = self.calibration_factor
+            if CF is None:
+                self.ui.log_text.append(f"No calibration factor in the leader file; using CF = {DEFAULT_CALIBRATION_FACTOR} dB")
+            else:
+                self.ui.log_text.append(f"Calibration factor from the leader file: CF = {CF} dB")
+            self.calibration_spec = alos_calibration(CF)
             
-            self.ui.log_text.append("ALOS PALSAR Calibration successfully applied on bands")
+            self.ui.log_text.append("ALOS PALSAR Calibration will be applied on bands tile by tile")
             self.calibration_done = True
 
         
@@ -172,60 +267,167 @@ class FP_to_CP(QtWidgets.QMainWindow):
             QMessageBox.warning(self, "Error", "Please perform calibration before simulation!")
             return
 
-        S11, S12, S22 = FP_scattering_matrix(self.I_HH_cal, self.Q_HH_cal, self.I_HV_cal, self.Q_HV_cal,
-                                            self.I_VH_cal, self.Q_VH_cal, self.I_VV_cal, self.Q_VV_cal)
-        RHV_mode = self.ui.RHV.isChecked()
-        LHV_mode = self.ui.LHV.isChecked()
-        pi4_mode = self.ui.PI4.isChecked()
+        modes = [mode for mode, selected in (("RHV", self.ui.RHV.isChecked()),
+                                             ("LHV", self.ui.LHV.isChecked()),
+                                             ("pi4", self.ui.PI4.isChecked())) if selected]
+        if self.ui.Ellipse.isChecked():
+            modes.append(ellipse_mode(self.ui.ellipse_orientation.value(), self.ui.ellipse_ellipticity.value()))
         
-        scattering_selected = self.ui.Scattering.isChecked()
-        covariance_selected = self.ui.Covariance.isChecked()
+        features = {
+            "scattering": self.ui.Scattering.isChecked(),
+            "covariance": self.ui.Covariance.isChecked(),
+            "stokes": self.ui.Stokes.isChecked(),
+            "dop": self.ui.DoP.isChecked(),
+            "m_chi": self.ui.MChi.isChecked(),
+            "m_delta": self.ui.MDelta.isChecked(),
+            "ratio": self.ui.Ratio.isChecked(),
+        }
         
-        if not (RHV_mode or LHV_mode or pi4_mode):
-            QMessageBox.warning(self, "Error", "Please select one of the simulation modes (RHV, LHV, or Pi/4).")
+        if not modes:
+            QMessageBox.warning(self, "Error", "Please select at least one simulation mode (RHV, LHV, Pi/4 or a custom ellipse).")
             return
 
-        if not (scattering_selected or covariance_selected):
-            QMessageBox.warning(self, "Error", "Please select at least one feature (Scattering vector or Covariance matrix).")
+        if not any(features.values()):
+            QMessageBox.warning(self, "Error", "Please select at least one feature to generate.")
             return
-        
-        S11_C, S21_C = None, None
-        C11, C12, C22 = None, None, None
-        folder_name = ""
-
-        if RHV_mode:
-            folder_name = "_RHV"
-            S11_C, S21_C = RHV_simulator(S11, S12, S22)
-        elif LHV_mode:
-            folder_name = "_LHV"
-            S11_C, S21_C = LHV_simulator(S11, S12, S22)
-        elif pi4_mode:
-            folder_name = "_pi4"
-            S11_C, S21_C = pi4_simulator(S11, S12, S22)
-
-        if covariance_selected:
-            self.ui.log_text.append("Covariance matrix selected. Processing...")
-            C11, C12, C22 = covariance_matrix_function(S11_C, S21_C)
-                
-        if scattering_selected:
-            folder_s = "S2" + folder_name
-            os.makedirs(folder_s, exist_ok=True)
-            self.ui.log_text.append(f"Saving scattering vector results to '{folder_s}' folder...")
-            save_single_band_tif(os.path.join(folder_s, "S11_real.tif"), S11_C.real, self.paths['HH'])
-            save_single_band_tif(os.path.join(folder_s, "S11_imag.tif"), S11_C.imag, self.paths['HH'])
-            save_single_band_tif(os.path.join(folder_s, "S21_real.tif"), S21_C.real, self.paths['HH'])
-            save_single_band_tif(os.path.join(folder_s, "S21_imag.tif"), S21_C.imag, self.paths['HH'])
-
-        if covariance_selected:
-            folder_c = "C2" + folder_name
-            os.makedirs(folder_c, exist_ok=True)
-            self.ui.log_text.append(f"Saving covariance matrix results to '{folder_c}' folder...")
-            save_single_band_tif(os.path.join(folder_c, "C11.tif"), C11, self.paths['HH'])
-            save_single_band_tif(os.path.join(folder_c, "C12_real.tif"), C12.real, self.paths['HH'])
-            save_single_band_tif(os.path.join(folder_c, "C12_imag.tif"), C12.imag, self.paths['HH'])
-            save_single_band_tif(os.path.join(folder_c, "C22.tif"), C22, self.paths['HH'])
-            
-        self.ui.log_text.append("Simulation completed successfully. Results have been saved.")
+
+        if (features["m_chi"] or features["m_delta"]) and not set(modes) <= {"RHV", "LHV"}:
+            QMessageBox.warning(self, "Error", "The m-chi and m-delta decompositions need the RHV or LHV mode only.")
+            return
+
+        region = self.region_spec()
+        if region is False:
+            QMessageBox.warning(self, "Error", "The region must be 'column row width height' or a GeoJSON AOI file.")
+            return
+
+        products = [product for product, selected in features.items() if selected]
+        for mode in modes:
+            for product in products:
+                prefix, _ = PRODUCTS[product]
+                self.ui.log_text.append(f"Saving {product} results to '{prefix}_{mode}'...")
+
+        tile_size = self.ui.tile_size.value()
+        workers = self.ui.workers.value()
+        if not workers:
+            # Every worker holds its tiles and scratch buffers, so only as many as fit in memory
+            available = available_memory()
+            workers = fitting_workers(make_job(self.sensor, None, modes, products), tile_size,
+                                      memory=available // 2 if available else None)
+        self.ui.log_text.append(f"Processing tiles of {tile_size} x {tile_size} pixels with {workers} worker(s).")
+
+        cache = ScatteringCache() if self.ui.use_cache.isChecked() else None
+        self.worker = ProcessingThread(self.paths, self.sensor, self.calibration_spec, modes, products,
+                                       tile_size=tile_size, workers=workers, cache=cache, region=region)
+        self.worker.message.connect(self.ui.log_text.append)
+        self.worker.progress.connect(self.update_progress)
+        self.worker.completed.connect(
+            lambda: self.ui.log_text.append("Simulation completed successfully. Results have been saved."))
+        self.worker.cancelled.connect(lambda: self.ui.log_text.append("Simulation cancelled."))
+        self.worker.failed.connect(lambda error: QMessageBox.critical(self, "Error", f"Simulation failed: {error}"))
+        self.worker.finished.connect(self.processing_finished)
+
+        self.ui.progress_bar.setValue(0)
+        self.set_running(True)
+        self.worker.start()
+
+    def show_preview(self):
+        if not self.images_loaded or not self.calibration_done:
+            QMessageBox.warning(self, "Error", "Please import and calibrate the images first!")
+            return
+
+        modes = [mode for mode, selected in (("RHV", self.ui.RHV.isChecked()),
+                                             ("LHV", self.ui.LHV.isChecked()),
+                                             ("pi4", self.ui.PI4.isChecked())) if selected]
+        if self.ui.Ellipse.isChecked():
+            modes.append(ellipse_mode(self.ui.ellipse_orientation.value(), self.ui.ellipse_ellipticity.value()))
+        mode = modes[0] if modes else "RHV"
+
+        self.ui.log_text.append("Computing the preview...")
+        self.preview_worker = PreviewThread(self.paths, self.sensor, self.calibration_spec, mode)
+        self.preview_worker.completed.connect(self.preview_finished)
+        self.preview_worker.failed.connect(lambda error: QMessageBox.critical(self, "Error", f"Preview failed: {error}"))
+        self.preview_worker.finished.connect(lambda: self.ui.Preview.setEnabled(self.worker is None))
+        self.ui.Preview.setEnabled(False)
+        self.preview_worker.start()
+
+    def preview_finished(self, result):
+        for problem in result["problems"]:
+            self.ui.log_text.append(f"Warning: {problem}")
+        if not result["problems"]:
+            self.ui.log_text.append("Input checks passed.")
+
+        rgb = result["rgb"]
+        rows, columns, _ = rgb.shape
+        data = rgb.tobytes()
+        image = QImage(data, columns, rows, 3 * columns, QImage.Format.Format_RGB888)
+        dialog = QDialog(self)
+        dialog.setWindowTitle(f"Preview (decimated by {result['step']})")
+        layout = QVBoxLayout(dialog)
+        label = QLabel()
+        # QImage doesn't copy the buffer; the pixmap does
+        label.setPixmap(QPixmap.fromImage(image))
+        layout.addWidget(label)
+        dialog.show()
+
+    def select_aoi(self):
+        aoi_file, _ = QFileDialog.getOpenFileName(
+            self, "Select AOI Polygon", "", "GeoJSON Files (*.geojson *.json)"
+        )
+        if aoi_file:
+            self.ui.region.setText(aoi_file)
+
+    def region_spec(self):
+        # run_tiled region of the region field: None (whole scene), a pixel window, an AOI file,
+        # or False when the text is neither
+        text = self.ui.region.text().strip()
+        if not text:
+            return None
+        values = text.replace(",", " ").split()
+        if len(values) == 4 and all(value.isdigit() for value in values):
+            return {"window": [int(value) for value in values]}
+        if os.path.isfile(text):
+            return {"polygon": text}
+        return False
+
+    def update_progress(self, done, total):
+        self.ui.progress_bar.setMaximum(total)
+        self.ui.progress_bar.setValue(done)
+
+    def toggle_stage_stats(self, visible):
+        self.ui.stage_stats.setVisible(visible)
+        self.update_stage_stats()
+
+    def update_stage_stats(self):
+        if self.worker is not None and self.ui.show_stats.isChecked():
+            self.ui.stage_stats.setText(self.worker.metrics.summary())
+
+    def cancel_processing(self):
+        if self.worker is not None:
+            self.ui.log_text.append("Cancelling after the tiles in progress...")
+            self.ui.Cancel.setEnabled(False)
+            self.worker.cancel()
+
+    def processing_finished(self):
+        self.update_stage_stats()
+        self.worker = None
+        self.set_running(False)
+
+    def set_running(self, running):
+        for button in (self.ui.FP_image_reader, self.ui.lut_file, self.ui.Convert_to_CP, self.ui.Preview,
+                       self.ui.region_file):
+            button.setEnabled(not running)
+        self.ui.Cancel.setEnabled(running)
+        if running:
+            self.stats_timer.start()
+        else:
+            self.stats_timer.stop()
+
+    def closeEvent(self, event):
+        # Let a running simulation stop at a tile boundary so no output is left half written
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+        super(FP_to_CP, self).closeEvent(event)
     
 def main():
     app = QApplication(sys.argv)
@@ -0,0 +1,210 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+REPORT_FILE = "run_report.json"
+
+# Stages of a run in pipeline order. The tile kernels are fused, so "calibrate" covers the
+# calibration and the FP scattering matrix, and "synthesize" the simulator and the covariance matrix.
+# The chunked (dask) backend only sees "compute", its whole task graph up to the encoding
+STAGES = ["read", "cache_read", "calibrate", "synthesize", "multilook", "derived", "encode", "compute", "write",
+          "cache_write", "checkpoint", "finalize"]
+
+
+def reset_peak_rss():
+    # Linux resets the VmHWM high-water mark when 5 is written to clear_refs
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def getrusage(who):
+    # resource.getrusage(RUSAGE_<who>), or None where the resource module is missing (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(getattr(resource, f"RUSAGE_{who}"))
+
+
+def peak_rss():
+    # Peak resident set size in bytes, since the last reset_peak_rss where supported;
+    # None when it can't be measured
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    usage = getrusage("SELF")
+    if usage is None:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        # Peak working set on Windows
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    scale = 1 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss * scale
+
+
+def children_peak_rss():
+    # Largest peak RSS of the terminated worker processes, or None
+    usage = getrusage("CHILDREN")
+    if usage is None:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss * scale
+
+
+def available_memory():
+    # Bytes of memory available to new allocations without swapping, or None when unknown
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.virtual_memory().available
+
+
+def format_megabytes(size, digits=0):
+    return "n/a" if size is None else f"{size / 2**20:.{digits}f} MB"
+
+
+class StageTimer:
+    # Calls, seconds, bytes and pixels per stage. A few perf_counter calls per tile,
+    # cheap enough to always be on. Plain dicts, so that the stages timed in a worker
+    # process can be sent back and merged
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds, nbytes=0, pixels=0):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = {"calls": 0, "seconds": 0.0, "bytes": 0, "pixels": 0}
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+        entry["bytes"] += nbytes
+        entry["pixels"] += pixels
+
+    @contextmanager
+    def stage(self, name, nbytes=0, pixels=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, nbytes, pixels)
+
+    def merge(self, stages):
+        for name, entry in stages.items():
+            total = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "bytes": 0, "pixels": 0})
+            for key, value in entry.items():
+                total[key] += value
+
+
+class RunMetrics(StageTimer):
+    # Stage totals of a whole run, updated by the thread that drives it and read by others
+    # (e.g. a GUI timer). Seconds of the tile stages are summed over the workers, so with
+    # several workers they can add up to more than the elapsed time
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.started = None
+        self.finished = None
+        self.tiles_total = 0
+        self.tiles_done = 0
+        self.tiles_resumed = 0
+
+    def start(self, tiles_total, tiles_resumed=0):
+        # tiles_resumed tiles were done by an earlier run and count as done
+        with self.lock:
+            self.started = time.perf_counter()
+            self.finished = None
+            self.tiles_total = tiles_total
+            self.tiles_done = tiles_resumed
+            self.tiles_resumed = tiles_resumed
+
+    def tile_done(self):
+        with self.lock:
+            self.tiles_done += 1
+
+    def finish(self):
+        with self.lock:
+            self.finished = time.perf_counter()
+
+    def add(self, name, seconds, nbytes=0, pixels=0):
+        with self.lock:
+            super().add(name, seconds, nbytes, pixels)
+
+    def merge(self, stages):
+        with self.lock:
+            super().merge(stages)
+
+    def snapshot(self):
+        with self.lock:
+            if self.started is None:
+                elapsed = 0.0
+            else:
+                elapsed = (self.finished or time.perf_counter()) - self.started
+            order = {name: index for index, name in enumerate(STAGES)}
+            stages = {}
+            for name in sorted(self.stages, key=lambda name: (order.get(name, len(order)), name)):
+                entry = dict(self.stages[name])
+                seconds = entry["seconds"]
+                entry["megabytes_per_s"] = entry["bytes"] / 2**20 / seconds if seconds else 0.0
+                entry["megapixels_per_s"] = entry["pixels"] / 1e6 / seconds if seconds else 0.0
+                stages[name] = entry
+            return {
+                "elapsed_seconds": elapsed,
+                "tiles_done": self.tiles_done,
+                "tiles_total": self.tiles_total,
+                "tiles_resumed": self.tiles_resumed,
+                "peak_rss_bytes": peak_rss(),
+                "peak_rss_children_bytes": children_peak_rss(),
+                "stages": stages,
+            }
+
+    def summary(self):
+        # One line per stage, for logs and the GUI
+        snapshot = self.snapshot()
+        resumed = f" ({snapshot['tiles_resumed']} resumed)" if snapshot["tiles_resumed"] else ""
+        lines = [f"{snapshot['tiles_done']}/{snapshot['tiles_total']} tiles{resumed} in "
+                 f"{snapshot['elapsed_seconds']:.1f} s, peak RSS {format_megabytes(snapshot['peak_rss_bytes'])}"]
+        for name, entry in snapshot["stages"].items():
+            line = f"  {name:<12} {entry['seconds']:8.2f} s"
+            if entry["pixels"]:
+                line += f" {entry['megapixels_per_s']:8.1f} MP/s"
+            if entry["bytes"]:
+                line += f" {entry['bytes'] / 2**20:10.1f} MB"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def write_report(self, path, **info):
+        # JSON report of the run: info (parameters, status, outputs) and the stage totals
+        report = dict(info, **self.snapshot())
+        report["date"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        staging_path = f"{path}.tmp"
+        with open(staging_path, "w") as file:
+            json.dump(report, file, indent=2, default=str)
+        os.replace(staging_path, path)
+        return report
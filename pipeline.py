@@ -0,0 +1,818 @@
+import os
+import queue
+import threading
+import time
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+from functions import *
+from cache import CACHE_BANDS
+from metrics import REPORT_FILE, RunMetrics, StageTimer
+from ceos import (CeosImageReader, DEFAULT_CALIBRATION_FACTOR, calibration_constant, ceos_meta, product_files,
+                  read_calibration_factor)
+from radarsat2 import read_lut
+from readers import RasterReader, RegionReader, touch_pages
+from region import intersecting_plans, resolve_region, scene_georeference
+from writers import OUTPUT_FORMATS, PRODUCTS, SCATTERING_BANDS, GeoTiffWriter, ZarrWriter
+
+POLARIZATIONS = ["HH", "HV", "VH", "VV"]
+
+SIMULATORS = {
+    "RHV": RHV_simulator,
+    "LHV": LHV_simulator,
+    "pi4": pi4_simulator,
+}
+
+ELLIPSE_PREFIX = "ellipse_"
+
+# Output name of the calibrated FP matrix written to the scattering cache
+FP_CACHE = "fp_cache"
+
+DEFAULT_TILE_SIZE = 1024
+
+# Seconds between flushes of the outputs when completed tiles are journaled
+CHECKPOINT_INTERVAL = 30
+
+# Tiles queued between the read, compute and write stages of a pipelined run
+DEFAULT_PREFETCH = 2
+
+
+class ProcessingCancelled(Exception):
+    pass
+
+# Working precisions of the tile kernel; "reference" keeps the promotion of the original functions
+PRECISIONS = {
+    "reference": None,
+    "float32": np.float32,
+}
+
+OUTPUT_DTYPES = ["float32", "float16", "int16"]
+
+DEFAULT_INT16_SCALE = 1e-4
+
+SPECKLE_FILTERS = [None, "boxcar", "refined_lee"]
+
+# Products derived from C2 in the same tile pass
+DERIVED_PRODUCTS = ["stokes", "dop", "m_chi", "m_delta", "ratio"]
+
+# Sense of the transmitted circular polarization, for the m-chi and m-delta decompositions
+CHIRALITY = {"RHV": 1, "LHV": -1}
+
+
+def tile_windows(rows, columns, tile_size=DEFAULT_TILE_SIZE):
+    for row_off in range(0, rows, tile_size):
+        for col_off in range(0, columns, tile_size):
+            height = min(tile_size, rows - row_off)
+            width = min(tile_size, columns - col_off)
+            yield Window(col_off, row_off, width, height)
+
+
+def multilooked_shape(rows, columns, looks=(1, 1)):
+    return -(-rows // looks[0]), -(-columns // looks[1])
+
+
+def tile_plans(rows, columns, tile_size=DEFAULT_TILE_SIZE, looks=(1, 1), halo=0):
+    # Tiles are laid out on the multilooked grid. Each plan holds the input window to read,
+    # the full resolution window of the tile itself ("core", where the scattering vector goes)
+    # and its multilooked window ("out", where C2 goes). The read window carries `halo`
+    # multilooked pixels on every side for the speckle filter.
+    # Without looks and halo, read, core and out are the same window.
+    looks_rows, looks_cols = looks
+    out_rows, out_cols = multilooked_shape(rows, columns, looks)
+    tile_rows, tile_cols = max(1, tile_size // looks_rows), max(1, tile_size // looks_cols)
+
+    for out_row in range(0, out_rows, tile_rows):
+        for out_col in range(0, out_cols, tile_cols):
+            out = Window(out_col, out_row, min(tile_cols, out_cols - out_col), min(tile_rows, out_rows - out_row))
+            first_row, first_col = max(0, out_row - halo), max(0, out_col - halo)
+            last_row = min(out_rows, out_row + out.height + halo)
+            last_col = min(out_cols, out_col + out.width + halo)
+
+            read = Window(first_col * looks_cols, first_row * looks_rows,
+                          min(last_col * looks_cols, columns) - first_col * looks_cols,
+                          min(last_row * looks_rows, rows) - first_row * looks_rows)
+            core_row, core_col = out_row * looks_rows, out_col * looks_cols
+            core = Window(core_col, core_row,
+                          min((out_col + out.width) * looks_cols, columns) - core_col,
+                          min((out_row + out.height) * looks_rows, rows) - core_row)
+            yield {
+                "read": read,
+                "core": core,
+                "out": out,
+                "core_offset": (core.row_off - read.row_off, core.col_off - read.col_off),
+                "out_offset": (out_row - first_row, out_col - first_col),
+            }
+
+
+def input_bands(paths, sensor):
+    # RADARSAT-2 ships one I/Q GeoTIFF per polarization. ALOS-PALSAR is read from the
+    # CEOS image file of every polarization next to the given VOL/LED/IMG file, or else
+    # through GDAL from a raster holding a complex band per polarization
+    if sensor == "RADARSAT2":
+        return {pol: (paths[pol], None) for pol in POLARIZATIONS}
+    files = product_files(paths["HH"])
+    if files is not None:
+        return {pol: (files["paths"][pol], None) for pol in POLARIZATIONS}
+    return {pol: (paths["HH"], index + 1) for index, pol in enumerate(POLARIZATIONS)}
+
+
+def open_reader(path, band, sensor, memmap=True):
+    if sensor == "ALOS" and band is None:
+        return CeosImageReader(path, memmap=memmap)
+    return RasterReader(path, band, memmap=memmap)
+
+
+def load_calibration(sensor, path=None):
+    # Per-scene calibration parameters, applied tile by tile in calibrate_tile.
+    # path is the LUT of RADARSAT-2, and any file of the product for ALOS-PALSAR
+    if sensor == "RADARSAT2":
+        try:
+            offset, gains = read_lut(path)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return None
+        return {"offset": offset, "gains": gains}
+
+    # The calibration factor of the product is in its leader file
+    files = product_files(path) if path else None
+    CF = None
+    if files is not None and files["leader"] is not None:
+        CF = read_calibration_factor(files["leader"])
+    return alos_calibration(CF)
+
+
+def alos_calibration(calibration_factor=None):
+    # Calibration of an ALOS-PALSAR product from its CF in dB, e.g. the one read_product found
+    # in the leader file; the default CF without one
+    if calibration_factor is None:
+        calibration_factor = DEFAULT_CALIBRATION_FACTOR
+    return {"const": calibration_constant(calibration_factor)}
+
+
+def scene_shape(paths, sensor):
+    path, band = input_bands(paths, sensor)["HH"]
+    with open_reader(path, band, sensor, memmap=False) as reader:
+        return reader.shape
+
+
+def output_meta(paths, sensor):
+    # Profile of the outputs: the input raster's, or the size of the CEOS image files
+    path, band = input_bands(paths, sensor)["HH"]
+    if sensor == "ALOS" and band is None:
+        return ceos_meta(path)
+    return reference_meta(paths["HH"])
+
+
+def open_inputs(paths, sensor, memmap=True):
+    # One lazy reader per polarization; only headers are read here
+    readers = {}
+    try:
+        for pol, (path, band) in input_bands(paths, sensor).items():
+            readers[pol] = open_reader(path, band, sensor, memmap=memmap)
+    except Exception:
+        for reader in readers.values():
+            reader.close()
+        raise
+    return readers
+
+
+def read_tile(readers, window, metrics=None, touch=False):
+    # Memory-mapped inputs come back as views; their pages are only read when
+    # the kernel touches them, i.e. in the worker that processes the tile (the "read"
+    # stage then only counts the bytes), unless touch faults them in here.
+    # The readers are the polarizations, or the S11/S12/S22 bands of a cache entry
+    start = time.perf_counter()
+    tile = {name: reader.read(window) for name, reader in readers.items()}
+    if touch:
+        for name, reader in readers.items():
+            if reader.memory_mapped:
+                touch_pages(tile[name])
+    if metrics is not None:
+        metrics.add("read", time.perf_counter() - start, sum(data.nbytes for data in tile.values()),
+                    window.width * window.height)
+    return tile
+
+
+def write_outputs(writers, outputs, metrics=None):
+    for name, window, results in outputs:
+        start = time.perf_counter()
+        writers[name].write(results, window)
+        if metrics is not None:
+            metrics.add("cache_write" if name == FP_CACHE else "write", time.perf_counter() - start,
+                        sum(data.nbytes for data in results.values()), window.width * window.height)
+
+
+def working_dtype(paths, sensor, calibration, precision="reference"):
+    # Complex dtype of the FP matrix computed by fp_scattering_kernel for these inputs
+    path, band = input_bands(paths, sensor)["HH"]
+    with open_reader(path, band, sensor, memmap=False) as reader:
+        IQ_dtype = reader.dtype
+    if sensor == "RADARSAT2":
+        dtype = fp_working_dtype(IQ_dtype, gains=calibration["gains"], offset=calibration["offset"],
+                                 dtype=PRECISIONS[precision])
+    else:
+        dtype = fp_working_dtype(IQ_dtype, const=calibration["const"], dtype=PRECISIONS[precision])
+    return np.result_type(dtype, 1j)
+
+
+def calibrate_tile(tile, sensor, calibration, window):
+    calibrated = {}
+    for pol in POLARIZATIONS:
+        if sensor == "RADARSAT2":
+            # Only the LUT columns covered by this tile are needed
+            gains = calibration["gains"][window.col_off:window.col_off + window.width]
+            I_cal, Q_cal = Radarsat2_calibration(tile[pol], gains, calibration["offset"], window.height)
+        else:
+            I_cal, Q_cal = ALOS_calibration(tile[pol], calibration["const"])[:2]
+
+        if I_cal is None:
+            raise ValueError(f"Calibration failed for {pol} tile at row {window.row_off}, column {window.col_off}.")
+        calibrated[pol] = (I_cal, Q_cal)
+    return calibrated
+
+
+def ellipse_mode(orientation, ellipticity):
+    # Mode name of an arbitrary transmitted ellipse (angles in degrees), also used for its output folders
+    return f"{ELLIPSE_PREFIX}{orientation:g}_{ellipticity:g}"
+
+
+def kernel_mode(mode):
+    # The mode as cp_synthesis_kernel takes it: a simulator name or (orientation, ellipticity)
+    if mode in SIMULATORS:
+        return mode
+    try:
+        if not mode.startswith(ELLIPSE_PREFIX):
+            raise ValueError
+        orientation, ellipticity = (float(angle) for angle in mode[len(ELLIPSE_PREFIX):].split("_"))
+    except ValueError:
+        raise ValueError(f"Unknown simulation mode: {mode}") from None
+    if not (-90 <= orientation <= 90 and -45 <= ellipticity <= 45):
+        raise ValueError(f"Ellipse angles out of range (orientation -90..90, ellipticity -45..45): {mode}")
+    return orientation, ellipticity
+
+
+def process_tile_reference(tile, window, job, mode):
+    # Stage by stage chain of the original functions, kept as the numerical reference
+    calibrated = calibrate_tile(tile, job["sensor"], job["calibration"], window)
+    S11, S12, S22 = FP_scattering_matrix(*calibrated["HH"], *calibrated["HV"],
+                                         *calibrated["VH"], *calibrated["VV"])
+    if mode in SIMULATORS:
+        S11_C, S21_C = SIMULATORS[mode](S11, S12, S22)
+    else:
+        S11_C, S21_C = ellipse_simulator(S11, S12, S22, *kernel_mode(mode))
+
+    bands = {}
+    if "scattering" in job["products"]:
+        bands.update({
+            "S11_real": S11_C.real,
+            "S11_imag": S11_C.imag,
+            "S21_real": S21_C.real,
+            "S21_imag": S21_C.imag,
+        })
+    if "covariance" in job["products"]:
+        C11, C12, C22 = covariance_matrix_function(S11_C, S21_C)
+        bands.update({
+            "C11": C11,
+            "C12_real": C12.real,
+            "C12_imag": C12.imag,
+            "C22": C22,
+        })
+    return bands
+
+
+# Scratch buffers of the tile kernels, one set per worker thread
+_scratch = threading.local()
+
+
+def make_job(sensor, calibration, mode, products, precision="reference", output_dtype="float32",
+             int16_scale=DEFAULT_INT16_SCALE, looks=(1, 1), speckle_filter=None, filter_size=7):
+    # Everything process_tile needs besides the tile itself; plain values so it pickles for process pools.
+    # mode is a mode name or a list of them, all synthesized from the same read
+    modes = [mode] if isinstance(mode, str) else list(mode)
+    if not modes or len(set(modes)) != len(modes):
+        raise ValueError("Select at least one simulation mode, each only once.")
+    for name in modes:
+        kernel_mode(name)
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}")
+    if output_dtype not in OUTPUT_DTYPES:
+        raise ValueError(f"Unknown output dtype: {output_dtype}")
+    if speckle_filter not in SPECKLE_FILTERS:
+        raise ValueError(f"Unknown speckle filter: {speckle_filter}")
+    if min(looks) < 1:
+        raise ValueError("The number of looks must be at least 1.")
+    if any(name not in CHIRALITY for name in modes) and ("m_chi" in products or "m_delta" in products):
+        raise ValueError("The m-chi and m-delta decompositions need a circular transmit mode (RHV or LHV).")
+    return {
+        "sensor": sensor,
+        "calibration": calibration,
+        "modes": modes,
+        "products": list(products),
+        "precision": precision,
+        "output_dtype": output_dtype,
+        "int16_scale": int16_scale,
+        "looks": tuple(looks),
+        "speckle_filter": speckle_filter,
+        "filter_size": filter_size,
+        "fill_cache": False,
+    }
+
+
+def filter_halo(job):
+    # Multilooked pixels needed around a tile so that filtering gives the same result as on the full scene
+    return job["filter_size"] // 2 if job["speckle_filter"] else 0
+
+
+def crop(data, offset, window):
+    row, col = offset
+    return data[row:row + window.height, col:col + window.width]
+
+
+def encode_output(data, output_dtype, int16_scale=DEFAULT_INT16_SCALE):
+    if output_dtype == "int16":
+        # Stored value = round(data / scale); the scale is written to the band metadata
+        scaled = np.rint(data / int16_scale)
+        return np.clip(scaled, -32767, 32767).astype(np.int16)
+    if output_dtype == "float16":
+        # Rounded to half precision here; GDAL stores it as a 16 bit Float32 band (NBITS=16)
+        return data.astype(np.float16).astype(np.float32)
+    return data.astype(np.float32)
+
+
+def process_tile(tile, plan, job, timer=None):
+    # Returns (mode, window, bands) triples: per mode, the scattering vector at full
+    # resolution and C2 (and its derived products) on the multilooked grid.
+    # The time of every stage is added to timer (a metrics.StageTimer)
+    if not hasattr(_scratch, "buffers"):
+        _scratch.buffers = {}
+    if timer is None:
+        timer = StageTimer()
+
+    calibration = job["calibration"]
+    dtype = PRECISIONS[job["precision"]]
+    read = plan["read"]
+    pixels = read.width * read.height
+    derived = [product for product in job["products"] if product in DERIVED_PRODUCTS]
+    kernel_products = [product for product in ("scattering", "covariance")
+                       if product in job["products"] or (product == "covariance" and derived)]
+    if "S11" in tile:
+        # Calibrated FP matrix from the scattering cache, copied since the synthesis may work in place
+        with timer.stage("cache_read", sum(tile[name].nbytes for name in CACHE_BANDS), pixels):
+            S11, S12, S22 = (get_buffer(_scratch.buffers, name, tile[name].shape, tile[name].dtype)
+                             for name in CACHE_BANDS)
+            for name, buffer in zip(CACHE_BANDS, (S11, S12, S22)):
+                np.copyto(buffer, tile[name])
+    elif job["sensor"] == "RADARSAT2":
+        raw = [tile[pol] for pol in POLARIZATIONS]
+        gains = calibration["gains"][read.col_off:read.col_off + read.width]
+        with timer.stage("calibrate", sum(data.nbytes for data in raw), pixels):
+            S11, S12, S22 = fp_scattering_kernel(*raw, gains=gains, offset=calibration["offset"],
+                                                 buffers=_scratch.buffers, dtype=dtype)
+    else:
+        raw = [tile[pol] for pol in POLARIZATIONS]
+        with timer.stage("calibrate", sum(data.nbytes for data in raw), pixels):
+            S11, S12, S22 = fp_scattering_kernel(*raw, const=calibration["const"],
+                                                 buffers=_scratch.buffers, dtype=dtype)
+
+    # Results are views of the scratch buffers, which the next mode or tile of this thread overwrites
+    def encode(bands, offset, window):
+        start = time.perf_counter()
+        encoded = {name: encode_output(crop(data, offset, window), job["output_dtype"], job["int16_scale"])
+                   for name, data in bands.items()}
+        timer.add("encode", time.perf_counter() - start, sum(data.nbytes for data in encoded.values()),
+                  window.width * window.height)
+        return encoded
+
+    outputs = []
+    if job["fill_cache"]:
+        fp_matrix = {name: crop(data, plan["core_offset"], plan["core"]).copy()
+                     for name, data in zip(CACHE_BANDS, (S11, S12, S22))}
+        outputs.append((FP_CACHE, plan["core"], fp_matrix))
+
+    for index, mode in enumerate(job["modes"]):
+        # The FP matrix is kept for the next modes; the last one synthesizes in place
+        last = index == len(job["modes"]) - 1
+        with timer.stage("synthesize", pixels=pixels):
+            results = cp_synthesis_kernel(S11, S12, S22, kernel_mode(mode), kernel_products,
+                                          _scratch.buffers, preserve=not last)
+
+        if "scattering" in job["products"]:
+            scattering = {name: results[name] for name in SCATTERING_BANDS}
+            outputs.append((mode, plan["core"], encode(scattering, plan["core_offset"], plan["core"])))
+
+        if "covariance" in kernel_products:
+            C11, C22 = results["C11"], results["C22"]
+            C12_real, C12_imag = results["C12_real"], results["C12_imag"]
+            if job["looks"] != (1, 1) or job["speckle_filter"]:
+                with timer.stage("multilook", pixels=pixels):
+                    C11, C12, C22 = multilook_covariance(C11, C12_real + 1j * C12_imag, C22, job["looks"],
+                                                         job["speckle_filter"], job["filter_size"])
+                C12_real, C12_imag = C12.real, C12.imag
+            covariance = {"C11": C11, "C12_real": C12_real, "C12_imag": C12_imag, "C22": C22}
+
+            bands = {}
+            if "covariance" in job["products"]:
+                bands.update(encode(covariance, plan["out_offset"], plan["out"]))
+            if derived:
+                # Cropped first, so the products are only computed where they are written
+                C11, C12_real, C12_imag, C22 = (crop(data, plan["out_offset"], plan["out"])
+                                                for data in covariance.values())
+                with timer.stage("derived", pixels=C11.size):
+                    products = derived_cp_products(C11, C12_real + 1j * C12_imag, C22, derived,
+                                                   CHIRALITY.get(mode, 1))
+                bands.update(encode(products, (0, 0), plan["out"]))
+            outputs.append((mode, plan["out"], bands))
+    return outputs
+
+
+def timed_process_tile(tile, plan, job):
+    # process_tile with the stage times of this tile, which can come back from a worker process
+    timer = StageTimer()
+    outputs = process_tile(tile, plan, job, timer)
+    return outputs, timer.stages
+
+
+def timed_process_and_write(tile, plan, job, writers):
+    # timed_process_tile for writers that take tiles from any thread or process (ZarrWriter):
+    # the outputs are written where they are computed and only the stage times come back
+    timer = StageTimer()
+    write_outputs(writers, process_tile(tile, plan, job, timer), timer)
+    return [], timer.stages
+
+
+class TileJournal:
+    # Append-only record of the tiles whose outputs are on disk, so that an interrupted
+    # run can resume. The first line is a signature of the run parameters; a journal of
+    # other parameters is started over.
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.done = set()
+        self.pending = []
+        try:
+            with open(path) as file:
+                lines = file.read().splitlines()
+        except OSError:
+            lines = []
+        if lines and lines[0] == signature:
+            self.done = {int(line) for line in lines[1:] if line.strip().isdigit()}
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w") as file:
+                file.write(signature + "\n")
+
+    def record(self, index):
+        self.pending.append(index)
+
+    def commit(self):
+        # Only called once the recorded tiles have been flushed to the outputs
+        if not self.pending:
+            return
+        with open(self.path, "a") as file:
+            file.write("".join(f"{index}\n" for index in self.pending))
+            file.flush()
+            os.fsync(file.fileno())
+        self.done.update(self.pending)
+        self.pending = []
+
+
+class TileProgress:
+    # Counts written tiles for the progress callback, checks for cancellation between tiles
+    # and, with a journal, periodically flushes the writers and journals the written tiles
+
+    def __init__(self, total, progress=None, cancel=None, journal=None, writers=None, metrics=None):
+        self.total = total
+        self.metrics = metrics
+        self.completed = len(journal.done) if journal is not None else 0
+        self.progress = progress
+        self.cancel = cancel
+        self.journal = journal
+        self.writers = writers or {}
+        self.last_checkpoint = time.monotonic()
+
+    def check(self):
+        if self.cancel is not None and self.cancel():
+            raise ProcessingCancelled()
+
+    def done(self, index=None):
+        self.completed += 1
+        if self.metrics is not None:
+            self.metrics.tile_done()
+        if self.journal is not None:
+            self.journal.record(index)
+            if time.monotonic() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+                start = time.perf_counter()
+                for writer in self.writers.values():
+                    writer.checkpoint()
+                self.journal.commit()
+                self.last_checkpoint = time.monotonic()
+                if self.metrics is not None:
+                    self.metrics.add("checkpoint", time.perf_counter() - start)
+        if self.progress is not None:
+            self.progress(self.completed, self.total)
+
+
+def estimate_memory(job, tile_size=DEFAULT_TILE_SIZE, workers=1, prefetch=DEFAULT_PREFETCH):
+    # Approximate peak bytes of run_tiled: the tiles in flight (inputs and encoded outputs)
+    # plus the scratch buffers of every worker
+    halo = filter_halo(job) * max(job["looks"])
+    pixels = (tile_size + 2 * halo) ** 2
+    complex_size = 8 if job["precision"] == "float32" else 16
+    input_size = 16 if job["sensor"] == "RADARSAT2" else 32
+    output_size = 4 * sum(len(PRODUCTS[product][1]) for product in job["products"]) * len(job["modes"])
+    scratch_size = 9 * complex_size
+    in_flight = max(workers, 1) + 2 * max(prefetch, 1)
+    return pixels * (in_flight * (input_size + output_size) + max(workers, 1) * scratch_size)
+
+
+def fitting_workers(job, tile_size=DEFAULT_TILE_SIZE, prefetch=DEFAULT_PREFETCH, memory=None, limit=None):
+    # Most workers, up to limit (by default the CPU count), whose estimate_memory fits in memory
+    # bytes; at least 1. Without memory, limit
+    limit = limit or os.cpu_count() or 1
+    if memory is None:
+        return limit
+    workers = 1
+    while workers < limit and estimate_memory(job, tile_size, workers + 1, prefetch) <= memory:
+        workers += 1
+    return workers
+
+
+def run_tiled(paths, sensor, calibration, mode, products, output_root=".",
+              tile_size=DEFAULT_TILE_SIZE, workers=1, use_processes=False,
+              precision="reference", output_dtype="float32", int16_scale=DEFAULT_INT16_SCALE,
+              layout="single", compress=None, tiled=False, overviews=False, cog=False,
+              looks=(1, 1), speckle_filter=None, filter_size=7, memmap=True, log=print,
+              progress=None, cancel=None, cache=None, journal=None, metrics=None, report=REPORT_FILE,
+              region=None, prefetch=DEFAULT_PREFETCH, output_format="geotiff"):
+    # Streams read -> calibrate -> synthesize -> write one tile at a time, so
+    # peak memory is bounded by tile_size instead of the scene size.
+    # progress(done, total) is called after every written tile; when cancel() returns True
+    # the run stops at the next tile boundary, removes its outputs and raises ProcessingCancelled.
+    # With a ScatteringCache, a scene calibrated before is read from the cache instead of
+    # being calibrated again, and new scenes are added to it.
+    # With a TileJournal, the tiles it records as done are skipped and their outputs are
+    # kept; an interrupted or cancelled run keeps its outputs so that it can be resumed.
+    # The time, bytes and pixels of every stage are collected in metrics (a RunMetrics,
+    # which others may read while the run goes on) and written to the JSON file report,
+    # relative to output_root, when the run ends.
+    # With a region (see region.resolve_region) only that part of the scene is read and written,
+    # with the geotransform shifted to its origin; for a polygon, only the tiles it touches.
+    # Reads, computation and writes overlap in a pipeline with prefetch tiles queued between
+    # them (see run_pipelined); prefetch=0 with a single worker runs them one after another.
+    # output_format "zarr" writes a chunked Zarr store instead of GeoTIFFs (see writers.ZarrWriter)
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    if tile_size < 1:
+        raise ValueError("The tile size must be at least 1 pixel.")
+    # workers=0 runs like a single worker, as it did before the pipeline
+    workers = max(workers, 1)
+    if metrics is None:
+        metrics = RunMetrics()
+    job = make_job(sensor, calibration, mode, products, precision, output_dtype, int16_scale,
+                   looks, speckle_filter, filter_size)
+
+    shape = scene_shape(paths, sensor)
+    rows, columns = shape
+    meta = output_meta(paths, sensor)
+    area = None
+    if region is not None:
+        georeference = None if region.get("window") is not None else scene_georeference(paths["HH"])
+        area = resolve_region(region, shape, georeference, job["looks"])
+        window = area["window"]
+        rows, columns = window.height, window.width
+        meta = dict(meta, width=columns, height=rows, transform=window_transform(window, meta["transform"]))
+        if sensor == "RADARSAT2":
+            # The tiles are addressed from the region origin, and so are the LUT columns
+            gains = calibration["gains"][window.col_off:window.col_off + columns]
+            job["calibration"] = dict(calibration, gains=gains)
+    resumed = journal is not None and bool(journal.done)
+    # One output set per mode
+    if output_format == "zarr":
+        writers = {
+            name: ZarrWriter(output_root, name, products, meta, tile_size, output_dtype, compress,
+                             looks=job["looks"], resume=resumed)
+            for name in job["modes"]
+        }
+    else:
+        writers = {
+            name: GeoTiffWriter(output_root, name, products, paths["HH"], output_dtype, int16_scale,
+                                layout=layout, compress=compress, tiled=tiled, overviews=overviews, cog=cog,
+                                looks=job["looks"], resume=resumed, meta=meta)
+            for name in job["modes"]
+        }
+
+    inputs = None
+    if cache is not None:
+        input_paths = list(dict.fromkeys(path for path, _ in input_bands(paths, sensor).values()))
+        dtype = working_dtype(paths, sensor, calibration, precision)
+        key = cache.key(input_paths, sensor, calibration, dtype)
+        inputs = cache.lookup(key, shape)
+        if inputs is not None:
+            log("Reading the calibrated scattering matrix from the cache.")
+        elif area is None and (journal is None or not journal.done):
+            # A resumed run or a region doesn't compute the whole scene, so it can't fill the cache
+            entry = cache.create(key, shape, dtype)
+            if entry is not None:
+                writers[FP_CACHE] = entry
+                job["fill_cache"] = True
+    if inputs is None:
+        inputs = open_inputs(paths, sensor, memmap)
+    if area is not None:
+        inputs = {name: RegionReader(reader, area["window"]) for name, reader in inputs.items()}
+
+    status = "failed"
+    try:
+        with ExitStack() as stack:
+            for writer in writers.values():
+                stack.enter_context(writer)
+            if "HH" in inputs and all(reader.memory_mapped for reader in inputs.values()):
+                log("Reading the input images memory-mapped.")
+            if area is not None:
+                window = area["window"]
+                log(f"Region of interest: rows {window.row_off}-{window.row_off + rows - 1}, "
+                    f"columns {window.col_off}-{window.col_off + columns - 1} of the {shape[0]} x {shape[1]} scene.")
+            log(f"Processing {rows} x {columns} pixels in tiles of {tile_size} x {tile_size} "
+                f"for {', '.join(job['modes'])}...")
+
+            plans = list(tile_plans(rows, columns, tile_size, job["looks"], filter_halo(job)))
+            if area is not None and area["geometries"]:
+                # Tiles outside the polygon are neither read nor written
+                looks_rows, looks_cols = job["looks"]
+                cell = (max(1, tile_size // looks_rows) * looks_rows, max(1, tile_size // looks_cols) * looks_cols)
+                count = len(plans)
+                plans = intersecting_plans(plans, area, cell)
+                log(f"{len(plans)} of {count} tiles intersect the AOI.")
+            remaining = [(index, plan) for index, plan in enumerate(plans)
+                         if journal is None or index not in journal.done]
+            metrics.start(len(plans), len(plans) - len(remaining))
+            tracker = TileProgress(len(plans), progress, cancel, journal, writers, metrics)
+            if len(remaining) < len(plans):
+                log(f"Resuming: {len(plans) - len(remaining)} of {len(plans)} tiles already done.")
+            if workers <= 1 and prefetch <= 0:
+                for index, plan in remaining:
+                    tracker.check()
+                    tile = read_tile(inputs, plan["read"], metrics)
+                    outputs, stages = timed_process_tile(tile, plan, job)
+                    metrics.merge(stages)
+                    write_outputs(writers, outputs, metrics)
+                    tracker.done(index)
+            else:
+                run_pipelined(remaining, inputs, writers, job, workers, use_processes, tracker, metrics, prefetch)
+            # Closing the writers builds the overviews and COGs
+            start = time.perf_counter()
+    except BaseException as error:
+        if isinstance(error, ProcessingCancelled):
+            status = "cancelled"
+        if journal is not None:
+            # The writers are closed by now, so every recorded tile is on disk
+            journal.commit()
+            if isinstance(error, ProcessingCancelled):
+                log("Processing cancelled; completed tiles are kept for resuming.")
+        elif isinstance(error, ProcessingCancelled):
+            for writer in writers.values():
+                writer.discard()
+            log("Processing cancelled; partial outputs removed.")
+        raise
+    else:
+        status = "completed"
+        metrics.add("finalize", time.perf_counter() - start)
+    finally:
+        for reader in inputs.values():
+            reader.close()
+        metrics.finish()
+        files = [path for name, writer in writers.items() if name != FP_CACHE for path in writer.files]
+        if report:
+            options = {"tile_size": tile_size, "workers": workers, "use_processes": use_processes,
+                       "precision": precision, "output_dtype": output_dtype, "layout": layout,
+                       "compress": compress, "looks": list(job["looks"]), "speckle_filter": speckle_filter,
+                       "filter_size": filter_size, "memmap": memmap, "cache": cache is not None,
+                       "resumed": resumed, "region": region, "prefetch": prefetch,
+                       "output_format": output_format}
+            try:
+                metrics.write_report(os.path.join(output_root, report), status=status, sensor=sensor,
+                                     inputs=paths, shape=[rows, columns], modes=job["modes"],
+                                     window=None if area is None else [area["window"].col_off, area["window"].row_off,
+                                                                       columns, rows],
+                                     products=list(products), options=options,
+                                     outputs=files if status == "completed" else [])
+            except OSError as e:
+                log(f"Could not write the run report: {e}")
+        if status == "completed":
+            log(metrics.summary())
+
+    return files
+
+
+def run_pipelined(plans, inputs, writers, job, workers=1, use_processes=False, tracker=None, metrics=None,
+                  prefetch=DEFAULT_PREFETCH):
+    # Runs the (index, plan) pairs of plans as a producer/consumer pipeline, so that the
+    # disk reads, the computation and the disk writes of different tiles overlap: a reader
+    # thread reads the next tiles into a bounded queue, `workers` compute threads process
+    # them (each through a worker process with use_processes) and a writer thread writes
+    # the results from a second bounded queue. Only the reader thread touches the input
+    # datasets and only the writer thread the outputs; at most 2 * prefetch + workers
+    # tiles are in memory. Writers that take tiles from any thread or process (ZarrWriter)
+    # are written by the compute stage instead, in parallel, and the writer thread only
+    # counts the tiles. The first error, or a cancellation, stops every stage
+    prefetch = max(prefetch, 1)
+    workers = max(workers, 1)
+    tracker = tracker or TileProgress(len(plans))
+    metrics = metrics or RunMetrics()
+    read_queue = queue.Queue(prefetch)
+    write_queue = queue.Queue(prefetch)
+    stop = threading.Event()
+    errors = []
+    # Marks the end of the tiles in a queue, once per consumer
+    end = object()
+
+    def put(target, item):
+        # Waits for room in the queue unless the pipeline is stopping
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(source):
+        while not stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def read():
+        for index, plan in plans:
+            tracker.check()
+            tile = read_tile(inputs, plan["read"], metrics, touch=True)
+            if not put(read_queue, (index, plan, tile)):
+                return
+        for _ in range(workers):
+            put(read_queue, end)
+
+    def compute():
+        while True:
+            item = get(read_queue)
+            if item is None:
+                return
+            if item is end:
+                put(write_queue, end)
+                return
+            index, plan, tile = item
+            if parallel:
+                task = (timed_process_and_write, tile, plan, job, writers)
+            else:
+                task = (timed_process_tile, tile, plan, job)
+            if executor is None:
+                outputs, stages = task[0](*task[1:])
+            else:
+                outputs, stages = executor.submit(*task).result()
+            metrics.merge(stages)
+            if not put(write_queue, (index, outputs)):
+                return
+
+    def write():
+        running = workers
+        while running:
+            item = get(write_queue)
+            if item is None:
+                return
+            if item is end:
+                running -= 1
+                continue
+            index, outputs = item
+            write_outputs(writers, outputs, metrics)
+            tracker.done(index)
+
+    def stage(function):
+        def run():
+            try:
+                function()
+            except BaseException as error:
+                errors.append(error)
+                stop.set()
+        return threading.Thread(target=run, name=f"tile-{function.__name__}", daemon=True)
+
+    parallel = all(writer.parallel for writer in writers.values())
+    executor = ProcessPoolExecutor(max_workers=workers) if use_processes else None
+    threads = [stage(read)] + [stage(compute) for _ in range(workers)] + [stage(write)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except BaseException:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    if errors:
+        raise errors[0]
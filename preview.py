@@ -0,0 +1,185 @@
+import argparse
+import math
+import sys
+
+# Quick look of a scene: calibration and CP synthesis on every n-th pixel, shown as an RGB
+# composite (|S_1|, |S_2|, |C12|^1/2) in seconds, to reject bad inputs before a full run.
+# Like cli.py, heavy imports (numpy, rasterio) are deferred to the functions that need them.
+
+DEFAULT_PREVIEW_SIZE = 1024
+DEFAULT_SMOOTHING = 3
+
+# Percentiles of the dB values mapped to 0 and 255
+STRETCH = (2, 98)
+
+# Thresholds of the input checks
+MAX_ZERO_FRACTION = 0.5
+MAX_SATURATED_FRACTION = 0.01
+MAX_RECIPROCITY_DB = 1.5
+
+
+def decimation_step(shape, max_size=DEFAULT_PREVIEW_SIZE):
+    return max(1, math.ceil(max(shape) / max_size))
+
+
+def band_power(data, sensor):
+    import numpy as np
+
+    if sensor == "RADARSAT2":
+        # (I, Q) bands
+        I, Q = data[0].astype(np.float64), data[1].astype(np.float64)
+        return I * I + Q * Q
+    return np.abs(data.astype(np.complex128)) ** 2
+
+
+def check_inputs(tile, sensor):
+    # Problems that make a full run pointless, and statistics of the decimated input bands
+    import numpy as np
+
+    problems = []
+    stats = {}
+    power = {}
+    for pol, data in tile.items():
+        values = band_power(data, sensor)
+        finite = np.isfinite(values)
+        valid = finite & (values > 0)
+        stats[pol] = {
+            "mean_power_db": float(10 * np.log10(values[valid].mean())) if valid.any() else None,
+            "zero_fraction": float(np.mean(values == 0)),
+            "non_finite_fraction": float(np.mean(~finite)),
+        }
+        power[pol] = values[valid].mean() if valid.any() else 0.0
+
+        if not valid.any():
+            problems.append(f"{pol} holds no valid pixels.")
+            continue
+        if stats[pol]["zero_fraction"] > MAX_ZERO_FRACTION:
+            problems.append(f"{pol}: {stats[pol]['zero_fraction']:.0%} of the pixels are zero.")
+        if stats[pol]["non_finite_fraction"] > 0:
+            problems.append(f"{pol}: {stats[pol]['non_finite_fraction']:.1%} of the pixels are NaN or infinite.")
+        if np.issubdtype(data.dtype, np.integer):
+            limits = np.iinfo(data.dtype)
+            saturated = float(np.mean((data == limits.min) | (data == limits.max)))
+            stats[pol]["saturated_fraction"] = saturated
+            if saturated > MAX_SATURATED_FRACTION:
+                problems.append(f"{pol}: {saturated:.1%} of the samples are saturated.")
+
+    if len(power) == 4 and all(value > 0 for value in power.values()):
+        # Reciprocity: HV and VH carry the same power, and less than the co-polarizations
+        reciprocity = 10 * math.log10(power["HV"] / power["VH"])
+        stats["HV_VH_ratio_db"] = reciprocity
+        if abs(reciprocity) > MAX_RECIPROCITY_DB:
+            problems.append(f"HV and VH differ by {reciprocity:+.1f} dB; are the images in HH, HV, VH, VV order?")
+        if min(power["HV"], power["VH"]) > max(power["HH"], power["VV"]):
+            problems.append("The cross-polarizations are stronger than the co-polarizations; "
+                            "are the images in HH, HV, VH, VV order?")
+    return problems, stats
+
+
+def stretch(values):
+    # dB values to uint8 between the STRETCH percentiles
+    import numpy as np
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        db = 10 * np.log10(values)
+    valid = np.isfinite(db)
+    if not valid.any():
+        return np.zeros(values.shape, np.uint8)
+    low, high = np.percentile(db[valid], STRETCH)
+    scaled = (db - low) / max(high - low, 1e-6) * 255
+    return np.clip(np.nan_to_num(scaled, nan=0, neginf=0), 0, 255).astype(np.uint8)
+
+
+def preview(paths, sensor, calibration, mode="RHV", max_size=DEFAULT_PREVIEW_SIZE, smoothing=DEFAULT_SMOOTHING,
+            memmap=True):
+    # {"rgb": (rows, columns, 3) uint8, "step", "shape", "problems", "stats"} of a scene decimated
+    # so that its longer side is at most max_size pixels
+    import numpy as np
+    from functions import boxcar_filter, cp_synthesis_kernel, fp_scattering_kernel
+    from pipeline import POLARIZATIONS, kernel_mode, open_inputs, scene_shape
+
+    shape = scene_shape(paths, sensor)
+    step = decimation_step(shape, max_size)
+    readers = open_inputs(paths, sensor, memmap)
+    try:
+        tile = {pol: readers[pol].read_decimated(step) for pol in POLARIZATIONS}
+    finally:
+        for reader in readers.values():
+            reader.close()
+    problems, stats = check_inputs(tile, sensor)
+
+    # float32 is plenty for a quick look
+    raw = [tile[pol] for pol in POLARIZATIONS]
+    if sensor == "RADARSAT2":
+        # The LUT column of every kept pixel; the gains vary slowly across range
+        gains = calibration["gains"][::step]
+        S11, S12, S22 = fp_scattering_kernel(*raw, gains=gains, offset=calibration["offset"], dtype=np.float32)
+    else:
+        S11, S12, S22 = fp_scattering_kernel(*raw, const=calibration["const"], dtype=np.float32)
+    results = cp_synthesis_kernel(S11, S12, S22, kernel_mode(mode), ["covariance"])
+
+    C11, C22 = results["C11"], results["C22"]
+    C12 = results["C12_real"] + 1j * results["C12_imag"]
+    if smoothing > 1:
+        # The decimated pixels are single look; a little averaging makes the composite readable
+        C11, C12, C22 = (boxcar_filter(data, smoothing) for data in (C11, C12, C22))
+    rgb = np.dstack([stretch(C11), stretch(C22), stretch(np.abs(C12))])
+    return {"rgb": rgb, "step": step, "shape": shape, "problems": problems, "stats": stats}
+
+
+def save_png(path, rgb):
+    import warnings
+    import rasterio
+    from rasterio.errors import NotGeoreferencedWarning
+
+    rows, columns, _ = rgb.shape
+    with warnings.catch_warnings():
+        # A quick look has no georeferencing
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.open(path, "w", driver="PNG", width=columns, height=rows, count=3, dtype="uint8") as dataset:
+            dataset.write(rgb.transpose(2, 0, 1))
+
+
+def build_parser():
+    from cli import MODES, add_input_arguments
+
+    parser = argparse.ArgumentParser(
+        prog="python -m preview",
+        description="Quick look of a scene: synthesizes a CP mode on a decimated copy of the inputs, "
+                    "writes an RGB composite (R = |S_1|, G = |S_2|, B = |C12|^1/2) and checks the inputs."
+    )
+    add_input_arguments(parser)
+    parser.add_argument("--mode", default="RHV", choices=MODES,
+                        help="Compact polarimetric mode of the composite (default: RHV).")
+    parser.add_argument("--ellipse", nargs=2, type=float, metavar=("ORIENTATION", "ELLIPTICITY"),
+                        help="Use an arbitrary transmitted ellipse instead of --mode, angles in degrees.")
+    parser.add_argument("--size", type=int, default=DEFAULT_PREVIEW_SIZE,
+                        help="Longer side of the preview in pixels (default: 1024).")
+    parser.add_argument("--smoothing", type=int, default=DEFAULT_SMOOTHING,
+                        help="Boxcar window applied to the covariance matrix, 1 for none (default: 3).")
+    parser.add_argument("--output", default="preview.png",
+                        help="PNG file of the composite (default: preview.png).")
+    return parser
+
+
+def main(argv=None):
+    from cli import load_inputs
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    paths, calibration = load_inputs(parser, args)
+
+    from pipeline import ellipse_mode
+
+    mode = ellipse_mode(*args.ellipse) if args.ellipse else args.mode
+    result = preview(paths, args.sensor, calibration, mode, args.size, args.smoothing, memmap=not args.no_memmap)
+    save_png(args.output, result["rgb"])
+    rows, columns = result["shape"]
+    print(f"Preview of {rows} x {columns} pixels (decimated by {result['step']}) saved to {args.output}")
+    for problem in result["problems"]:
+        print(f"Warning: {problem}", file=sys.stderr)
+    return 1 if result["problems"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
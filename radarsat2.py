@@ -0,0 +1,98 @@
+import functools
+import os
+import xml.etree.ElementTree as ET
+from functions import gains_offset_reader_xml
+
+PRODUCT_FILE = "product.xml"
+
+# Calibration LUTs of a product, by the incidenceAngleCorrection they are listed with in product.xml
+LUT_TYPES = {
+    "sigma": ("Sigma Nought", "lutSigma.xml"),
+    "beta": ("Beta Nought", "lutBeta.xml"),
+    "gamma": ("Gamma", "lutGamma.xml"),
+}
+
+POLARIZATIONS = ["HH", "HV", "VH", "VV"]
+
+
+def find_text(element, path):
+    # product.xml elements are namespaced; {*} matches any namespace
+    found = element.find("/".join("{*}" + tag for tag in path.split("/")))
+    return found.text.strip() if found is not None and found.text else None
+
+
+def read_product(path):
+    # Parses product.xml once: imagery per polarization, calibration LUTs and raster size.
+    # path is the product folder or its product.xml
+    product_path = os.path.join(path, PRODUCT_FILE) if os.path.isdir(path) else path
+    folder = os.path.dirname(os.path.abspath(product_path))
+    root = ET.parse(product_path).getroot()
+
+    image_attributes = root.find("{*}imageAttributes")
+    if image_attributes is None:
+        raise ValueError(f"No imageAttributes in {product_path}; is it a RADARSAT-2 product.xml?")
+
+    data_type = find_text(image_attributes, "rasterAttributes/dataType")
+    if data_type is not None and data_type.lower() != "complex":
+        raise ValueError(f"{product_path} is a {data_type} product; Single Look Complex data is required.")
+
+    paths = {}
+    for element in image_attributes.findall("{*}fullResolutionImageData"):
+        pole = element.get("pole", "").upper()
+        if pole in POLARIZATIONS and element.text:
+            paths[pole] = os.path.join(folder, element.text.strip())
+    for pol in POLARIZATIONS:
+        # Older packages without the pole attributes follow the imagery_XX.tif naming
+        paths.setdefault(pol, os.path.join(folder, f"imagery_{pol}.tif"))
+    missing = [pol for pol in POLARIZATIONS if not os.path.exists(paths[pol])]
+    if missing:
+        raise ValueError(f"The product has no imagery for {', '.join(missing)}; a quad-pol product is required.")
+
+    luts = {}
+    for element in image_attributes.findall("{*}lookupTable"):
+        correction = element.get("incidenceAngleCorrection", "")
+        for lut_type, (name, _) in LUT_TYPES.items():
+            if correction.lower() == name.lower() and element.text:
+                luts[lut_type] = os.path.join(folder, element.text.strip())
+    for lut_type, (_, file_name) in LUT_TYPES.items():
+        if lut_type not in luts and os.path.exists(os.path.join(folder, file_name)):
+            luts[lut_type] = os.path.join(folder, file_name)
+
+    columns = find_text(image_attributes, "rasterAttributes/numberOfSamplesPerLine")
+    rows = find_text(image_attributes, "rasterAttributes/numberOfLines")
+    return {
+        "product": product_path,
+        "paths": paths,
+        "luts": luts,
+        "shape": (int(rows), int(columns)) if rows and columns else None,
+        "satellite": find_text(root, "sourceAttributes/satellite"),
+        "acquisition": find_text(root, "sourceAttributes/rawDataStartTime"),
+    }
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_lut(path, stamp):
+    offset, gains = gains_offset_reader_xml(path)
+    if gains is None:
+        raise ValueError(f"Failed to read the calibration LUT {path}.")
+    # Shared between runs, so it must not be modified
+    gains.setflags(write=False)
+    return offset, gains
+
+
+def read_lut(path):
+    # (offset, per-column gains) of a LUT, parsed once per file version and process.
+    # The gains vector broadcasts over the rows of a tile
+    stat = os.stat(path)
+    return _parse_lut(os.path.abspath(path), (stat.st_size, stat.st_mtime_ns))
+
+
+def product_calibration(product, lut_type="sigma"):
+    if lut_type not in LUT_TYPES:
+        raise ValueError(f"Unknown LUT type: {lut_type}")
+    if lut_type not in product["luts"]:
+        raise ValueError(f"The product has no {LUT_TYPES[lut_type][0]} LUT.")
+    offset, gains = read_lut(product["luts"][lut_type])
+    if product["shape"] is not None and gains.shape[0] != product["shape"][1]:
+        raise ValueError(f"The {lut_type} LUT has {gains.shape[0]} gains for {product['shape'][1]} columns.")
+    return {"offset": offset, "gains": gains}
@@ -0,0 +1,182 @@
+import mmap
+import numpy as np
+import rasterio
+from rasterio.enums import Interleaving, Resampling
+from rasterio.windows import Window
+
+
+def touch_pages(data):
+    # Faults in the pages of a memory-mapped view by reading one value per page, so
+    # that they come from disk in the calling thread rather than in the tile kernel
+    step = max(1, mmap.PAGESIZE // data.itemsize)
+    data[..., ::step].sum()
+
+
+def tiff_byte_order(path):
+    with open(path, "rb") as file:
+        return "<" if file.read(2) == b"II" else ">"
+
+
+def strip_offsets(dataset, bidx, strips):
+    offsets = []
+    for strip in range(strips):
+        offset = dataset.get_tag_item(f"BLOCK_OFFSET_0_{strip}", "TIFF", bidx=bidx)
+        if offset is None:
+            return None
+        offsets.append(int(offset))
+    return offsets
+
+
+def geotiff_memmap(dataset):
+    # Zero-copy (bands, rows, columns) view of an uncompressed GeoTIFF whose strips are
+    # stored back to back, or None when the layout has to go through GDAL
+    if dataset.driver != "GTiff" or dataset.compression is not None or len(set(dataset.dtypes)) != 1:
+        return None
+    try:
+        dtype = np.dtype(dataset.dtypes[0])
+    except TypeError:
+        return None
+    strip_rows, strip_columns = dataset.block_shapes[0]
+    if strip_columns != dataset.width:
+        return None
+
+    rows, columns, count = dataset.height, dataset.width, dataset.count
+    strips = -(-rows // strip_rows)
+    # Big-endian files would hand non-native arrays to the kernels; GDAL swaps those
+    if not dtype.newbyteorder(tiff_byte_order(dataset.name)).isnative:
+        return None
+
+    if dataset.interleaving == Interleaving.pixel:
+        strip_bytes = strip_rows * columns * count * dtype.itemsize
+        offsets = strip_offsets(dataset, 1, strips)
+        if offsets is None or offsets != [offsets[0] + strip * strip_bytes for strip in range(strips)]:
+            return None
+        array = np.memmap(dataset.name, dtype=dtype, mode="r", offset=offsets[0], shape=(rows, columns, count))
+        return array.transpose(2, 0, 1)
+
+    if dataset.interleaving == Interleaving.band or count == 1:
+        strip_bytes = strip_rows * columns * dtype.itemsize
+        band_bytes = rows * columns * dtype.itemsize
+        first = None
+        for bidx in range(1, count + 1):
+            offsets = strip_offsets(dataset, bidx, strips)
+            if offsets is None:
+                return None
+            if first is None:
+                first = offsets[0]
+            start = first + (bidx - 1) * band_bytes
+            if offsets != [start + strip * strip_bytes for strip in range(strips)]:
+                return None
+        return np.memmap(dataset.name, dtype=dtype, mode="r", offset=first, shape=(count, rows, columns))
+    return None
+
+
+class RasterReader:
+    # Window-addressable handle on an input raster. Opening only reads the header;
+    # pixels are read when a window is requested, straight from the page cache
+    # when the file can be memory-mapped and through GDAL otherwise
+
+    def __init__(self, path, band=None, memmap=True):
+        self.path = path
+        self.band = band
+        self.dataset = rasterio.open(path)
+        self.shape = (self.dataset.height, self.dataset.width)
+        self.dtype = np.dtype(self.dataset.dtypes[(band or 1) - 1])
+        self.array = geotiff_memmap(self.dataset) if memmap else None
+
+    @property
+    def memory_mapped(self):
+        return self.array is not None
+
+    def read(self, window):
+        # Same result as dataset.read(window=window) / dataset.read(band, window=window)
+        if self.array is None:
+            if self.band is None:
+                return self.dataset.read(window=window)
+            return self.dataset.read(self.band, window=window)
+
+        rows, columns = window.toslices()
+        if self.band is None:
+            return self.array[:, rows, columns]
+        return self.array[self.band - 1, rows, columns]
+
+    def read_decimated(self, step):
+        # Every step-th row and column: strided from the memory map, otherwise nearest
+        # neighbour through GDAL, which reads from the overviews when the file has them
+        if self.array is not None:
+            if self.band is None:
+                return self.array[:, ::step, ::step]
+            return self.array[self.band - 1, ::step, ::step]
+
+        rows, columns = (-(-size // step) for size in self.shape)
+        if self.band is None:
+            return self.dataset.read(out_shape=(self.dataset.count, rows, columns), resampling=Resampling.nearest)
+        return self.dataset.read(self.band, out_shape=(rows, columns), resampling=Resampling.nearest)
+
+    def close(self):
+        self.array = None
+        self.dataset.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RegionReader:
+    # A window of another reader (RasterReader, CeosImageReader or a cached band), addressed
+    # as a scene of its own so that tiles of a region of interest read only that region
+
+    def __init__(self, reader, window):
+        self.reader = reader
+        self.window = window
+        self.shape = (window.height, window.width)
+        self.dtype = getattr(reader, "dtype", None)
+
+    @property
+    def memory_mapped(self):
+        return self.reader.memory_mapped
+
+    def read(self, window):
+        return self.reader.read(Window(self.window.col_off + window.col_off, self.window.row_off + window.row_off,
+                                       window.width, window.height))
+
+    def close(self):
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ArrayReader:
+    # The same read(window) interface on an array already in memory: (I/Q, rows, columns)
+    # like a RADARSAT-2 GeoTIFF or complex (rows, columns) like an ALOS-PALSAR polarization
+
+    def __init__(self, array):
+        self.array = np.asanyarray(array)
+        self.shape = self.array.shape[-2:]
+        self.dtype = self.array.dtype
+
+    @property
+    def memory_mapped(self):
+        return isinstance(self.array, np.memmap)
+
+    def read(self, window):
+        rows, columns = window.toslices()
+        return self.array[..., rows, columns]
+
+    def read_decimated(self, step):
+        return self.array[..., ::step, ::step]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
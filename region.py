@@ -0,0 +1,123 @@
+import json
+import math
+import rasterio
+from affine import Affine
+from rasterio.errors import RasterioIOError, WindowError
+from rasterio.features import bounds as geometry_bounds
+from rasterio.features import rasterize
+from rasterio.transform import from_gcps
+from rasterio.warp import transform_bounds, transform_geom
+from rasterio.windows import Window
+
+# Region of interest of a run, given as a plain (JSON) dict:
+#   {"window": [col_off, row_off, width, height]} in pixels of the scene,
+#   {"bbox": [left, bottom, right, top], "crs": "EPSG:4326"} or
+#   {"polygon": GeoJSON file, FeatureCollection, Feature or geometry, "crs": ...}
+# bbox and polygon coordinates are longitude/latitude unless "crs" (or the "crs" member
+# of the GeoJSON) says otherwise
+
+DEFAULT_CRS = "EPSG:4326"
+REGION_KEYS = ["window", "bbox", "polygon"]
+
+
+def scene_georeference(path):
+    # (transform, crs) from pixel to map coordinates of a raster: its geotransform, else an
+    # affine fit of its GCPs (RADARSAT-2 SLC imagery), else None (e.g. CEOS image files)
+    try:
+        with rasterio.open(path) as dataset:
+            if dataset.crs is not None and not dataset.transform.is_identity:
+                return dataset.transform, dataset.crs
+            gcps, crs = dataset.gcps
+            if gcps and crs is not None:
+                return from_gcps(gcps), crs
+    except RasterioIOError:
+        pass
+    return None
+
+
+def load_geometries(polygon):
+    # (geometries, crs name or None) of a GeoJSON file or object
+    if isinstance(polygon, str):
+        with open(polygon) as file:
+            polygon = json.load(file)
+    crs = polygon.get("crs", {}).get("properties", {}).get("name")
+    if polygon.get("type") == "FeatureCollection":
+        geometries = [feature["geometry"] for feature in polygon.get("features", []) if feature.get("geometry")]
+    elif polygon.get("type") == "Feature":
+        geometries = [polygon["geometry"]] if polygon.get("geometry") else []
+    else:
+        geometries = [polygon]
+    if not geometries or any(geometry.get("type") not in ("Polygon", "MultiPolygon") for geometry in geometries):
+        raise ValueError("The AOI must hold Polygon or MultiPolygon geometries.")
+    return geometries, crs
+
+
+def bounds_window(bounds, transform):
+    # Smallest pixel window covering map bounds; the corners are mapped one by one
+    # since a transform fitted to GCPs can be rotated
+    left, bottom, right, top = bounds
+    inverse = ~transform
+    corners = [inverse * (x, y) for x in (left, right) for y in (bottom, top)]
+    first_col = math.floor(min(col for col, _ in corners))
+    first_row = math.floor(min(row for _, row in corners))
+    return Window(first_col, first_row,
+                  math.ceil(max(col for col, _ in corners)) - first_col,
+                  math.ceil(max(row for _, row in corners)) - first_row)
+
+
+def resolve_region(region, shape, georeference=None, looks=(1, 1)):
+    # {"window": the region in scene pixels, "geometries": AOI polygons in the scene CRS or None,
+    #  "transform": pixel to scene CRS}. The window is clipped to the scene and widened to whole
+    # looks, so that the multilooked outputs fall on the grid of a full-scene run
+    keys = [key for key in REGION_KEYS if region.get(key) is not None]
+    if len(keys) != 1:
+        raise ValueError(f"A region needs exactly one of {', '.join(REGION_KEYS)}.")
+    rows, columns = shape
+    geometries = None
+    transform = None
+    if keys == ["window"]:
+        col_off, row_off, width, height = (int(value) for value in region["window"])
+        if width <= 0 or height <= 0:
+            raise ValueError("The region window must have a positive width and height.")
+        window = Window(col_off, row_off, width, height)
+    else:
+        if georeference is None:
+            raise ValueError("The scene isn't georeferenced; give the region as a pixel window.")
+        transform, scene_crs = georeference
+        if keys == ["bbox"]:
+            bounds = transform_bounds(region.get("crs") or DEFAULT_CRS, scene_crs, *region["bbox"], densify_pts=21)
+        else:
+            geometries, crs = load_geometries(region["polygon"])
+            geometries = [transform_geom(region.get("crs") or crs or DEFAULT_CRS, scene_crs, geometry)
+                          for geometry in geometries]
+            extents = [geometry_bounds(geometry) for geometry in geometries]
+            bounds = (min(extent[0] for extent in extents), min(extent[1] for extent in extents),
+                      max(extent[2] for extent in extents), max(extent[3] for extent in extents))
+        window = bounds_window(bounds, transform)
+
+    try:
+        window = window.intersection(Window(0, 0, columns, rows))
+    except WindowError:
+        raise ValueError("The region doesn't overlap the scene.") from None
+    looks_rows, looks_cols = looks
+    first_row = window.row_off // looks_rows * looks_rows
+    first_col = window.col_off // looks_cols * looks_cols
+    last_row = min(-(-(window.row_off + window.height) // looks_rows) * looks_rows, rows)
+    last_col = min(-(-(window.col_off + window.width) // looks_cols) * looks_cols, columns)
+    window = Window(int(first_col), int(first_row), int(last_col - first_col), int(last_row - first_row))
+    return {"window": window, "geometries": geometries, "transform": transform}
+
+
+def intersecting_plans(plans, area, cell):
+    # The tile plans whose core window touches the AOI polygons. The polygons are burnt into
+    # a grid of one cell per tile, cell being the (rows, columns) of a full tile in pixels
+    if not area["geometries"]:
+        return plans
+    window = area["window"]
+    cell_rows, cell_cols = cell
+    grid = (-(-window.height // cell_rows), -(-window.width // cell_cols))
+    transform = area["transform"] * Affine.translation(window.col_off, window.row_off) * Affine.scale(cell_cols,
+                                                                                                      cell_rows)
+    touched = rasterize(area["geometries"], out_shape=grid, transform=transform, all_touched=True, dtype="uint8")
+    return [plan for plan in plans
+            if touched[plan["core"].row_off // cell_rows, plan["core"].col_off // cell_cols]]
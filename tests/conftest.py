@@ -0,0 +1,48 @@
+import glob
+import os
+import sys
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+# The modules live at the root of the repository, next to main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_rs2_scene(folder, rows=83, columns=97, seed=0):
+    # Synthetic RADARSAT-2 imagery_<pol>.tif (I/Q int16 bands) and lutSigma.xml; returns (paths, lut)
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = {}
+    for pol in ["HH", "HV", "VH", "VV"]:
+        paths[pol] = os.path.join(folder, f"imagery_{pol}.tif")
+        with rasterio.open(paths[pol], "w", driver="GTiff", width=columns, height=rows, count=2, dtype="int16",
+                           crs="EPSG:32610", transform=from_origin(500000, 4000000, 5, 5)) as dataset:
+            dataset.write(rng.integers(-3000, 3000, (2, rows, columns)).astype(np.int16))
+    lut = os.path.join(folder, "lutSigma.xml")
+    gains = " ".join(f"{gain:.6e}" for gain in rng.uniform(500, 900, columns))
+    with open(lut, "w") as file:
+        file.write(f"<lut><offset>0.000000e+00</offset><gains>{gains}</gains></lut>")
+    return paths, lut
+
+
+def read_outputs(folder):
+    # {path relative to folder: band} of every GeoTIFF written under folder
+    outputs = {}
+    for path in sorted(glob.glob(os.path.join(folder, "**", "*.tif"), recursive=True)):
+        with rasterio.open(path) as dataset:
+            outputs[os.path.relpath(path, folder)] = dataset.read()
+    return outputs
+
+
+def assert_same_outputs(folder, expected_folder):
+    outputs, expected = read_outputs(folder), read_outputs(expected_folder)
+    assert expected and sorted(outputs) == sorted(expected)
+    for name, data in expected.items():
+        np.testing.assert_array_equal(outputs[name], data, err_msg=name)
+
+
+@pytest.fixture
+def rs2_scene(tmp_path):
+    return write_rs2_scene(tmp_path / "input")
@@ -0,0 +1,33 @@
+import json
+import os
+import re
+import pytest
+from batch import load_manifest, scene_memory
+
+README = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "README.md")
+
+
+def readme_manifest():
+    # The JSON example of the "Batch Processing" section
+    with open(README, encoding="utf-8") as file:
+        text = file.read()
+    section = text[text.index("### Batch Processing"):]
+    return json.loads(re.search(r"```json\n(.*?)```", section, re.S).group(1))
+
+
+def test_readme_manifest(tmp_path):
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps(readme_manifest()))
+    manifest = load_manifest(str(path))
+    assert [scene["name"] for scene in manifest["scenes"]] == ["rs2_0001", "alos_0001"]
+    for scene in manifest["scenes"]:
+        assert scene_memory(scene) > 0
+
+
+def test_manifest_rejects_non_positive_options(tmp_path):
+    manifest = readme_manifest()
+    for option in ("tile_size", "workers"):
+        path = tmp_path / f"{option}.json"
+        path.write_text(json.dumps(dict(manifest, options={option: 0})))
+        with pytest.raises(ValueError, match=option):
+            load_manifest(str(path))
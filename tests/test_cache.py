@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from rasterio.windows import Window
+import cache
+from cache import CACHE_BANDS, DIGESTS_FILE, STALE_STAGING_AGE, ScatteringCache
+
+SHAPE = (16, 24)
+DTYPE = np.complex128
+# Size of an entry of SHAPE, without the entry.json
+ENTRY_SIZE = len(CACHE_BANDS) * 16 * 24 * 16
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    paths = []
+    for pol in ["HH", "HV", "VH", "VV"]:
+        path = tmp_path / f"imagery_{pol}.tif"
+        path.write_bytes(pol.encode() * 100)
+        paths.append(str(path))
+    return paths
+
+
+def fp_matrix(seed=0):
+    rng = np.random.default_rng(seed)
+    return {name: rng.normal(size=SHAPE) + 1j * rng.normal(size=SHAPE) for name in CACHE_BANDS}
+
+
+def store(scattering_cache, key, bands):
+    # Writes an entry in two tiles, as run_tiled does
+    with scattering_cache.create(key, SHAPE, DTYPE) as entry:
+        for window in (Window(0, 0, 24, 10), Window(0, 10, 24, 6)):
+            entry.write({name: data[window.toslices()] for name, data in bands.items()}, window)
+
+
+def age(path, seconds):
+    # Moves the modification times of a folder and its files back
+    stamp = time.time() - seconds
+    for name in os.listdir(path):
+        os.utime(os.path.join(path, name), (stamp, stamp))
+    os.utime(path, (stamp, stamp))
+
+
+def test_miss_then_hit(tmp_path, inputs):
+    scattering_cache = ScatteringCache(tmp_path / "cache")
+    key = scattering_cache.key(inputs, "RADARSAT2", {"gains": np.arange(24.0), "offset": 0.0}, DTYPE)
+    assert scattering_cache.lookup(key, SHAPE) is None
+
+    bands = fp_matrix()
+    store(scattering_cache, key, bands)
+    cached = scattering_cache.lookup(key, SHAPE)
+    for name, data in bands.items():
+        np.testing.assert_array_equal(cached[name].read(Window(3, 2, 10, 9)), data[2:11, 3:13])
+    # An entry of another shape doesn't match
+    assert scattering_cache.lookup(key, (16, 25)) is None
+    assert not [name for name in os.listdir(tmp_path / "cache") if name.endswith(".partial")]
+
+
+def test_key_follows_inputs_calibration_and_dtype(tmp_path, inputs):
+    scattering_cache = ScatteringCache(tmp_path / "cache")
+    calibration = {"gains": np.arange(24.0), "offset": 0.0}
+    key = scattering_cache.key(inputs, "RADARSAT2", calibration, DTYPE)
+    assert scattering_cache.key(inputs, "RADARSAT2", calibration, DTYPE) == key
+    assert scattering_cache.key(inputs, "RADARSAT2", dict(calibration, offset=1.0), DTYPE) != key
+    assert scattering_cache.key(inputs, "RADARSAT2", calibration, np.complex64) != key
+    assert scattering_cache.key(inputs[::-1], "RADARSAT2", calibration, DTYPE) != key
+
+
+def test_changed_input_invalidates_the_digest(tmp_path, inputs, monkeypatch):
+    scattering_cache = ScatteringCache(tmp_path / "cache")
+    calibration = {"const": 1e-11}
+    key = scattering_cache.key(inputs, "ALOS", calibration, DTYPE)
+    store(scattering_cache, key, fp_matrix())
+
+    # Unchanged inputs aren't hashed again
+    hashed = []
+    file_digest = cache.file_digest
+    monkeypatch.setattr(cache, "file_digest", lambda path: hashed.append(path) or file_digest(path))
+    assert scattering_cache.key(inputs, "ALOS", calibration, DTYPE) == key
+    assert hashed == []
+
+    # Same size, new contents and time stamp
+    with open(inputs[2], "r+b") as file:
+        file.write(b"XX")
+    stamp = os.stat(inputs[2]).st_mtime_ns + 10**9
+    os.utime(inputs[2], ns=(stamp, stamp))
+    new_key = scattering_cache.key(inputs, "ALOS", calibration, DTYPE)
+    assert hashed == [os.path.abspath(inputs[2])]
+    assert new_key != key
+    assert scattering_cache.lookup(new_key, SHAPE) is None
+    with open(tmp_path / "cache" / DIGESTS_FILE) as file:
+        assert json.load(file)[os.path.abspath(inputs[2])]["stamp"][1] == stamp
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    # Room for two entries
+    scattering_cache = ScatteringCache(tmp_path / "cache", max_bytes=2 * ENTRY_SIZE + 1024)
+    for index, key in enumerate(["a", "b"]):
+        store(scattering_cache, key, fp_matrix(index))
+        age(scattering_cache.entry_path(key), 100 - index)
+    # Using "a" makes "b" the least recently used
+    assert scattering_cache.lookup("a", SHAPE) is not None
+    store(scattering_cache, "c", fp_matrix(2))
+    assert scattering_cache.lookup("b", SHAPE) is None
+    assert scattering_cache.lookup("a", SHAPE) is not None
+    assert scattering_cache.lookup("c", SHAPE) is not None
+
+
+def test_scene_larger_than_the_cache_is_not_stored(tmp_path):
+    scattering_cache = ScatteringCache(tmp_path / "cache", max_bytes=ENTRY_SIZE - 1)
+    assert scattering_cache.create("a", SHAPE, DTYPE) is None
+
+
+def test_staging_folders(tmp_path):
+    scattering_cache = ScatteringCache(tmp_path / "cache", max_bytes=2 * ENTRY_SIZE + 1024)
+    store(scattering_cache, "a", fp_matrix())
+    age(scattering_cache.entry_path("a"), 100)
+
+    # A run writing an entry: its staging folder counts against max_bytes, so "a" makes room
+    writing = scattering_cache.create("b", SHAPE, DTYPE).open()
+    scattering_cache.evict(reserve=ENTRY_SIZE)
+    assert os.path.isdir(writing.staging_path)
+    assert scattering_cache.lookup("a", SHAPE) is None
+
+    # A run that was killed: its staging folder is removed once stale
+    age(writing.staging_path, STALE_STAGING_AGE + 60)
+    scattering_cache.evict()
+    assert not os.path.exists(writing.staging_path)
+    assert os.listdir(tmp_path / "cache") == []
+
+
+def test_concurrent_writes_of_the_same_entry(tmp_path):
+    # E.g. batch scenes on the same inputs: one entry is kept, and no staging folder is left
+    scattering_cache = ScatteringCache(tmp_path / "cache")
+    bands = fp_matrix()
+    errors = []
+
+    def write():
+        try:
+            store(scattering_cache, "a", bands)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=write) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert os.listdir(tmp_path / "cache") == ["a"]
+    cached = scattering_cache.lookup("a", SHAPE)
+    for name, data in bands.items():
+        np.testing.assert_array_equal(cached[name].read(Window(0, 0, 24, 16)), data)
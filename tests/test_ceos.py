@@ -0,0 +1,151 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from rasterio.windows import Window
+from ceos import (CeosImageReader, RECORD_HEADER, calibration_constant, image_layout, read_calibration_factor,
+                  read_product)
+from pipeline import alos_calibration, load_calibration
+
+SCENE = "ALPSRP123456780-P1.1__A"
+PREFIX = 412
+
+
+def record_header(sequence, code, length):
+    return np.array([(sequence, (63, code, 18, 18), length)], RECORD_HEADER).tobytes()
+
+
+def put(record, start, text):
+    # Fields at their 1-based byte positions, as in the format description
+    record[start - 1:start - 1 + len(text)] = text.encode("ascii")
+
+
+def write_image(path, data, suffix=0, sample_format="C*8"):
+    rows, columns = data.shape
+    record_length = PREFIX + columns * 8 + suffix
+    descriptor = bytearray(b" " * 720)
+    descriptor[:12] = record_header(1, 192, 720)
+    put(descriptor, 181, f"{rows:6d}")
+    put(descriptor, 187, f"{record_length:6d}")
+    put(descriptor, 237, f"{rows:8d}")
+    put(descriptor, 249, f"{columns:8d}")
+    put(descriptor, 277, f"{PREFIX:4d}")
+    put(descriptor, 281, f"{columns * 8:8d}")
+    put(descriptor, 289, f"{suffix:4d}")
+    put(descriptor, 429, f"{sample_format:<4}")
+    rng = np.random.default_rng(1)
+    with open(path, "wb") as file:
+        file.write(descriptor)
+        for row in range(rows):
+            # Random prefix and suffix bytes, so that reading them by mistake shows
+            prefix = bytearray(rng.integers(0, 256, PREFIX, dtype=np.uint8).tobytes())
+            prefix[:12] = record_header(row + 2, 10, record_length)
+            file.write(prefix + data[row].astype(">c8").tobytes() + rng.integers(0, 256, suffix, np.uint8).tobytes())
+
+
+def write_leader(path, calibration_factor):
+    with open(path, "wb") as file:
+        for code, length in [(192, 720), (10, 4096), (30, 4680), (40, 16384)]:
+            file.write(record_header(1, code, length) + b" " * (length - 12))
+        if calibration_factor is not None:
+            radiometric = bytearray(b" " * 9860)
+            radiometric[:12] = record_header(5, 50, 9860)
+            put(radiometric, 21, f"{calibration_factor:>16}")
+            file.write(radiometric)
+
+
+def write_product(folder, data, calibration_factor="-83.5000000", suffix=0):
+    # VOL, LED and IMG files of a quad-pol Level 1.1 product holding data (4, rows, columns)
+    os.makedirs(folder, exist_ok=True)
+    for pol, image in zip(["HH", "HV", "VH", "VV"], data):
+        write_image(os.path.join(folder, f"IMG-{pol}-{SCENE}"), image, suffix)
+    if calibration_factor is not False:
+        write_leader(os.path.join(folder, f"LED-{SCENE}"), calibration_factor)
+    volume = os.path.join(folder, f"VOL-{SCENE}")
+    with open(volume, "wb") as file:
+        file.write(record_header(1, 192, 360) + b" " * 348)
+    return volume
+
+
+def scene_data(rows=37, columns=29):
+    rng = np.random.default_rng(0)
+    return (rng.normal(size=(4, rows, columns)) + 1j * rng.normal(size=(4, rows, columns))).astype(np.complex64) * 1000
+
+
+@pytest.mark.parametrize("value, expected", [("-83.5000000", -83.5), ("-115.0000000", -115.0),
+                                             ("", None), ("nan", None), (None, None)])
+def test_calibration_factor(tmp_path, value, expected):
+    leader = tmp_path / f"LED-{SCENE}"
+    write_leader(leader, value)
+    assert read_calibration_factor(leader) == expected
+
+
+def test_calibration_constant():
+    # CF - 32 dB for Level 1.1, unless the factor already includes the offset
+    assert calibration_constant(-83.0) == pytest.approx(10 ** (-115 / 10))
+    assert calibration_constant(-115.0) == pytest.approx(10 ** (-115 / 10))
+    assert calibration_constant(-100.0) == pytest.approx(10 ** (-100 / 10))
+    assert calibration_constant(-99.0) == pytest.approx(10 ** (-131 / 10))
+
+
+@pytest.mark.parametrize("suffix", [0, 24])
+def test_image_layout(tmp_path, suffix):
+    path = tmp_path / f"IMG-HH-{SCENE}"
+    write_image(path, scene_data()[0], suffix)
+    assert image_layout(path) == {"shape": (37, 29), "offset": 720, "record_length": PREFIX + 29 * 8 + suffix,
+                                  "prefix": PREFIX}
+
+
+def test_image_layout_errors(tmp_path):
+    path = tmp_path / f"IMG-HH-{SCENE}"
+    write_image(path, scene_data()[0], sample_format="IU2")
+    with pytest.raises(ValueError, match="C\\*8"):
+        image_layout(path)
+    write_image(path, scene_data()[0])
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - 1)
+    with pytest.raises(ValueError, match="truncated"):
+        image_layout(path)
+
+
+@pytest.mark.parametrize("suffix", [0, 24])
+def test_reader_paths_agree(tmp_path, suffix):
+    data = scene_data()
+    volume = write_product(tmp_path, data, suffix=suffix)
+    path = read_product(volume)["paths"]["HV"]
+    windows = [Window(0, 0, 29, 37), Window(3, 5, 10, 7), Window(20, 30, 16, 16), Window(28, 0, 1, 37)]
+    with CeosImageReader(path, memmap=True) as mapped, CeosImageReader(path, memmap=False) as read:
+        assert mapped.memory_mapped and not read.memory_mapped
+        for window in windows:
+            expected = data[1][window.toslices()]
+            for reader in (mapped, read):
+                tile = reader.read(window)
+                assert tile.dtype == np.complex64
+                np.testing.assert_array_equal(tile, expected)
+        for step in (1, 3, 8):
+            np.testing.assert_array_equal(mapped.read_decimated(step), data[1][::step, ::step])
+            np.testing.assert_array_equal(read.read_decimated(step), data[1][::step, ::step])
+
+        # The threads of a run share the reader
+        rows = [Window(0, row, 29, 1) for row in range(37)] * 4
+        with ThreadPoolExecutor(8) as pool:
+            for window, tile in zip(rows, pool.map(read.read, rows)):
+                np.testing.assert_array_equal(tile, data[1][window.toslices()])
+
+
+def test_read_product(tmp_path):
+    volume = write_product(tmp_path, scene_data())
+    product = read_product(volume)
+    assert product["shape"] == (37, 29)
+    assert product["satellite"] == "ALOS"
+    assert product["calibration_factor"] == -83.5
+    assert product["leader"] == str(tmp_path / f"LED-{SCENE}")
+    assert load_calibration("ALOS", volume)["const"] == pytest.approx(10 ** (-115.5 / 10))
+    assert alos_calibration(product["calibration_factor"]) == load_calibration("ALOS", volume)
+
+
+def test_missing_leader_uses_the_default_factor(tmp_path):
+    volume = write_product(tmp_path, scene_data(), calibration_factor=False)
+    assert read_product(volume)["calibration_factor"] is None
+    assert load_calibration("ALOS", volume)["const"] == pytest.approx(10 ** (-115 / 10))
+    assert alos_calibration(None) == load_calibration("ALOS", volume)
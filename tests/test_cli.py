@@ -0,0 +1,88 @@
+import pytest
+from cli import build_parser, main
+from conftest import assert_same_outputs
+from pipeline import ellipse_mode, load_calibration, run_tiled
+
+
+def rs2_arguments(scene, *options):
+    paths, lut = scene
+    return ["--sensor", "RADARSAT2", "--images", *paths.values(), "--lut", lut, *options]
+
+
+def test_defaults():
+    args = build_parser().parse_args(["--sensor", "ALOS", "--images", "VOL", "--mode", "RHV",
+                                      "--products", "covariance"])
+    assert (args.tile_size, args.workers, args.prefetch, args.processes) == (1024, 1, 2, False)
+    assert (args.precision, args.output_dtype, args.layout, args.format) == ("reference", "float32", "single",
+                                                                            "geotiff")
+    assert (args.looks, args.speckle_filter, args.filter_size) == ([1, 1], None, 7)
+    assert args.cache_dir is None and args.dask is None
+
+
+def test_repeated_options():
+    args = build_parser().parse_args(["--sensor", "ALOS", "--images", "VOL", "--mode", "RHV", "pi4",
+                                      "--ellipse", "30", "10", "--ellipse", "0", "-45", "--products", "dop",
+                                      "--cache-dir", "--dask"])
+    assert args.mode == ["RHV", "pi4"]
+    assert args.ellipse == [[30.0, 10.0], [0.0, -45.0]]
+    assert (args.cache_dir, args.dask) == ("~/.cache/CompactSAR", "threads")
+
+
+@pytest.mark.parametrize("options", [
+    ["--mode", "RHV"],
+    ["--sensor", "ERS", "--mode", "RHV", "--products", "covariance"],
+    ["--mode", "CTLR", "--products", "covariance"],
+    ["--mode", "RHV", "--products", "covariance", "--tile-size", "many"],
+    ["--mode", "RHV", "--products", "covariance", "--window", "0", "0", "8", "8", "--bbox", "0", "0", "1", "1"],
+])
+def test_invalid_arguments(options):
+    # Rejected by the parser: missing --products, unknown choices, bad types, two regions
+    with pytest.raises(SystemExit) as error:
+        build_parser().parse_args(options if "--sensor" in options else ["--sensor", "RADARSAT2", *options])
+    assert error.value.code == 2
+
+
+@pytest.mark.parametrize("options, message", [
+    (["--products", "covariance"], "at least one --mode"),
+    (["--mode", "RHV", "--products", "covariance", "--tile-size", "0"], "--tile-size must be at least 1"),
+    (["--mode", "RHV", "--products", "covariance", "--workers", "0"], "--workers must be at least 1"),
+    (["--mode", "RHV", "--products", "covariance", "--dask", "--cache-dir"], "--dask can't be combined"),
+    (["--mode", "RHV", "--products", "covariance", "--dask", "--window", "0", "0", "8", "8"],
+     "--dask can't be combined"),
+    (["--mode", "RHV", "--products", "covariance", "--format", "zarr", "--cog"], "only apply to GeoTIFF"),
+    (["--mode", "RHV", "--products", "covariance", "--format", "zarr", "--output-dtype", "int16"],
+     "complex64 and float32"),
+    (["--mode", "RHV", "--products", "covariance", "--format", "zarr", "--compress", "lzw"], "zstd or deflate"),
+])
+def test_rejected_options(rs2_scene, capsys, options, message):
+    with pytest.raises(SystemExit) as error:
+        main(rs2_arguments(rs2_scene, *options))
+    assert error.value.code == 2
+    assert message in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("arguments, message", [
+    (["--sensor", "RADARSAT2"], "Give the input --images"),
+    (["--sensor", "RADARSAT2", "--images", "HH.tif", "HV.tif", "--lut", "lut.xml"], "exactly 4 images"),
+    (["--sensor", "RADARSAT2", "--images", "HH.tif", "HV.tif", "VH.tif", "VV.tif"], "--lut"),
+    (["--sensor", "RADARSAT2", "--product", "RS2", "--lut", "lut.xml"], "--product replaces"),
+    (["--sensor", "ALOS", "--product", "RS2"], "only available for RADARSAT-2"),
+    (["--sensor", "ALOS", "--images", "VOL", "IMG"], "exactly 1 VOL file"),
+])
+def test_rejected_inputs(capsys, arguments, message):
+    with pytest.raises(SystemExit) as error:
+        main([*arguments, "--mode", "RHV", "--products", "covariance"])
+    assert error.value.code == 2
+    assert message in capsys.readouterr().err
+
+
+def test_run_matches_run_tiled(rs2_scene, tmp_path):
+    # Options are passed on to run_tiled as given
+    assert main(rs2_arguments(rs2_scene, "--mode", "RHV", "--ellipse", "30", "10", "--products", "covariance",
+                              "--tile-size", "32", "--workers", "2", "--looks", "2", "2",
+                              "--output-dir", str(tmp_path / "cli"), "--no-report")) == 0
+    paths, lut = rs2_scene
+    run_tiled(paths, "RADARSAT2", load_calibration("RADARSAT2", lut), ["RHV", ellipse_mode(30, 10)], ["covariance"],
+              output_root=str(tmp_path / "expected"), tile_size=32, looks=(2, 2), report=None,
+              log=lambda message: None)
+    assert_same_outputs(tmp_path / "cli", tmp_path / "expected")
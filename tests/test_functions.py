@@ -0,0 +1,265 @@
+import numpy as np
+import pytest
+from functions import (ALOS_calibration, FP_scattering_matrix, LHV_simulator, RHV_simulator, Radarsat2_calibration,
+                       boxcar_filter, covariance_matrix_function, cp_synthesis_kernel, ellipse_simulator,
+                       fp_scattering_kernel, fused_cp_kernel, pi4_simulator, refined_lee_filter,
+                       transmit_jones_vector)
+
+SIMULATORS = {"RHV": RHV_simulator, "LHV": LHV_simulator, "pi4": pi4_simulator}
+PRODUCTS = ["scattering", "covariance"]
+# Below and above the size from which numpy reuses temporaries (functions.ELIDE_BYTES)
+SHAPES = [(37, 53), (150, 170)]
+# The circular and pi4 modes as transmitted ellipses (orientation, ellipticity)
+ELLIPSES = {"RHV": (0, -45), "LHV": (0, 45), "pi4": (45, 0)}
+
+
+def rs2_tile(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    IQ = [rng.integers(-3000, 3000, (2, *shape)).astype(np.int16) for _ in range(4)]
+    gains = rng.uniform(500, 900, shape[1]).astype(np.float32)
+    return IQ, {"gains": gains, "offset": 0.0}
+
+
+def alos_tile(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    IQ = [(rng.normal(size=shape) + 1j * rng.normal(size=shape)).astype(np.complex64) * 1000 for _ in range(4)]
+    return IQ, {"const": 10 ** (-83 / 10)}
+
+
+TILES = {"RADARSAT2": rs2_tile, "ALOS": alos_tile}
+
+
+def calibrated_parts(IQ, calibration):
+    # (I, Q) of HH, HV, VH, VV from Radarsat2_calibration/ALOS_calibration
+    if "gains" in calibration:
+        return [Radarsat2_calibration(band, calibration["gains"], calibration["offset"], band.shape[1])
+                for band in IQ]
+    return [ALOS_calibration(band, calibration["const"])[:2] for band in IQ]
+
+
+def reference_fp_matrix(IQ, calibration):
+    # Radarsat2_calibration/ALOS_calibration -> FP_scattering_matrix
+    return FP_scattering_matrix(*[part for band in calibrated_parts(IQ, calibration) for part in band])
+
+
+def reference_bands(IQ, calibration, mode):
+    S11, S21 = SIMULATORS[mode](*reference_fp_matrix(IQ, calibration))
+    C11, C12, C22 = covariance_matrix_function(S11, S21)
+    return {"S11_real": S11.real, "S11_imag": S11.imag, "S21_real": S21.real, "S21_imag": S21.imag,
+            "C11": C11, "C12_real": C12.real, "C12_imag": C12.imag, "C22": C22}
+
+
+def assert_identical(results, expected):
+    assert set(results) == set(expected)
+    for name, data in expected.items():
+        assert results[name].dtype == data.dtype, name
+        np.testing.assert_array_equal(results[name], data, err_msg=name)
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("mode", ["RHV", "LHV", "pi4"])
+@pytest.mark.parametrize("sensor", ["RADARSAT2", "ALOS"])
+def test_fused_kernel_matches_reference_chain(sensor, mode, shape):
+    IQ, calibration = TILES[sensor](shape)
+    assert_identical(fused_cp_kernel(*IQ, mode, PRODUCTS, **calibration), reference_bands(IQ, calibration, mode))
+
+
+@pytest.mark.parametrize("sensor", ["RADARSAT2", "ALOS"])
+def test_fp_scattering_kernel_matches_reference(sensor):
+    IQ, calibration = TILES[sensor](SHAPES[0])
+    for result, expected in zip(fp_scattering_kernel(*IQ, **calibration), reference_fp_matrix(IQ, calibration)):
+        assert result.dtype == expected.dtype
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("sensor", ["RADARSAT2", "ALOS"])
+def test_buffers_are_reused_across_tile_shapes(sensor):
+    # The scratch buffers follow the shape of every tile, and are kept while it doesn't change
+    buffers = {}
+    previous_shape = None
+    for index, shape in enumerate([SHAPES[0], SHAPES[1], SHAPES[1], SHAPES[0][::-1], SHAPES[0]]):
+        IQ, calibration = TILES[sensor](shape, seed=index)
+        previous = dict(buffers)
+        results = fused_cp_kernel(*IQ, "RHV", PRODUCTS, **calibration, buffers=buffers)
+        assert_identical(results, reference_bands(IQ, calibration, "RHV"))
+        assert all(buffer.shape == shape for buffer in buffers.values())
+        if shape == previous_shape:
+            assert all(buffers[name] is buffer for name, buffer in previous.items())
+        previous_shape = shape
+
+
+def test_synthesis_in_place_overwrites_the_fp_matrix():
+    IQ, calibration = rs2_tile(SHAPES[0])
+    buffers = {}
+    S11, S12, S22 = fp_scattering_kernel(*IQ, **calibration, buffers=buffers)
+    results = cp_synthesis_kernel(S11, S12, S22, "RHV", PRODUCTS, buffers, preserve=False)
+    assert np.shares_memory(results["S11_real"], S11)
+    assert np.shares_memory(results["S21_real"], S22)
+    assert np.shares_memory(results["C12_real"], S12)
+    assert_identical(results, reference_bands(IQ, calibration, "RHV"))
+
+
+@pytest.mark.parametrize("mode", ["RHV", "LHV", "pi4", (30, 10)])
+def test_synthesis_with_preserve_keeps_the_fp_matrix(mode):
+    IQ, calibration = rs2_tile(SHAPES[0])
+    buffers = {}
+    S11, S12, S22 = fp_scattering_kernel(*IQ, **calibration, buffers=buffers)
+    fp_matrix = [S11.copy(), S12.copy(), S22.copy()]
+    results = cp_synthesis_kernel(S11, S12, S22, mode, PRODUCTS, buffers, preserve=True)
+    for element, expected in zip((S11, S12, S22), fp_matrix):
+        np.testing.assert_array_equal(element, expected)
+    for data in results.values():
+        assert not any(np.shares_memory(data, element) for element in (S11, S12, S22))
+
+
+@pytest.mark.parametrize("mode", ["RHV", "LHV", "pi4"])
+def test_jones_vectors_of_the_simulators(mode):
+    # The simulators transmit (h, v) / sqrt(2) with h, v in {1, j, -j}
+    expected = {"RHV": (1, -1j), "LHV": (1, 1j), "pi4": (1, 1)}[mode]
+    h, v = transmit_jones_vector(*ELLIPSES[mode])
+    np.testing.assert_allclose(np.sqrt(2) * np.array([h, v]), expected, atol=1e-15)
+
+
+@pytest.mark.parametrize("mode", ["RHV", "LHV", "pi4"])
+def test_ellipses_reproduce_the_simulators(mode):
+    # Same channels up to the rounding of the 1/sqrt(2) scaling (cos(45) vs 1 / np.sqrt(2))
+    IQ, calibration = rs2_tile(SHAPES[0])
+    fp_matrix = reference_fp_matrix(IQ, calibration)
+    for result, expected in zip(ellipse_simulator(*fp_matrix, *ELLIPSES[mode]), SIMULATORS[mode](*fp_matrix)):
+        np.testing.assert_allclose(result, expected, rtol=1e-14, atol=1e-14 * np.abs(expected).max())
+
+    ellipse = fused_cp_kernel(*IQ, ELLIPSES[mode], PRODUCTS, **calibration)
+    for name, expected in reference_bands(IQ, calibration, mode).items():
+        np.testing.assert_allclose(ellipse[name], expected, rtol=1e-13, atol=1e-13 * np.abs(expected).max(),
+                                   err_msg=name)
+
+
+@pytest.mark.parametrize("sensor", ["RADARSAT2", "ALOS"])
+def test_several_modes_from_one_read(sensor):
+    # One FP matrix synthesized into every mode with preserve=True (the last one in place), as
+    # process_tile does, gives the results of a separate run per mode
+    IQ, calibration = TILES[sensor](SHAPES[0])
+    modes = ["RHV", "LHV", "pi4", (30, 10)]
+    buffers = {}
+    S11, S12, S22 = fp_scattering_kernel(*IQ, **calibration, buffers=buffers)
+    for index, mode in enumerate(modes):
+        last = index == len(modes) - 1
+        results = {name: data.copy() for name, data in
+                   cp_synthesis_kernel(S11, S12, S22, mode, PRODUCTS, buffers, preserve=not last).items()}
+        assert_identical(results, fused_cp_kernel(*IQ, mode, PRODUCTS, **calibration))
+
+
+def wide_range_tile(sensor, shape, seed=0):
+    # Tiles whose pixel powers span 60 dB
+    rng = np.random.default_rng(seed)
+    amplitude = 10 ** rng.uniform(0, 3, (4, *shape))
+    phase = rng.uniform(-np.pi, np.pi, (4, *shape))
+    if sensor == "RADARSAT2":
+        amplitude *= 30
+        IQ = [np.stack([np.rint(a * np.cos(p)), np.rint(a * np.sin(p))]).astype(np.int16)
+              for a, p in zip(amplitude, phase)]
+        return IQ, {"gains": rng.uniform(500, 900, shape[1]).astype(np.float32), "offset": 0.0}
+    IQ = [(a * np.exp(1j * p)).astype(np.complex64) for a, p in zip(amplitude, phase)]
+    return IQ, {"const": 10 ** (-83 / 10)}
+
+
+@pytest.mark.parametrize("mode", ["RHV", "LHV", "pi4"])
+@pytest.mark.parametrize("sensor", ["RADARSAT2", "ALOS"])
+def test_float32_precision_bounds(sensor, mode):
+    # The bounds of the README: 4u sqrt(P) for the scattering vector and 8u P for C2
+    u = 2.0 ** -24
+    IQ, calibration = wide_range_tile(sensor, (64, 64))
+    power = sum(I * I + Q * Q for I, Q in calibrated_parts(IQ, calibration))
+    reference = fused_cp_kernel(*IQ, mode, PRODUCTS, **calibration)
+    reference = {name: data.copy() for name, data in reference.items()}
+    single = fused_cp_kernel(*IQ, mode, PRODUCTS, **calibration, dtype=np.float32)
+    assert single["C11"].dtype == np.float32
+
+    def element(bands, name):
+        if name in ("C11", "C22"):
+            return bands[name].astype(np.float64)
+        return bands[f"{name}_real"].astype(np.float64) + 1j * bands[f"{name}_imag"]
+
+    for name in ("S11", "S21"):
+        error = np.abs(element(single, name) - element(reference, name))
+        assert np.all(error <= 4 * u * np.sqrt(power)), name
+    for name in ("C11", "C12", "C22"):
+        error = np.abs(element(single, name) - element(reference, name))
+        assert np.all(error <= 8 * u * power), name
+
+
+def window_mean(array, row, col, half, mask=None):
+    # Mean of the pixels of array within half of (row, col), and inside mask (size x size) if given
+    total, count = 0, 0
+    for i in range(-half, half + 1):
+        for j in range(-half, half + 1):
+            inside = 0 <= row + i < array.shape[0] and 0 <= col + j < array.shape[1]
+            if inside and (mask is None or mask[i + half, j + half]):
+                total += array[row + i, col + j]
+                count += 1
+    return total / count
+
+
+def direct_refined_lee(C11, C12, C22, size, looks):
+    # Pixel by pixel: the 3 x 3 sub-window means of the span (clamped to the array), the edge
+    # direction of the largest gradient, its half window on the side of the centre, and the
+    # local linear MMSE estimate from the span statistics of that half window
+    rows, cols = C11.shape
+    half = size // 2
+    sub = 2 * (size // 4) + 1
+    step = (size - sub) // 2
+    span = C11 + C22
+    offsets = np.arange(size) - half
+    di, dj = np.meshgrid(offsets, offsets, indexing="ij")
+    masks = [dj <= 0, dj >= 0, di >= dj, di <= dj, di <= 0, di >= 0, di + dj <= 0, di + dj >= 0]
+    filtered = [np.zeros_like(element) for element in (C11, C12, C22)]
+    for row in range(rows):
+        for col in range(cols):
+            m = [[window_mean(span, min(max(row + i * step, 0), rows - 1), min(max(col + j * step, 0), cols - 1),
+                              sub // 2) for j in (-1, 0, 1)] for i in (-1, 0, 1)]
+            sides = [
+                (m[0][0] + m[1][0] + m[2][0], m[0][2] + m[1][2] + m[2][2]),
+                (m[1][0] + m[2][0] + m[2][1], m[0][1] + m[0][2] + m[1][2]),
+                (m[0][0] + m[0][1] + m[0][2], m[2][0] + m[2][1] + m[2][2]),
+                (m[0][0] + m[0][1] + m[1][0], m[1][2] + m[2][1] + m[2][2]),
+            ]
+            gradients = [abs(second - first) for first, second in sides]
+            direction = gradients.index(max(gradients))
+            first, second = sides[direction]
+            centre = 3 * m[1][1]
+            mask = masks[2 * direction + int(abs(second - centre) < abs(first - centre))]
+
+            mean_y = window_mean(span, row, col, half, mask)
+            var_y = max(window_mean(span * span, row, col, half, mask) - mean_y ** 2, 0)
+            var_x = max((var_y - mean_y ** 2 / looks) / (1 + 1 / looks), 0)
+            b = var_x / var_y if var_y > 0 else 0
+            for result, element in zip(filtered, (C11, C12, C22)):
+                mean = window_mean(element, row, col, half, mask)
+                result[row, col] = mean + b * (element[row, col] - mean)
+    return filtered
+
+
+@pytest.fixture
+def covariance():
+    # C2 of a tile, 13 dB brighter right of column 15 so that the refined Lee filter sees an edge
+    IQ, calibration = rs2_tile((23, 31))
+    C2 = fused_cp_kernel(*IQ, "RHV", ["covariance"], **calibration)
+    C11, C12, C22 = C2["C11"].copy(), C2["C12_real"] + 1j * C2["C12_imag"], C2["C22"].copy()
+    for element in (C11, C12, C22):
+        element[:, 15:] *= 20
+    return C11, C12, C22
+
+
+@pytest.mark.parametrize("size", [3, 5])
+def test_boxcar_filter_matches_the_window_means(covariance, size):
+    for element in covariance:
+        expected = np.array([[window_mean(element, row, col, size // 2) for col in range(element.shape[1])]
+                             for row in range(element.shape[0])])
+        np.testing.assert_allclose(boxcar_filter(element, size), expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize("size, looks", [(5, 1), (7, 4), (9, 4)])
+def test_refined_lee_filter_matches_the_direct_computation(covariance, size, looks):
+    results = refined_lee_filter(*covariance, size, looks)
+    for result, expected in zip(results, direct_refined_lee(*covariance, size, looks)):
+        np.testing.assert_allclose(result, expected, rtol=1e-9, atol=1e-12 * np.abs(expected).max())
@@ -0,0 +1,172 @@
+import json
+import numpy as np
+import pytest
+import rasterio
+from conftest import assert_same_outputs
+from functions import fused_cp_kernel, multilook_covariance
+from metrics import RunMetrics
+from pipeline import (ProcessingCancelled, TileJournal, encode_output, ellipse_mode, estimate_memory, fitting_workers,
+                      load_calibration, make_job, process_tile, run_tiled, tile_plans)
+from test_functions import rs2_tile, wide_range_tile
+
+PRODUCTS = ["scattering", "covariance", "stokes"]
+
+
+def tile_outputs(tile, plan, job):
+    return {(mode, name): data for mode, _, bands in process_tile(tile, plan, job) for name, data in bands.items()}
+
+
+def test_several_modes_from_one_read():
+    # Every mode of a multi-mode job gives the results of its own single-mode job
+    IQ, calibration = rs2_tile((40, 60))
+    tile = dict(zip(["HH", "HV", "VH", "VV"], IQ))
+    modes = ["RHV", "LHV", "pi4", ellipse_mode(30, 10)]
+    plan = next(tile_plans(40, 60, tile_size=64, looks=(2, 2)))
+    outputs = tile_outputs(tile, plan, make_job("RADARSAT2", calibration, modes, PRODUCTS, looks=(2, 2)))
+    for mode in modes:
+        single = tile_outputs(tile, plan, make_job("RADARSAT2", calibration, mode, PRODUCTS, looks=(2, 2)))
+        assert single
+        for key, data in single.items():
+            np.testing.assert_array_equal(outputs[key], data, err_msg=str(key))
+    assert len(outputs) == len(modes) * len(single)
+
+
+@pytest.fixture
+def wide_range_covariance():
+    # C11 and C22 of a tile whose FP powers span 60 dB
+    IQ, calibration = wide_range_tile("RADARSAT2", (64, 64))
+    results = fused_cp_kernel(*IQ, "RHV", ["covariance"], **calibration)
+    return np.concatenate([results["C11"].ravel(), results["C22"].ravel(), -results["C11"].ravel()])
+
+
+def test_float16_output_error(wide_range_covariance):
+    # A relative error of at most 2^-11 in the normal range of float16
+    data = wide_range_covariance
+    encoded = encode_output(data, "float16")
+    assert encoded.dtype == np.float32
+    normal = (np.abs(data) >= 2.0 ** -14) & (np.abs(data) <= 65504)
+    assert normal.sum() > 0.9 * data.size
+    assert np.all(np.abs(encoded[normal] - data[normal]) <= 2.0 ** -11 * np.abs(data[normal]))
+
+
+@pytest.mark.parametrize("scale", [1e-4, 1e-2, 1.0])
+def test_int16_output_error(wide_range_covariance, scale):
+    # round(value / scale): an absolute error of at most scale / 2, values beyond 32767 * scale clipped
+    data = wide_range_covariance
+    encoded = encode_output(data, "int16", scale)
+    assert encoded.dtype == np.int16
+    inside = np.abs(data) <= 32767 * scale
+    assert inside.any()
+    decoded = encoded.astype(np.float64) * scale
+    assert np.all(np.abs(decoded[inside] - data[inside]) <= scale / 2 * (1 + 1e-9))
+    np.testing.assert_array_equal(encoded[~inside], np.sign(data[~inside]) * 32767)
+
+
+def run_scene(scene, output_root, **options):
+    paths, lut = scene
+    options = dict({"tile_size": 32, "log": lambda message: None}, **options)
+    return run_tiled(paths, "RADARSAT2", load_calibration("RADARSAT2", lut), ["RHV", "pi4"],
+                     ["scattering", "covariance"], output_root=str(output_root), **options)
+
+
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_cancelled_run_resumes_to_identical_outputs(rs2_scene, tmp_path, prefetch):
+    run_scene(rs2_scene, tmp_path / "expected")
+
+    journal_path = str(tmp_path / "out" / "journal.txt")
+    written = []
+    with pytest.raises(ProcessingCancelled):
+        run_scene(rs2_scene, tmp_path / "out", prefetch=prefetch, journal=TileJournal(journal_path, "run"),
+                  progress=lambda done, total: written.append(done), cancel=lambda: len(written) >= 3)
+    journal = TileJournal(journal_path, "run")
+    assert 3 <= len(journal.done) < 12
+
+    metrics = RunMetrics()
+    run_scene(rs2_scene, tmp_path / "out", prefetch=prefetch, journal=journal, metrics=metrics)
+    assert_same_outputs(tmp_path / "out", tmp_path / "expected")
+    # The tiles of the first run count as done
+    snapshot = metrics.snapshot()
+    assert snapshot["tiles_done"] == snapshot["tiles_total"] == 12
+    assert snapshot["tiles_resumed"] >= 3
+    assert metrics.summary().startswith(f"12/12 tiles ({snapshot['tiles_resumed']} resumed)")
+    with open(tmp_path / "out" / "run_report.json") as file:
+        report = json.load(file)
+    assert (report["status"], report["tiles_done"], report["tiles_total"]) == ("completed", 12, 12)
+
+
+def test_journal_of_other_parameters_is_discarded(tmp_path):
+    path = str(tmp_path / "journal.txt")
+    journal = TileJournal(path, "tile_size=32")
+    for index in (0, 1, 5):
+        journal.record(index)
+    journal.commit()
+    assert TileJournal(path, "tile_size=32").done == {0, 1, 5}
+
+    assert TileJournal(path, "tile_size=64").done == set()
+    with open(path) as file:
+        assert file.read() == "tile_size=64\n"
+    assert TileJournal(path, "tile_size=32").done == set()
+
+
+def test_resume_with_other_parameters_recomputes_every_tile(rs2_scene, tmp_path):
+    journal_path = str(tmp_path / "out" / "journal.txt")
+    written = []
+    with pytest.raises(ProcessingCancelled):
+        run_scene(rs2_scene, tmp_path / "out", journal=TileJournal(journal_path, "tile_size=32"), prefetch=0,
+                  progress=lambda done, total: written.append(done), cancel=lambda: len(written) >= 3)
+    # The interrupted outputs were written with other parameters; none of their tiles is kept
+    run_scene(rs2_scene, tmp_path / "out", tile_size=64, journal=TileJournal(journal_path, "tile_size=64"))
+    run_scene(rs2_scene, tmp_path / "expected", tile_size=64)
+    assert_same_outputs(tmp_path / "out", tmp_path / "expected")
+
+
+def test_fitting_workers():
+    job = make_job("RADARSAT2", None, ["RHV", "pi4"], PRODUCTS)
+    memory = estimate_memory(job, 1024, 3, 2)
+    assert fitting_workers(job, 1024, 2, memory, limit=8) == 3
+    assert fitting_workers(job, 1024, 2, memory - 1, limit=8) == 2
+    assert fitting_workers(job, 1024, 2, memory, limit=2) == 2
+    # Smaller tiles fit more workers, and one worker is always left
+    assert fitting_workers(job, 512, 2, memory, limit=8) > 3
+    assert fitting_workers(job, 1024, 2, 0, limit=8) == 1
+    assert fitting_workers(job, 1024, 2, None, limit=8) == 8
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_pipelined_runs_match_the_sequential_run(rs2_scene, tmp_path, use_processes):
+    # workers <= 1 with prefetch 0 runs the tiles one after another; anything else goes through run_pipelined
+    run_scene(rs2_scene, tmp_path / "expected", workers=1, prefetch=0, looks=(2, 2), speckle_filter="boxcar")
+    for workers in (0, 1, 3):
+        for prefetch in (0, 3):
+            if workers <= 1 and prefetch == 0:
+                continue
+            output_root = tmp_path / f"workers_{workers}_prefetch_{prefetch}"
+            run_scene(rs2_scene, output_root, workers=workers, prefetch=prefetch, use_processes=use_processes,
+                      looks=(2, 2), speckle_filter="boxcar")
+            assert_same_outputs(output_root, tmp_path / "expected")
+
+
+@pytest.mark.parametrize("speckle_filter", ["boxcar", "refined_lee"])
+def test_filtered_outputs_dont_depend_on_the_tile_size(rs2_scene, tmp_path, speckle_filter):
+    # With the halo of the filter around every tile, tiles of any size give the whole-scene result
+    paths, lut = rs2_scene
+    calibration = load_calibration("RADARSAT2", lut)
+    IQ = []
+    for pol in ["HH", "HV", "VH", "VV"]:
+        with rasterio.open(paths[pol]) as dataset:
+            IQ.append(dataset.read())
+    C2 = fused_cp_kernel(*IQ, "RHV", ["covariance"], **calibration)
+    C11, C12, C22 = multilook_covariance(C2["C11"], C2["C12_real"] + 1j * C2["C12_imag"], C2["C22"], (2, 3),
+                                         speckle_filter, 5)
+    expected = {"C11": C11, "C12_real": C12.real, "C12_imag": C12.imag, "C22": C22}
+
+    for tile_size in (16, 32, 256):
+        output_root = tmp_path / str(tile_size)
+        run_scene(rs2_scene, output_root, tile_size=tile_size, looks=(2, 3), speckle_filter=speckle_filter,
+                  filter_size=5)
+        for name, data in expected.items():
+            with rasterio.open(output_root / "C2_RHV" / f"{name}.tif") as dataset:
+                np.testing.assert_allclose(dataset.read(1), data, rtol=1e-6, atol=1e-6 * np.abs(data).max(),
+                                           err_msg=f"{tile_size} {name}")
+        if tile_size != 16:
+            assert_same_outputs(output_root, tmp_path / "16")
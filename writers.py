@@ -0,0 +1,377 @@
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from functions import reference_meta
+
+SCATTERING_BANDS = ["S11_real", "S11_imag", "S21_real", "S21_imag"]
+COVARIANCE_BANDS = ["C11", "C12_real", "C12_imag", "C22"]
+
+# Folder/file prefix and band names of every product
+PRODUCTS = {
+    "scattering": ("S2", SCATTERING_BANDS),
+    "covariance": ("C2", COVARIANCE_BANDS),
+    "stokes": ("Stokes", ["g0", "g1", "g2", "g3"]),
+    "dop": ("DoP", ["m"]),
+    "m_chi": ("m_chi", ["m_chi_even", "m_chi_volume", "m_chi_odd"]),
+    "m_delta": ("m_delta", ["m_delta_even", "m_delta_volume", "m_delta_odd"]),
+    "ratio": ("Ratio", ["ratio"]),
+}
+
+# Bands that the complex layout stores as a single CFloat32 band
+COMPLEX_BANDS = {
+    "S11": ("S11_real", "S11_imag"),
+    "S21": ("S21_real", "S21_imag"),
+}
+
+# Bands kept at full resolution when C2 is multilooked
+FULL_RESOLUTION_BANDS = set(SCATTERING_BANDS) | set(COMPLEX_BANDS)
+
+# single: one file per band in <prefix>_<mode>/ (the original layout)
+# multiband: one <prefix>_<mode>.tif per product
+# complex: like multiband, but the scattering vector as CFloat32 bands
+LAYOUTS = ["single", "multiband", "complex"]
+
+COMPRESSIONS = ["deflate", "zstd", "lerc", "lzw"]
+
+DEFAULT_BLOCK_SIZE = 256
+
+# geotiff: the GeoTIFFs of the layouts above; zarr: one chunked Zarr store (see ZarrWriter)
+OUTPUT_FORMATS = ["geotiff", "zarr"]
+
+STORE_NAME = "CP.zarr"
+
+# Bands stored as complex64 arrays in a Zarr store
+STORE_COMPLEX_BANDS = dict(COMPLEX_BANDS, C12=("C12_real", "C12_imag"))
+
+ZARR_COMPRESSIONS = ["zstd", "deflate"]
+
+
+def output_files(output_root, mode, products, layout="single"):
+    # Maps every output file to the bands it stores, in band order
+    files = {}
+    for product in products:
+        prefix, band_names = PRODUCTS[product]
+        folder = prefix + "_" + mode
+        if layout == "single":
+            for name in band_names:
+                files[os.path.join(output_root, folder, name + ".tif")] = [name]
+        elif layout == "complex" and product == "scattering":
+            files[os.path.join(output_root, folder + ".tif")] = list(COMPLEX_BANDS)
+        else:
+            files[os.path.join(output_root, folder + ".tif")] = list(band_names)
+    return files
+
+
+def overview_factors(rows, columns, block_size=DEFAULT_BLOCK_SIZE):
+    factors = []
+    factor = 2
+    while max(rows, columns) / factor >= block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+class GeoTiffWriter:
+    # Opens every output once, with a profile derived from a single read of the
+    # reference image, and writes result tiles into them window by window.
+    # Any thread can write, but only one at a time (GDAL datasets aren't thread-safe);
+    # run_pipelined's writer thread is the only one that writes during a run
+    parallel = False
+
+    def __init__(self, output_root, mode, products, reference_image_path, output_dtype="float32",
+                 int16_scale=1e-4, layout="single", compress=None, tiled=False,
+                 block_size=DEFAULT_BLOCK_SIZE, overviews=False, cog=False, looks=(1, 1), resume=False,
+                 meta=None):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown output layout: {layout}")
+        if compress is not None and compress not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compress}")
+        if layout == "complex" and output_dtype != "float32":
+            raise ValueError("The complex layout can only be written as float32.")
+
+        self.files = output_files(output_root, mode, products, layout)
+        self.output_dtype = output_dtype
+        self.int16_scale = int16_scale
+        self.layout = layout
+        self.compress = compress
+        self.block_size = block_size
+        self.overviews = overviews
+        self.cog = cog
+        self.looks = tuple(looks)
+        self.resume = resume
+        # meta replaces the profile of reference_image_path, for inputs GDAL doesn't read
+        self.meta = meta if meta is not None else reference_meta(reference_image_path)
+        self.datasets = {}
+        self.targets = {}
+
+        profile = self.meta.copy()
+        profile.update({
+            'dtype': 'int16' if output_dtype == "int16" else 'float32',
+            'driver': 'GTiff'
+        })
+        if output_dtype == "float16":
+            profile['nbits'] = 16
+        # Compressed strips would be rewritten by every tile, so compression implies internal tiling
+        if tiled or compress or cog:
+            profile.update({'tiled': True, 'blockxsize': block_size, 'blockysize': block_size})
+        if compress and not cog:
+            profile['compress'] = compress
+            if compress != "lerc" and output_dtype != "float16":
+                profile['predictor'] = 2 if output_dtype == "int16" else 3
+        self.profile = profile
+
+    def open(self):
+        for path, band_names in self.files.items():
+            if self.resume and os.path.exists(self.staging_path(path)):
+                # Outputs of an interrupted run are completed in place
+                dataset = rasterio.open(self.staging_path(path), 'r+')
+            else:
+                dataset = self.create(path, band_names)
+
+            self.datasets[path] = dataset
+            for index, name in enumerate(band_names, start=1):
+                self.targets[name] = (path, index)
+        return self
+
+    def create(self, path, band_names):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        profile = dict(self.profile, count=len(band_names))
+        if band_names[0] not in FULL_RESOLUTION_BANDS and self.looks != (1, 1):
+            looks_rows, looks_cols = self.looks
+            profile.update({
+                'height': -(-profile['height'] // looks_rows),
+                'width': -(-profile['width'] // looks_cols),
+                'transform': profile['transform'] * Affine.scale(looks_cols, looks_rows)
+            })
+        if band_names[0] in COMPLEX_BANDS:
+            profile['dtype'] = 'complex64'
+            profile.pop('predictor', None)
+
+        dataset = rasterio.open(self.staging_path(path), 'w', **profile)
+        if self.output_dtype == "int16":
+            dataset.scales = (self.int16_scale,) * len(band_names)
+        if self.layout != "single":
+            for index, name in enumerate(band_names, start=1):
+                dataset.set_band_description(index, name)
+        return dataset
+
+    def staging_path(self, path):
+        # COG can't be written block by block; tiles go to a plain GeoTIFF that is converted on close
+        return path + ".tmp.tif" if self.cog else path
+
+    def write(self, results, window):
+        for name, (path, index) in self.targets.items():
+            if name in COMPLEX_BANDS:
+                real, imag = COMPLEX_BANDS[name]
+                if real not in results:
+                    continue
+                data = np.empty(results[real].shape, dtype=np.complex64)
+                data.real = results[real]
+                data.imag = results[imag]
+            elif name in results:
+                data = results[name]
+            else:
+                continue
+            self.datasets[path].write(data, index, window=window)
+
+    def checkpoint(self):
+        # Closing flushes GDAL's block cache, so every tile written so far is on disk
+        for path, dataset in self.datasets.items():
+            dataset.close()
+            self.datasets[path] = rasterio.open(self.staging_path(path), 'r+')
+
+    def close(self):
+        for path, dataset in self.datasets.items():
+            if self.overviews and not self.cog and not dataset.closed:
+                factors = overview_factors(dataset.height, dataset.width, self.block_size)
+                if factors:
+                    dataset.build_overviews(factors, Resampling.average)
+                    dataset.update_tags(ns='rio_overview', resampling='average')
+            dataset.close()
+
+    def finalize(self):
+        # Only called after a successful run, so a failed run never leaves a half written COG
+        if not self.cog:
+            return
+        for path, band_names in self.files.items():
+            options = {'blocksize': self.block_size, 'overviews': 'AUTO' if self.overviews else 'NONE',
+                       'overview_resampling': 'average'}
+            if self.compress:
+                options['compress'] = self.compress
+                if (self.compress != "lerc" and self.output_dtype != "float16"
+                        and band_names[0] not in COMPLEX_BANDS):
+                    options['predictor'] = 'YES'
+            rasterio.shutil.copy(self.staging_path(path), path, driver='COG', **options)
+            rasterio.shutil.delete(self.staging_path(path))
+
+    def discard(self):
+        # Removes the (partially written) outputs of an aborted run
+        self.close()
+        for path in self.files:
+            for target in {path, self.staging_path(path)}:
+                if os.path.exists(target):
+                    rasterio.shutil.delete(target)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is None:
+            self.finalize()
+
+
+def import_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("Zarr outputs need zarr: pip install zarr") from None
+    return zarr
+
+
+def store_bands(products):
+    # Arrays of a mode in a Zarr store, in band order, with the complex bands joined
+    names = []
+    for product in products:
+        for name in PRODUCTS[product][1]:
+            name = next((band for band, parts in STORE_COMPLEX_BANDS.items() if name in parts), name)
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def geotransform(transform):
+    return " ".join(repr(value) for value in transform.to_gdal())
+
+
+class ZarrWriter:
+    # Writes the bands of a mode as the arrays of the <mode> group of one Zarr store,
+    # <output_root>/CP.zarr: S11, S21 and C12 complex64, the others float32. The arrays are
+    # chunked like the tiles of the run, so a tile write replaces whole chunks and tiles can be
+    # written in any order from any thread or process (a writer pickles as its store path).
+    # Modes and products are added to an existing store of the same scene without touching the
+    # others. Each group opens as an xarray Dataset, georeferenced like compactsar.to_dataset
+    parallel = True
+
+    def __init__(self, output_root, mode, products, meta, tile_size=1024, output_dtype="float32", compress=None,
+                 looks=(1, 1), resume=False):
+        if output_dtype != "float32":
+            raise ValueError("Zarr stores are written as complex64 and float32.")
+        if compress is not None and compress not in ZARR_COMPRESSIONS:
+            raise ValueError(f"Zarr stores can't be compressed with {compress}.")
+        self.store = os.path.join(output_root, STORE_NAME)
+        self.mode = mode
+        self.bands = store_bands(products)
+        self.files = {os.path.join(self.store, mode, name): [name] for name in self.bands}
+        self.meta = meta
+        self.compress = compress
+        self.looks = tuple(looks)
+        self.resume = resume
+        self.arrays = {}
+
+        # (shape, chunks) of the full resolution (True) and multilooked (False) arrays; the
+        # tiles are laid out on the multilooked grid, like pipeline.tile_plans does
+        rows, columns = meta["height"], meta["width"]
+        looks_rows, looks_cols = self.looks
+        tile_rows, tile_cols = max(1, tile_size // looks_rows), max(1, tile_size // looks_cols)
+        self.grids = {
+            True: ((rows, columns), (tile_rows * looks_rows, tile_cols * looks_cols)),
+            False: ((-(-rows // looks_rows), -(-columns // looks_cols)), (tile_rows, tile_cols)),
+        }
+
+    def __getstate__(self):
+        # Worker processes open the arrays themselves
+        state = self.__dict__.copy()
+        state["arrays"] = {}
+        return state
+
+    def georeference(self):
+        attrs = {"GeoTransform": geotransform(self.meta["transform"])}
+        if self.meta.get("crs"):
+            crs_wkt = CRS.from_user_input(self.meta["crs"]).to_wkt()
+            attrs.update({"crs_wkt": crs_wkt, "spatial_ref": crs_wkt})
+        return attrs
+
+    def open(self):
+        zarr = import_zarr()
+        root = zarr.open_group(self.store, mode="a")
+        scene = dict(self.georeference(), height=self.meta["height"], width=self.meta["width"])
+        if any(key in root.attrs and root.attrs[key] != value for key, value in scene.items()):
+            raise ValueError(f"{self.store} holds the outputs of another scene or region.")
+        root.attrs.update(scene)
+
+        group = root.require_group(self.mode)
+        attrs = {"looks": list(self.looks)}
+        if self.looks != (1, 1):
+            looks_rows, looks_cols = self.looks
+            attrs["looked_GeoTransform"] = geotransform(self.meta["transform"] * Affine.scale(looks_cols, looks_rows))
+        group.attrs.update(attrs)
+        group.create_array("spatial_ref", shape=(), dtype="int64", attributes=self.georeference(), overwrite=True)
+
+        compressors = {"zstd": zarr.codecs.ZstdCodec(), "deflate": zarr.codecs.GzipCodec(), None: "auto"}
+        for name in self.bands:
+            if self.resume and name in group:
+                # Arrays of an interrupted run are completed in place
+                self.arrays[name] = group[name]
+                continue
+            full = name in FULL_RESOLUTION_BANDS
+            shape, chunks = self.grids[full]
+            self.arrays[name] = group.create_array(
+                name, shape=shape, chunks=chunks, dtype="complex64" if name in STORE_COMPLEX_BANDS else "float32",
+                compressors=compressors[self.compress], fill_value=0,
+                dimension_names=("y", "x") if full or self.looks == (1, 1) else ("y_looked", "x_looked"),
+                attributes={"grid_mapping": "spatial_ref", "coordinates": "spatial_ref"}, overwrite=True)
+        return self
+
+    def array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = import_zarr().open_array(self.store, path=f"{self.mode}/{name}", mode="r+")
+        return self.arrays[name]
+
+    def write(self, results, window):
+        for name in self.bands:
+            if name in STORE_COMPLEX_BANDS:
+                real, imag = STORE_COMPLEX_BANDS[name]
+                if real not in results:
+                    continue
+                data = np.empty(results[real].shape, dtype=np.complex64)
+                data.real = results[real]
+                data.imag = results[imag]
+            elif name in results:
+                data = results[name]
+            else:
+                continue
+            self.array(name)[window.toslices()] = data
+
+    def checkpoint(self):
+        # Every write goes straight to the store
+        pass
+
+    def close(self):
+        self.arrays = {}
+
+    def finalize(self):
+        pass
+
+    def discard(self):
+        # Removes the arrays of an aborted run; the other modes and products of the store are kept
+        self.close()
+        group = import_zarr().open_group(self.store, mode="a")
+        if self.mode in group:
+            for name in self.bands:
+                if name in group[self.mode]:
+                    del group[self.mode][name]
+            if set(group[self.mode].keys()) <= {"spatial_ref"}:
+                del group[self.mode]
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is None:
+            self.finalize()